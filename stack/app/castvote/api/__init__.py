@@ -0,0 +1,4 @@
+import bootstrap
+# from common import *
+
+from .handlers import cast_vote_handler, relay_worker_handler, receipt_handler, results_handler
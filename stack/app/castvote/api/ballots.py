@@ -0,0 +1,84 @@
+'''Signed ballots and the bbfarm proxy vote txs that carry them.
+
+A ballot is what a voter signs off chain and anyone can submit for them: BBFarm.submitProxyVote(bytes32[5] proxyReq,
+bytes extra), where proxyReq is [r, s, v ‖ (namespace, sequence), ballotId, voteData]. The relay submits ballots from
+the castvote service account so voters don't need to hold gas.'''
+
+import re
+from typing import List, Dict, NamedTuple
+
+from eth_abi import encode_abi
+from eth_account import Account
+from eth_account.signers.local import LocalAccount
+from eth_utils import keccak
+
+from lib import get_ssm_param_with_enc, get_ssm_param_no_enc, gen_ssm_nodekey_service, gen_ssm_networkid, SVC_CASTVOTE
+
+SUBMIT_PROXY_VOTE_SIG = 'submitProxyVote(bytes32[5],bytes)'
+SUBMIT_PROXY_VOTE_SELECTOR = keccak(text=SUBMIT_PROXY_VOTE_SIG)[:4]
+
+# gas limit for a proxy vote with no extra data (ecrecover, the sequence number and the vote itself), plus what each
+# 32 byte word of `extra` costs to pass in and store
+PROXY_VOTE_GAS = 150000
+PROXY_VOTE_GAS_PER_WORD = 22000
+MAX_EXTRA_BYTES = 1024
+
+_BYTES32 = re.compile(r'^0x[0-9a-fA-F]{64}$')
+_HEX = re.compile(r'^0x(?:[0-9a-fA-F]{2})*$')
+
+Ballot = NamedTuple('Ballot', [('proxy_req', List[str]), ('extra', str)])
+
+
+class InvalidBallot(Exception):
+    pass
+
+
+def parse_ballot(obj) -> Ballot:
+    '''A ballot from its JSON form: {"proxyReq": [5 x bytes32 hex], "extra": "0x..."}; `extra` is optional.'''
+    if type(obj) is not dict:
+        raise InvalidBallot('expected an object with keys proxyReq and extra')
+    proxy_req = obj.get('proxyReq')
+    if type(proxy_req) is not list or len(proxy_req) != 5 or \
+            not all(type(w) is str and _BYTES32.match(w) for w in proxy_req):
+        raise InvalidBallot('proxyReq must be a list of 5 bytes32 hex strings')
+    extra = obj.get('extra', '0x')
+    if type(extra) is not str or not _HEX.match(extra):
+        raise InvalidBallot('extra must be a 0x prefixed hex string')
+    if len(extra) // 2 - 1 > MAX_EXTRA_BYTES:
+        raise InvalidBallot(f"extra is longer than {MAX_EXTRA_BYTES} bytes")
+    return Ballot([w.lower() for w in proxy_req], extra.lower())
+
+
+def ballot_hash(ballot: Ballot) -> str:
+    '''keccak256 over the whole ballot (signature included). Used as the ballot's receipt handle, so resubmitting
+    the same signed ballot gets the same handle.'''
+    return '0x' + keccak(b''.join(bytes.fromhex(w[2:]) for w in ballot.proxy_req) +
+                         bytes.fromhex(ballot.extra[2:])).hex()
+
+
+def ballot_to_json(ballot: Ballot) -> Dict:
+    return {'proxyReq': ballot.proxy_req, 'extra': ballot.extra}
+
+
+def proxy_vote_gas(ballot: Ballot) -> int:
+    n_words = (len(ballot.extra) // 2 - 1 + 31) // 32
+    return PROXY_VOTE_GAS + PROXY_VOTE_GAS_PER_WORD * n_words
+
+
+def encode_proxy_vote(ballot: Ballot) -> bytes:
+    return SUBMIT_PROXY_VOTE_SELECTOR + encode_abi(['bytes32[5]', 'bytes'],
+                                                   [[bytes.fromhex(w[2:]) for w in ballot.proxy_req],
+                                                    bytes.fromhex(ballot.extra[2:])])
+
+
+def mk_proxy_vote_tx(bbfarm_addr: str, ballot: Ballot) -> Dict:
+    return {'to': bbfarm_addr, 'value': 0, 'gas': proxy_vote_gas(ballot), 'gasPrice': 1,
+            'data': encode_proxy_vote(ballot)}
+
+
+def load_castvote_acct(name_prefix: str) -> LocalAccount:
+    return Account.privateKeyToAccount(get_ssm_param_with_enc(gen_ssm_nodekey_service(name_prefix, SVC_CASTVOTE)))
+
+
+def get_chainid(name_prefix: str) -> int:
+    return int(get_ssm_param_no_enc(gen_ssm_networkid(name_prefix)))
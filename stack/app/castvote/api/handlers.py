@@ -0,0 +1,154 @@
+import bootstrap
+
+import base64
+import json
+import os
+import time
+
+import boto3
+
+from common.cache import TtlLruCache
+from common.queue import SqsQueue
+from rpc import JsonRpcClient
+from multirpc import connect
+from rpccache import CachingRpc
+from .ballots import parse_ballot, InvalidBallot, load_castvote_acct, get_chainid
+from .relay import ReceiptStore, enqueue_ballots, run_relay
+from .verify import Verifier, SentSequences, chain_weights
+
+
+class log:
+    @staticmethod
+    def info(str):
+        print('LOG INFO >>', str)
+
+
+s3 = boto3.client('s3')
+
+MAX_BALLOTS_PER_POST = 500
+
+_rpc = None  # type: JsonRpcClient
+
+# ballot id -> (Tally, last checkpointed at); anything dropped resumes from its checkpoint
+_tallies = TtlLruCache(maxsize=32, ttl=3600)
+CHECKPOINT_EVERY = 60  # seconds
+
+
+def _get_rpc() -> JsonRpcClient:
+    # kept for the life of the container so node latencies and health, and final chain data, carry over
+    global _rpc
+    if _rpc is None:
+        _rpc = CachingRpc(connect(os.environ['pEthHost'], os.environ.get('pEthNodeIps', '')))
+    return _rpc
+
+
+def _resp(status_code, body):
+    return {'statusCode': status_code, 'headers': {'Content-Type': 'application/json'}, 'body': json.dumps(body)}
+
+
+def _get_body(event) -> str:
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode()
+    return body
+
+
+def cast_vote_handler(event, ctx):
+    '''POST /ballots: one signed ballot ({"proxyReq": [...], "extra": "0x..."}) or {"ballots": [ballot, ...]}. Each
+    ballot is queued for the relay and answered with a receipt handle to poll.'''
+    try:
+        body = json.loads(_get_body(event))
+    except ValueError:
+        return _resp(400, {'Errors': ['body must be JSON']})
+    batch = type(body) is dict and 'ballots' in body
+    objs = body['ballots'] if batch else [body]
+    if type(objs) is not list or len(objs) == 0:
+        return _resp(400, {'Errors': ['ballots must be a non-empty list']})
+    if len(objs) > MAX_BALLOTS_PER_POST:
+        return _resp(400, {'Errors': [f"at most {MAX_BALLOTS_PER_POST} ballots per request"]})
+    ballots, errors = [], []
+    for (i, obj) in enumerate(objs):
+        try:
+            ballots.append(parse_ballot(obj))
+        except InvalidBallot as e:
+            errors.append(f"ballot {i}: {e}")
+    if errors:
+        return _resp(400, {'Errors': errors})
+
+    receipts = enqueue_ballots(SqsQueue(os.environ['pBallotQueue']), ReceiptStore(os.environ['pReceiptsBucket']),
+                               ballots)
+    ret = [{'Receipt': r['Receipt'], 'State': r['State'], 'StatusPath': f"/ballots/{r['Receipt']}"} for r in receipts]
+    log.info(f"cast vote: {len(ret)} ballots")
+    return _resp(202, {'Receipts': ret} if batch else ret[0])
+
+
+def relay_worker_handler(event, ctx):
+    '''Scheduled: send queued ballots as proxy votes from the castvote service account, after checking their
+    signatures and that the voters are active members. Runs with a reserved concurrency of 1 so it's the only user of
+    that account's nonces.'''
+    # numpy comes in with the snapshot; only this handler needs it
+    from common.membersnap import fetch_snapshot, snapshot_key
+
+    name_prefix = os.environ['pNamePrefix']
+    membership = os.environ['pMembershipContract']
+    rpc = _get_rpc()
+    # until the indexer publishes the first snapshot, members are checked on chain
+    verifier = Verifier(lambda: fetch_snapshot(s3, os.environ['pMembersBucket'], snapshot_key(membership)),
+                        fallback_weights=lambda voters: chain_weights(rpc, membership, voters),
+                        sent_store=SentSequences(os.environ['pReceiptsBucket'], os.environ['pBBFarmAddr'], s3=s3))
+    totals = run_relay(SqsQueue(os.environ['pBallotQueue']), ReceiptStore(os.environ['pReceiptsBucket']),
+                       rpc, load_castvote_acct(name_prefix),
+                       os.environ['pBBFarmAddr'], get_chainid(name_prefix),
+                       remaining_time=lambda: ctx.get_remaining_time_in_millis() / 1000, verifier=verifier)
+    return dict(totals, Verified=verifier.stats['Verified'], CheckedOnChain=verifier.stats['CheckedOnChain'])
+
+
+def receipt_handler(event, ctx):
+    '''GET /ballots/{receipt} -- queued, rejected (with the reason), sent (with the txid), mined, or failed (the
+    proxy vote reverted).'''
+    receipt_id = (event.get('pathParameters') or {}).get('receipt', '')
+    store = ReceiptStore(os.environ['pReceiptsBucket'])
+    try:
+        receipt = store.get(receipt_id)
+    except store.s3.exceptions.NoSuchKey:
+        return _resp(404, {'Errors': [f"no ballot {receipt_id}"]})
+    if receipt['State'] == 'sent':
+        tx_receipt = _get_rpc().get_transaction_receipt(receipt['Txid'])
+        if tx_receipt is not None:
+            receipt.update({'State': 'mined' if tx_receipt.get('status', 1) == 1 else 'failed',
+                            'BlockNumber': tx_receipt['blockNumber']})
+    return _resp(200, receipt)
+
+
+def results_handler(event, ctx):
+    '''GET /results/{ballotId} -- the weighted tally so far. A warm container keeps the tally in memory and only reads
+    blocks since its last request; the state is checkpointed to S3 for cold starts. 404 for a ballot bbfarm doesn't
+    have.'''
+    # numpy is only needed here
+    from .tally import load_tally, save_tally, BallotNotFound
+
+    try:
+        ballot_id = int((event.get('pathParameters') or {}).get('ballotId', ''), 0)
+    except ValueError:
+        return _resp(400, {'Errors': ['ballotId must be an integer (0x prefixed for hex)']})
+    if not 0 <= ballot_id < 2 ** 256:
+        return _resp(400, {'Errors': ['ballotId must be a uint256']})
+    bucket = os.environ['pReceiptsBucket']
+    cached = _tallies.get(ballot_id)
+    if cached is None:
+        tally = load_tally(s3, bucket, os.environ['pBBFarmAddr'], os.environ['pMembershipContract'], ballot_id)
+        try:
+            # only ballots bbfarm knows about take a place in the cache
+            tally.end_time(_get_rpc())
+        except BallotNotFound as e:
+            return _resp(404, {'Errors': [str(e)]})
+        cached = (tally, time.time())
+        _tallies.put(ballot_id, cached)
+    (tally, saved_at) = cached
+    stats = tally.catch_up(_get_rpc())
+    advanced = stats['ToBlock'] >= stats['FromBlock']
+    if advanced and (time.time() - saved_at > CHECKPOINT_EVERY or stats['Closed']):
+        save_tally(s3, bucket, tally)
+        _tallies.put(ballot_id, (tally, time.time()))
+    log.info(f"results: {stats}; tallies {_tallies.stats()}")
+    return _resp(200, tally.results())
@@ -0,0 +1,230 @@
+'''The cast-vote relay.
+
+Ballots posted to the API get a receipt (keyed by the ballot's hash) and are queued, several to a message. The relay
+worker drains the queue once per block: it signs a proxy vote tx per ballot from the castvote service account with
+consecutive nonces and broadcasts them in JSON-RPC batches, taking as many ballots as fit in the block's gas limit and
+holding back when too many of our txs are still unmined, so a lagging chain makes ballots wait in the queue rather
+than in the node's tx pool.'''
+
+import json
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple, Callable, Optional
+
+import boto3
+from eth_account.signers.local import LocalAccount
+
+from common.queue import Message
+from txpipe import NonceStream, sign_txs, broadcast
+from .ballots import Ballot, ballot_hash, ballot_to_json, proxy_vote_gas, mk_proxy_vote_tx, parse_ballot
+
+log = logging.getLogger("castvote-relay")
+log.setLevel(logging.INFO)
+
+BALLOTS_PER_MSG = 50  # keeps a message well under SQS's 256KB even with the largest `extra`
+
+
+class ReceiptStore:
+    '''Receipts live in S3 as receipts/<ballot hash>.json.'''
+
+    def __init__(self, bucket: str, s3=None):
+        self.bucket = bucket
+        self.s3 = boto3.client('s3') if s3 is None else s3
+
+    def put(self, receipt: Dict):
+        self.s3.put_object(Bucket=self.bucket, Key=f"receipts/{receipt['Receipt']}.json",
+                           Body=json.dumps(receipt).encode(), ContentType='application/json')
+
+    def put_many(self, receipts: List[Dict]):
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            list(pool.map(self.put, receipts))
+
+    def get(self, receipt: str) -> Dict:
+        return json.loads(self.s3.get_object(Bucket=self.bucket, Key=f"receipts/{receipt}.json")['Body'].read())
+
+    def get_many(self, receipts: List[str]) -> List[Optional[Dict]]:
+        '''The stored receipt for each handle, or None where there isn't one.'''
+        def get(r):
+            try:
+                return self.get(r)
+            except self.s3.exceptions.NoSuchKey:
+                return None
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            return list(pool.map(get, receipts))
+
+
+def enqueue_ballots(queue, receipts: ReceiptStore, ballots: List[Ballot]) -> List[Dict]:
+    '''Queue each ballot we haven't seen before and return a receipt for every ballot, in order. A ballot that's
+    already been queued (same hash) gets its existing receipt back rather than being sent twice, unless it was
+    rejected: the voter may have become eligible since.'''
+    handles = [ballot_hash(b) for b in ballots]
+    unique = list(OrderedDict.fromkeys(handles))
+    existing = {h: (r if r is None or r['State'] != 'rejected' else None)
+                for (h, r) in zip(unique, receipts.get_many(unique))}
+    now = time.time()
+    new = OrderedDict()
+    for (h, b) in zip(handles, ballots):
+        if existing[h] is None and h not in new:
+            new[h] = {'Receipt': h, 'State': 'queued', 'BallotId': b.proxy_req[3], 'Queued': now}
+            existing[h] = new[h]
+    if new:
+        receipts.put_many(list(new.values()))
+        items = [{'Receipt': h, 'Ballot': ballot_to_json(b), 'Queued': now} for (h, b) in zip(handles, ballots)
+                 if h in new]
+        # each new ballot appears once even if it was posted twice in this request
+        items = list(OrderedDict((i['Receipt'], i) for i in items).values())
+        queue.send_many([{'Ballots': items[i:i + BALLOTS_PER_MSG]} for i in range(0, len(items), BALLOTS_PER_MSG)])
+    return [existing[h] for h in handles]
+
+
+class PendingBallots:
+    '''Ballots received from the queue and not yet sent, oldest first. A queue message is only deleted once every
+    ballot it carried has been sent; a ballot seen again (redelivered, or posted twice) is dropped.'''
+
+    def __init__(self):
+        self.pending = OrderedDict()  # type: Dict[str, Tuple[Ballot, float, str]]
+        self.refs = {}  # type: Dict[str, int]  # message handle -> ballots from it still pending
+        self.seen = set()
+        self.done_handles = []  # type: List[str]
+        self.gas = 0
+
+    def add_many(self, msgs: List[Message], verifier=None) -> List[Dict]:
+        '''Add the ballots carried by `msgs`. With a `verifier`, ballots that fail its checks aren't added; their
+        (rejected) receipts are returned.'''
+        items = []
+        for msg in msgs:
+            self.refs[msg.handle] = 0
+            for item in msg.body['Ballots']:
+                h = item['Receipt']
+                if h in self.seen:
+                    continue
+                self.seen.add(h)
+                items.append((h, parse_ballot(item['Ballot']), item['Queued'], msg.handle))
+        rejected = []
+        if verifier is not None and items:
+            checked = verifier.check([b for (_, b, _, _) in items])
+            rejected = [{'Receipt': h, 'State': 'rejected', 'Reason': reason, 'Voter': voter,
+                         'BallotId': b.proxy_req[3], 'Queued': queued}
+                        for ((h, b, queued, _), (voter, reason)) in zip(items, checked) if reason is not None]
+            items = [i for (i, (_, reason)) in zip(items, checked) if reason is None]
+            # a rejected ballot can be posted again (say once the voter is a member), so forget we've seen it
+            self.seen.difference_update(r['Receipt'] for r in rejected)
+        for (h, ballot, queued, handle) in items:
+            self.pending[h] = (ballot, queued, handle)
+            self.refs[handle] += 1
+            self.gas += proxy_vote_gas(ballot)
+        for msg in msgs:
+            if self.refs[msg.handle] == 0:
+                del self.refs[msg.handle]
+                self.done_handles.append(msg.handle)
+        return rejected
+
+    def take(self, gas_budget: int, max_n: int) -> List[Tuple[str, Ballot, float]]:
+        '''The oldest ballots whose txs fit within `gas_budget`, at most `max_n` of them.'''
+        batch = []
+        while self.pending and len(batch) < max_n:
+            (h, (ballot, queued, handle)) = next(iter(self.pending.items()))
+            gas = proxy_vote_gas(ballot)
+            if gas > gas_budget:
+                break
+            gas_budget -= gas
+            self.gas -= gas
+            del self.pending[h]
+            batch.append((h, ballot, queued))
+            self.refs[handle] -= 1
+            if self.refs[handle] == 0:
+                del self.refs[handle]
+                self.done_handles.append(handle)
+        return batch
+
+    def take_done_handles(self) -> List[str]:
+        (ret, self.done_handles) = (self.done_handles, [])
+        return ret
+
+    def handles(self) -> List[str]:
+        return list(self.refs)
+
+    def leftovers(self) -> List[Dict]:
+        return [{'Receipt': h, 'Ballot': ballot_to_json(b), 'Queued': queued}
+                for (h, (b, queued, _)) in self.pending.items()]
+
+    def __len__(self):
+        return len(self.pending)
+
+
+def flush_block(queue, pending: PendingBallots, receipts: ReceiptStore, rpc, acct: LocalAccount, bbfarm_addr: str,
+                chainid: int, verifier=None, max_in_flight=2048, block_fill=0.95, max_receive=2000) -> Dict:
+    '''Top up `pending` from the queue (dropping ballots `verifier` rejects) and send as many ballots as fit in one
+    block and the in-flight window.'''
+    gas_limit = rpc.get_block('latest')['gasLimit']
+    budget = int(gas_limit * block_fill)
+    # keep about two blocks' worth on hand so a full block can always be sent
+    received = 0
+    rejected = []
+    while pending.gas < 2 * budget and received < max_receive:
+        msgs = queue.receive(min(100, max_receive - received))
+        if len(msgs) == 0:
+            break
+        received += len(msgs)
+        rejected += pending.add_many(msgs, verifier)
+    if rejected:
+        receipts.put_many(rejected)
+
+    mined_nonce = rpc.get_transaction_count(acct.address, 'latest')
+    next_nonce = rpc.get_transaction_count(acct.address, 'pending')
+    in_flight = next_nonce - mined_nonce
+    stats = {'Backlog': len(pending), 'InFlight': in_flight, 'Sent': 0, 'Gas': 0, 'Rejected': len(rejected)}
+    batch = pending.take(budget, max(0, max_in_flight - in_flight))
+    if batch:
+        txs = [mk_proxy_vote_tx(bbfarm_addr, b) for (_, b, _) in batch]
+        signed = sign_txs(acct, txs, NonceStream(next_nonce), chainid=chainid)
+        broadcast(rpc, acct.address, signed, window=max_in_flight)
+        now = time.time()
+        receipts.put_many([{'Receipt': h, 'State': 'sent', 'BallotId': b.proxy_req[3], 'Queued': queued, 'Sent': now,
+                            'Sender': acct.address, 'Nonce': stx.nonce, 'Txid': stx.txid}
+                           for ((h, b, queued), stx) in zip(batch, signed)])
+        if verifier is not None:
+            verifier.record_sent([h for (h, _, _) in batch])
+        stats.update({'Sent': len(signed), 'Gas': sum(tx['gas'] for tx in txs)})
+    done = pending.take_done_handles()
+    if done:
+        queue.delete(done)
+    stats['Backlog'] = len(pending)
+    return stats
+
+
+def run_relay(queue, receipts: ReceiptStore, rpc, acct: LocalAccount, bbfarm_addr: str, chainid: int,
+              remaining_time: Callable[[], float], verifier=None, margin=15, idle_blocks=3, poll_rate=0.25,
+              **flush_kwargs) -> Dict:
+    '''Flush once per new block until the queue has been idle for `idle_blocks` blocks or we're near the deadline.
+    Ballots still pending are queued again for the next run; their original messages can't just be released since
+    some of the ballots they carried may have been sent.'''
+    pending = PendingBallots()
+    totals = {'Blocks': 0, 'Sent': 0, 'Gas': 0, 'Rejected': 0}
+    last_block = None
+    idle = 0
+    while idle < idle_blocks and remaining_time() > margin:
+        block = rpc.block_number()
+        if block == last_block:
+            time.sleep(poll_rate)
+            continue
+        last_block = block
+        stats = flush_block(queue, pending, receipts, rpc, acct, bbfarm_addr, chainid, verifier=verifier,
+                            **flush_kwargs)
+        log.info(f"[run_relay] block {block}: {stats}")
+        totals['Blocks'] += 1
+        totals['Sent'] += stats['Sent']
+        totals['Gas'] += stats['Gas']
+        totals['Rejected'] += stats['Rejected']
+        idle = idle + 1 if stats['Sent'] == 0 and stats['Backlog'] == 0 else 0
+    leftovers = pending.leftovers()
+    if leftovers:
+        queue.send_many([{'Ballots': leftovers[i:i + BALLOTS_PER_MSG]}
+                         for i in range(0, len(leftovers), BALLOTS_PER_MSG)])
+    queue.delete(pending.handles() + pending.take_done_handles())
+    totals['Requeued'] = len(leftovers)
+    log.info(f"[run_relay] {totals}")
+    return totals
@@ -0,0 +1,202 @@
+'''Weighted tally of a bbfarm ballot.
+
+Votes are read from bbfarm's Vote(uint256 indexed ballotId, bytes32 vote, address voter, bytes extra) events and voter
+weights from Membership's SetMember events, both fetched in parallel chunks (logscan) and decoded in bulk with numpy.
+Only a voter's last vote counts, and it counts with the weight their membership record gives them at the ballot's
+end time, using the record as it stood when the ballot closed (so SetMember txs after the close don't change the
+result). The state is a handful of arrays keyed by address that can be saved as a checkpoint, so catching up only
+reads blocks since the last run.'''
+
+import io
+import json
+import logging
+import time
+from typing import List, Dict, Optional
+
+import numpy as np
+from eth_utils import keccak
+
+from logscan import fetch_logs
+
+log = logging.getLogger("castvote-tally")
+log.setLevel(logging.INFO)
+
+VOTE_TOPIC = '0x' + keccak(text='Vote(uint256,bytes32,address,bytes)').hex()
+SET_MEMBER_TOPIC = '0x' + keccak(text='SetMember(address,uint48,uint48,uint48)').hex()
+GET_DETAILS_SELECTOR = keccak(text='getDetails(uint256,address)')[:4].hex()
+END_TIME_WORD = 5  # getDetails returns (hasVoted, nVotesCast, secKey, submissionBits, startTime, endTime, ...)
+
+CONFIRMATIONS = 2
+
+ADDR = np.dtype('S20')
+WORD = np.dtype('S32')
+
+
+class BallotNotFound(Exception):
+    pass
+
+
+def _words(logs: List[Dict], n_words: int) -> np.ndarray:
+    '''The first `n_words` data words of every log as an (n, 32 * n_words) uint8 array.'''
+    hexes = ''.join(l['data'][2:2 + 64 * n_words] for l in logs)
+    return np.frombuffer(bytes.fromhex(hexes), dtype=np.uint8).reshape(len(logs), 32 * n_words)
+
+
+def _uint(words: np.ndarray, i: int) -> np.ndarray:
+    '''Word `i` of each row as uint64 (its low 8 bytes; every value we read here fits).'''
+    return words[:, 32 * i + 24:32 * (i + 1)].copy().view('>u8').ravel().astype(np.uint64)
+
+
+def _last_by_key(keys: np.ndarray, *cols: np.ndarray):
+    '''Rows of `cols` for the last occurrence of each key (input in chronological order), sorted by key.'''
+    if len(keys) == 0:
+        return (keys,) + cols
+    rev = keys[::-1]
+    (uniq, idx) = np.unique(rev, return_index=True)
+    return (uniq,) + tuple(c[::-1][idx] for c in cols)
+
+
+def decode_votes(logs: List[Dict]):
+    '''(voter, vote) arrays for Vote logs, in log order.'''
+    if len(logs) == 0:
+        return np.zeros(0, dtype=ADDR), np.zeros(0, dtype=WORD)
+    w = _words(logs, 2)
+    return w[:, 44:64].copy().view(ADDR).ravel(), w[:, 0:32].copy().view(WORD).ravel()
+
+
+def decode_set_members(logs: List[Dict]):
+    '''(address, weight, start, end) arrays for SetMember logs, in log order.'''
+    if len(logs) == 0:
+        return (np.zeros(0, dtype=ADDR),) + tuple(np.zeros(0, dtype=np.uint64) for _ in range(3))
+    w = _words(logs, 4)
+    return w[:, 12:32].copy().view(ADDR).ravel(), _uint(w, 1), _uint(w, 2), _uint(w, 3)
+
+
+class Tally:
+    def __init__(self, bbfarm: str, membership: str, ballot_id: int, meta: Optional[Dict] = None,
+                 cols: Optional[Dict[str, np.ndarray]] = None):
+        self.bbfarm = bbfarm
+        self.membership = membership
+        self.ballot_id = ballot_id
+        self.meta = meta or {'LastBlock': -1, 'EndTime': None, 'CloseBlock': None, 'NVoteLogs': 0}
+        empty = decode_set_members([])
+        self.cols = cols or {'voter': np.zeros(0, dtype=ADDR), 'vote': np.zeros(0, dtype=WORD),
+                             'm_addr': empty[0], 'm_weight': empty[1], 'm_start': empty[2], 'm_end': empty[3]}
+
+    @property
+    def last_block(self) -> int:
+        return self.meta['LastBlock']
+
+    def end_time(self, rpc) -> int:
+        if self.meta['EndTime'] is None:
+            ret = rpc.call({'to': self.bbfarm, 'data': '0x' + GET_DETAILS_SELECTOR + '{:064x}'.format(self.ballot_id) +
+                            '00' * 32})
+            end_word = ret[2 + 64 * END_TIME_WORD:2 + 64 * (END_TIME_WORD + 1)]
+            # bbfarm answers with zeros for a ballot it doesn't have (and a node with nothing at all when there's no
+            # contract)
+            if len(end_word) < 64 or int(end_word, 16) == 0:
+                raise BallotNotFound(f"no ballot {self.ballot_id:#x} on bbfarm {self.bbfarm}")
+            self.meta['EndTime'] = int(end_word, 16)
+        return self.meta['EndTime']
+
+    def close_block(self, rpc, head: int) -> Optional[int]:
+        '''The first block after the ballot's end time, once there is one.'''
+        if self.meta['CloseBlock'] is None:
+            end_time = self.end_time(rpc)
+            if rpc.get_block(head)['timestamp'] <= end_time:
+                return None
+            (lo, hi) = (max(0, self.last_block), head)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if rpc.get_block(mid)['timestamp'] > end_time:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            self.meta['CloseBlock'] = lo
+        return self.meta['CloseBlock']
+
+    def catch_up(self, rpc, head: Optional[int] = None) -> Dict:
+        '''Read Vote and SetMember logs from the last block seen up to the (confirmed) head, or up to the close.'''
+        start = time.time()
+        head = rpc.block_number() if head is None else head
+        to_block = head - CONFIRMATIONS
+        close = self.close_block(rpc, to_block) if to_block >= 0 else None
+        if close is not None:
+            to_block = min(to_block, close - 1)
+        from_block = self.last_block + 1
+        stats = {'FromBlock': from_block, 'ToBlock': to_block, 'NVotes': 0, 'NSetMembers': 0,
+                 'Closed': close is not None}
+        if to_block < from_block:
+            return stats
+        vote_logs = fetch_logs(rpc, self.bbfarm, [VOTE_TOPIC, '0x{:064x}'.format(self.ballot_id)], from_block, to_block)
+        member_logs = fetch_logs(rpc, self.membership, [SET_MEMBER_TOPIC], from_block, to_block)
+
+        (voter, vote) = decode_votes(vote_logs)
+        c = self.cols
+        (c['voter'], c['vote']) = _last_by_key(np.concatenate([c['voter'], voter]), np.concatenate([c['vote'], vote]))
+        m = decode_set_members(member_logs)
+        names = ['m_addr', 'm_weight', 'm_start', 'm_end']
+        merged = _last_by_key(*[np.concatenate([c[k], new]) for (k, new) in zip(names, m)])
+        c.update(zip(names, merged))
+        self.meta['LastBlock'] = to_block
+        self.meta['NVoteLogs'] += len(vote_logs)
+        stats.update({'NVotes': len(vote_logs), 'NSetMembers': len(member_logs), 'Seconds': time.time() - start})
+        log.info(f"[Tally.catch_up] ballot {self.ballot_id:x}: {stats}")
+        return stats
+
+    def weights(self, at: int) -> np.ndarray:
+        '''Each voter's weight at time `at` from the membership records seen so far.'''
+        c = self.cols
+        if len(c['m_addr']) == 0:
+            return np.zeros(len(c['voter']), dtype=np.uint64)
+        i = np.searchsorted(c['m_addr'], c['voter'])
+        j = np.minimum(i, len(c['m_addr']) - 1)
+        ok = (c['m_addr'][j] == c['voter']) & (c['m_start'][j] <= at) & (c['m_end'][j] >= at)
+        return np.where(ok, c['m_weight'][j], 0).astype(np.uint64)
+
+    def results(self, at: Optional[int] = None) -> Dict:
+        '''Total weight and number of voters behind each distinct vote. Weights are taken at the ballot's end time
+        (or `at`); votes from voters with no weight there are counted separately.'''
+        at = self.meta['EndTime'] if at is None else at
+        w = self.weights(at)
+        counted = w > 0
+        (options, inv) = np.unique(self.cols['vote'][counted], return_inverse=True)
+        totals = np.zeros(len(options), dtype=np.uint64)
+        np.add.at(totals, inv, w[counted])
+        counts = np.bincount(inv, minlength=len(options))
+        order = np.argsort(-totals.astype(np.int64), kind='stable')
+        return {'BallotId': '0x{:064x}'.format(self.ballot_id), 'Block': self.last_block, 'At': at,
+                'Closed': self.meta['CloseBlock'] is not None, 'NVoters': int(len(w)),
+                'NIneligible': int((~counted).sum()), 'TotalWeight': int(totals.sum()),
+                'Results': [{'Vote': '0x' + options[k].ljust(32, b'\0').hex(), 'Weight': int(totals[k]),
+                             'NVoters': int(counts[k])} for k in order]}
+
+    # checkpoints
+
+    def dumps(self) -> bytes:
+        buf = io.BytesIO()
+        np.savez(buf, meta=np.array(json.dumps(self.meta)), **self.cols)
+        return buf.getvalue()
+
+    @classmethod
+    def loads(cls, bbfarm: str, membership: str, ballot_id: int, data: bytes) -> 'Tally':
+        with np.load(io.BytesIO(data), allow_pickle=False) as f:
+            cols = {k: f[k] for k in f.files if k != 'meta'}
+            meta = json.loads(str(f['meta']))
+        return cls(bbfarm, membership, ballot_id, meta, cols)
+
+
+def checkpoint_key(bbfarm: str, ballot_id: int) -> str:
+    return f"tally/{bbfarm.lower()}/{ballot_id:064x}.npz"
+
+
+def load_tally(s3, bucket: str, bbfarm: str, membership: str, ballot_id: int) -> Tally:
+    try:
+        data = s3.get_object(Bucket=bucket, Key=checkpoint_key(bbfarm, ballot_id))['Body'].read()
+    except s3.exceptions.NoSuchKey:
+        return Tally(bbfarm, membership, ballot_id)
+    return Tally.loads(bbfarm, membership, ballot_id, data)
+
+
+def save_tally(s3, bucket: str, tally: Tally):
+    s3.put_object(Bucket=bucket, Key=checkpoint_key(tally.bbfarm, tally.ballot_id), Body=tally.dumps())
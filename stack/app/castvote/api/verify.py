@@ -0,0 +1,231 @@
+'''Checks a ballot has to pass before the relay spends gas on it.
+
+bbfarm recovers the voter from the ballot itself: proxyReq[2] is v (first byte) followed by 31 bytes whose last 4 are
+the voter's sequence number, and the signed message is keccak256 of those 31 bytes ‖ ballotId ‖ voteData ‖ extra. We
+do the same recovery off chain, in bulk across processes, then check every recovered voter against the published
+member snapshot (weight > 0 and start <= now <= end, as Membership.balanceOf does) in one vectorised lookup, and
+keep only the latest sequence number per voter and ballot. Until the indexer has published a snapshot, members are
+checked with Membership.balanceOf calls instead. The sequence numbers sent are saved (SentSequences) so that a later
+relay run also drops a replayed or stale ballot rather than sending it for bbfarm to revert.'''
+
+import json
+import logging
+import multiprocessing
+import os
+import time
+from typing import List, Dict, Tuple, Optional, Callable
+
+import boto3
+from eth_account import Account
+from eth_utils import keccak
+
+from .ballots import Ballot, ballot_hash
+
+log = logging.getLogger("castvote-verify")
+log.setLevel(logging.INFO)
+
+MIN_PER_WORKER = 64  # below this a batch isn't worth forking for
+
+BALANCE_OF_SELECTOR = keccak(text='balanceOf(address)')[:4].hex()
+
+REJECT_BAD_SIG = 'bad signature'
+REJECT_NOT_MEMBER = 'not an active member'
+REJECT_DUPLICATE = 'superseded by a later ballot from the same voter'
+REJECT_STALE_SEQUENCE = 'sequence number not above one already accepted'
+
+
+def unpack_proxy_req(ballot: Ballot) -> Tuple[int, int, int, bytes, int]:
+    '''(v, r, s, the signed 31 bytes of proxyReq[2], sequence number)'''
+    req2 = bytes.fromhex(ballot.proxy_req[2][2:])
+    (r, s) = (int(ballot.proxy_req[0], 16), int(ballot.proxy_req[1], 16))
+    return req2[0], r, s, req2[1:], int.from_bytes(req2[-4:], 'big')
+
+
+def signed_message(ballot: Ballot) -> bytes:
+    (_, _, _, req2, _) = unpack_proxy_req(ballot)
+    return req2 + b''.join(bytes.fromhex(w[2:]) for w in ballot.proxy_req[3:]) + bytes.fromhex(ballot.extra[2:])
+
+
+def sign_ballot(key: bytes, ballot_id: str, vote_data: str, seq: int, extra='0x') -> Ballot:
+    '''A ballot from voter `key` with sequence number `seq`, signed the way bbfarm checks it (recover_voter undoes
+    this). Ballots come signed from voters' clients; this is for tests and load generators.'''
+    req2 = b'\0' * 27 + seq.to_bytes(4, 'big')
+    unsigned = Ballot(['0x' + '00' * 32, '0x' + '00' * 32, '0x00' + req2.hex(), ballot_id, vote_data], extra)
+    sig = Account.signHash(keccak(signed_message(unsigned)), key)
+    return Ballot(['0x{:064x}'.format(sig.r), '0x{:064x}'.format(sig.s), '0x' + bytes([sig.v]).hex() + req2.hex(),
+                   ballot_id, vote_data], extra)
+
+
+def recover_voter(ballot: Ballot) -> Optional[str]:
+    '''The address that signed `ballot`, or None if the signature can't be valid.'''
+    (v, r, s, _, _) = unpack_proxy_req(ballot)
+    # ecrecover only takes v as 27 or 28 and returns 0 for anything else
+    if v not in (27, 28):
+        return None
+    try:
+        return Account.recoverHash(keccak(signed_message(ballot)), vrs=(v, r, s))
+    except Exception:
+        return None
+
+
+def _recover_chunk(ballots: List[Ballot]) -> List[Optional[str]]:
+    return [recover_voter(b) for b in ballots]
+
+
+def _recover_into(ballots: List[Ballot], conn):
+    conn.send(_recover_chunk(ballots))
+    conn.close()
+
+
+def recover_voters(ballots: List[Ballot], workers: Optional[int] = None) -> List[Optional[str]]:
+    '''recover_voter for every ballot, split across `workers` processes (default: one per CPU). Lambda has no
+    /dev/shm, so multiprocessing.Pool and ProcessPoolExecutor can't start there; plain Processes and Pipes work.'''
+    workers = min(workers or os.cpu_count() or 1, len(ballots) // MIN_PER_WORKER)
+    if workers <= 1:
+        return _recover_chunk(ballots)
+    size = -(-len(ballots) // workers)
+    chunks = [ballots[i:i + size] for i in range(0, len(ballots), size)]
+    procs = []
+    for chunk in chunks[1:]:
+        (recv_conn, send_conn) = multiprocessing.Pipe(duplex=False)
+        p = multiprocessing.Process(target=_recover_into, args=(chunk, send_conn), daemon=True)
+        p.start()
+        send_conn.close()
+        procs.append((p, recv_conn))
+    # this process takes the first chunk rather than sitting idle
+    voters = _recover_chunk(chunks[0])
+    for (p, conn) in procs:
+        voters.extend(conn.recv())
+        p.join()
+    return voters
+
+
+def chain_weights(rpc, membership_addr: str, voters: List[str], batch_size=500) -> List[int]:
+    '''Membership.balanceOf for each voter, as of the latest block.'''
+    calls = [('eth_call', [{'to': membership_addr, 'data': '0x' + BALANCE_OF_SELECTOR + '00' * 12 + v[2:].lower()},
+                           'latest']) for v in voters]
+    return [int(w, 16) for i in range(0, len(calls), batch_size) for w in rpc.batch(calls[i:i + batch_size])]
+
+
+class SentSequences:
+    '''The highest sequence number sent per voter for each ballot, kept in S3 as sent/<bbfarm>/<ballot id>.json next
+    to the receipts. Only the relay writes these (and only one relay runs at a time).'''
+
+    def __init__(self, bucket: str, bbfarm: str, s3=None):
+        self.bucket = bucket
+        self.bbfarm = bbfarm
+        self.s3 = boto3.client('s3') if s3 is None else s3
+
+    def key(self, ballot_id: str) -> str:
+        return f"sent/{self.bbfarm.lower()}/{ballot_id[2:]}.json"
+
+    def load(self, ballot_id: str) -> Dict[str, int]:
+        try:
+            return json.loads(self.s3.get_object(Bucket=self.bucket, Key=self.key(ballot_id))['Body'].read())
+        except self.s3.exceptions.NoSuchKey:
+            return {}
+
+    def save(self, ballot_id: str, seqs: Dict[str, int]):
+        self.s3.put_object(Bucket=self.bucket, Key=self.key(ballot_id), Body=json.dumps(seqs).encode(),
+                           ContentType='application/json')
+
+
+class Verifier:
+    '''Verifies batches of ballots for one relay run. `load_snapshot` returns the current MemberSnapshot; it's
+    called at most every `snapshot_ttl` seconds. If it raises SnapshotMissing, voters' weights come from
+    `fallback_weights` (voters -> weights, e.g. `chain_weights`) for that batch. With a `sent_store`
+    (SentSequences), sequence numbers sent by earlier runs count as accepted too; tell it what was sent with
+    `record_sent`.'''
+
+    def __init__(self, load_snapshot: Callable, workers: Optional[int] = None, snapshot_ttl=30,
+                 clock: Callable[[], float] = time.time,
+                 fallback_weights: Optional[Callable[[List[str]], List[int]]] = None,
+                 sent_store: Optional[SentSequences] = None):
+        self.load_snapshot = load_snapshot
+        self.fallback_weights = fallback_weights
+        self.workers = workers
+        self.snapshot_ttl = snapshot_ttl
+        self.clock = clock
+        self.sent_store = sent_store
+        self._snapshot = (0.0, None)
+        self.accepted = {}  # type: Dict[Tuple[str, str], int]  # (voter, ballotId) -> highest sequence accepted
+        self.sent = {}  # type: Dict[str, Dict[str, int]]  # ballotId -> voter -> highest sequence sent, by any run
+        self._unsent = {}  # type: Dict[str, Tuple[str, str, int]]  # accepted ballot's hash -> (voter, ballotId, seq)
+        self.stats = {'Verified': 0, 'Rejected': 0, 'CheckedOnChain': 0}
+
+    def sent_for(self, ballot_id: str) -> Dict[str, int]:
+        if ballot_id not in self.sent:
+            self.sent[ballot_id] = {} if self.sent_store is None else self.sent_store.load(ballot_id)
+        return self.sent[ballot_id]
+
+    def record_sent(self, receipts: List[str]):
+        '''Note that the accepted ballots with these receipts (hashes) were sent, and save their sequence numbers for
+        later runs.'''
+        changed = set()
+        for h in receipts:
+            if h not in self._unsent:
+                continue
+            (voter, ballot_id, seq) = self._unsent.pop(h)
+            sent = self.sent_for(ballot_id)
+            if seq > sent.get(voter, 0):
+                sent[voter] = seq
+                changed.add(ballot_id)
+        if self.sent_store is not None:
+            for ballot_id in sorted(changed):
+                self.sent_store.save(ballot_id, self.sent[ballot_id])
+
+    def snapshot(self):
+        (loaded_at, snap) = self._snapshot
+        if snap is None or self.clock() - loaded_at > self.snapshot_ttl:
+            snap = self.load_snapshot()
+            self._snapshot = (self.clock(), snap)
+        return snap
+
+    def weights(self, voters: List[str]) -> List[int]:
+        # the snapshot module (and numpy) is already loaded by whatever load_snapshot uses
+        from common.membersnap import SnapshotMissing
+
+        try:
+            return list(self.snapshot().weights(voters, int(self.clock())))
+        except SnapshotMissing as e:
+            if self.fallback_weights is None:
+                raise
+            log.warning(f"[Verifier] {e}; checking {len(voters)} voters on chain")
+            self.stats['CheckedOnChain'] += len(voters)
+            return self.fallback_weights(voters)
+
+    def check(self, ballots: List[Ballot]) -> List[Tuple[Optional[str], Optional[str]]]:
+        '''(voter, reason rejected) for each ballot; the reason is None for ballots worth sending.'''
+        voters = recover_voters(ballots, self.workers)
+        ret = [(v, None if v is not None else REJECT_BAD_SIG) for v in voters]
+        signed = [i for (i, v) in enumerate(voters) if v is not None]
+        if signed:
+            weights = self.weights([voters[i] for i in signed])
+            for (i, w) in zip(signed, weights):
+                if w == 0:
+                    ret[i] = (voters[i], REJECT_NOT_MEMBER)
+
+        # of a voter's ballots for the same ballotId, only the highest sequence number counts on chain (and bbfarm
+        # refuses anything at or below the last one it saw, starting from 0)
+        best = {}  # type: Dict[Tuple[str, str], Tuple[int, int]]  # -> (sequence, index)
+        for (i, (voter, reason)) in enumerate(ret):
+            if reason is not None:
+                continue
+            key = (voter, ballots[i].proxy_req[3])
+            seq = unpack_proxy_req(ballots[i])[4]
+            if seq <= max(self.accepted.get(key, 0), self.sent_for(key[1]).get(voter, 0)):
+                ret[i] = (voter, REJECT_STALE_SEQUENCE)
+            elif key in best and best[key][0] >= seq:
+                ret[i] = (voter, REJECT_DUPLICATE)
+            else:
+                if key in best:
+                    ret[best[key][1]] = (voter, REJECT_DUPLICATE)
+                best[key] = (seq, i)
+        for (key, (seq, i)) in best.items():
+            self.accepted[key] = seq
+            self._unsent[ballot_hash(ballots[i])] = key + (seq,)
+
+        n_ok = len(best)
+        self.stats['Verified'] += n_ok
+        self.stats['Rejected'] += len(ballots) - n_ok
+        return ret
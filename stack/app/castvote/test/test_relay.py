@@ -0,0 +1,170 @@
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+cr_common_dir = os.path.join(main_dir, '../../cr/common')
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'api'))
+sys.path.insert(0, os.path.join(main_dir, '../common'))
+sys.path.insert(0, os.path.join(cr_common_dir, 'deps'))
+sys.path.insert(0, cr_common_dir)
+
+import io
+import logging
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+from eth_account import Account
+from common.queue import LocalQueue
+from api.ballots import parse_ballot, proxy_vote_gas, InvalidBallot, PROXY_VOTE_GAS
+from api.relay import ReceiptStore, PendingBallots, enqueue_ballots, flush_block, run_relay
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestRelay')
+
+BBFARM = '0x' + 'bb' * 20
+
+
+class FakeS3:
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+
+class FakeNode:
+    def __init__(self, gas_limit):
+        self.gas_limit = gas_limit
+        self.head = 1
+        self.mined = 0
+        self.sent = []
+
+    def block_number(self):
+        return self.head
+
+    def get_block(self, block):
+        return {'gasLimit': self.gas_limit}
+
+    def get_transaction_count(self, addr, block):
+        return self.mined if block == 'latest' else len(self.sent)
+
+    def send_raw_transaction(self, raw):
+        self.sent.append(raw)
+
+    def send_raw_transactions(self, raws):
+        self.sent.extend(raws)
+
+    def mine(self):
+        self.head += 1
+        self.mined = len(self.sent)
+
+
+def mk_ballot(i, extra='0x'):
+    return parse_ballot({'proxyReq': ['0x{:064x}'.format(i * 5 + j + 1) for j in range(5)], 'extra': extra})
+
+
+def test_parse_ballot():
+    b = mk_ballot(1, '0x' + 'ab' * 33)
+    assert proxy_vote_gas(b) > proxy_vote_gas(mk_ballot(1)) == PROXY_VOTE_GAS
+    for bad in [{'proxyReq': ['0x00'] * 5}, {'proxyReq': ['0x' + '00' * 32] * 4}, [],
+                {'proxyReq': ['0x' + '00' * 32] * 5, 'extra': '0xabc'}]:
+        try:
+            parse_ballot(bad)
+            assert False, bad
+        except InvalidBallot:
+            pass
+    return True
+
+
+def test_enqueue_dedupes():
+    queue, receipts = LocalQueue(), ReceiptStore('receipts', s3=FakeS3())
+    ballots = [mk_ballot(i) for i in range(120)]
+    rs = enqueue_ballots(queue, receipts, ballots + ballots[:3])
+    assert len(rs) == 123 and rs[0]['Receipt'] == rs[120]['Receipt']
+    assert len(queue) == 3  # 120 ballots, 50 to a message
+    # posting a ballot again returns its existing receipt and doesn't queue it
+    assert enqueue_ballots(queue, receipts, ballots[:1])[0] == rs[0] and len(queue) == 3
+    return True
+
+
+def test_flush_packs_blocks():
+    queue, s3 = LocalQueue(), FakeS3()
+    receipts = ReceiptStore('receipts', s3=s3)
+    node = FakeNode(gas_limit=10 * PROXY_VOTE_GAS)
+    acct = Account.create()
+    enqueue_ballots(queue, receipts, [mk_ballot(i) for i in range(25)])
+    pending = PendingBallots()
+
+    stats = flush_block(queue, pending, receipts, node, acct, BBFARM, 1, block_fill=1.0)
+    assert stats['Sent'] == 10 and stats['Gas'] == 10 * PROXY_VOTE_GAS and len(node.sent) == 10
+    # nothing mined yet, so the in-flight window holds the next block back
+    stats = flush_block(queue, pending, receipts, node, acct, BBFARM, 1, block_fill=1.0, max_in_flight=15)
+    assert stats['Sent'] == 5 and stats['InFlight'] == 10
+    node.mine()
+    stats = flush_block(queue, pending, receipts, node, acct, BBFARM, 1, block_fill=1.0, max_in_flight=15)
+    assert stats['Sent'] == 10 and stats['Backlog'] == 0
+    # every message is deleted once all of its ballots are sent
+    assert len(queue) == 0 and len(queue._in_flight) == 0
+    sent = [receipts.get(k[len('receipts/'):-len('.json')]) for k in s3.objects]
+    assert all(r['State'] == 'sent' for r in sent)
+    assert sorted(r['Nonce'] for r in sent) == list(range(25))
+    return True
+
+
+def test_leftovers_requeued():
+    queue, receipts = LocalQueue(), ReceiptStore('receipts', s3=FakeS3())
+    node = FakeNode(gas_limit=10 * PROXY_VOTE_GAS)
+    enqueue_ballots(queue, receipts, [mk_ballot(i) for i in range(30)])
+    deadline = iter([100, 100, 0])
+    totals = run_relay(queue, receipts, node, Account.create(), BBFARM, 1, remaining_time=lambda: next(deadline),
+                       block_fill=1.0)
+    # one block's worth sent; the rest is queued again in new messages rather than released with the sent ones
+    assert totals['Sent'] == 10 and totals['Requeued'] == 20
+    assert len(queue) == 1 and len(queue._in_flight) == 0
+    assert len(queue.receive(10)[0].body['Ballots']) == 20
+    return True
+
+
+class RejectOdd:
+    def __init__(self):
+        self.sent = []
+
+    def check(self, ballots):
+        return [('0xvoter', None if int(b.proxy_req[0], 16) % 2 else 'odd') for b in ballots]
+
+    def record_sent(self, receipts):
+        self.sent += receipts
+
+
+def test_rejected_not_sent():
+    queue, receipts = LocalQueue(), ReceiptStore('receipts', s3=FakeS3())
+    node = FakeNode(gas_limit=100 * PROXY_VOTE_GAS)
+    ballots = [mk_ballot(i) for i in range(10)]
+    rs = enqueue_ballots(queue, receipts, ballots)
+    verifier = RejectOdd()
+    stats = flush_block(queue, PendingBallots(), receipts, node, Account.create(), BBFARM, 1, verifier=verifier)
+    assert (stats['Sent'], stats['Rejected']) == (5, 5) and len(queue._in_flight) == 0
+    # the verifier hears which ballots went out
+    assert verifier.sent == [r['Receipt'] for r in rs[0::2]]
+    assert receipts.get(rs[1]['Receipt'])['State'] == 'rejected'
+    # a rejected ballot can be posted again
+    enqueue_ballots(queue, receipts, ballots[1:2])
+    assert len(queue) == 1
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_parse_ballot, test_enqueue_dedupes, test_flush_packs_blocks, test_leftovers_requeued,
+             test_rejected_not_sent]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -0,0 +1,145 @@
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+cr_common_dir = os.path.join(main_dir, '../../cr/common')
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'api'))
+sys.path.insert(0, os.path.join(main_dir, '../common'))
+sys.path.insert(0, os.path.join(cr_common_dir, 'deps'))
+sys.path.insert(0, cr_common_dir)
+
+import logging
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+from api.tally import Tally, BallotNotFound, VOTE_TOPIC, SET_MEMBER_TOPIC, END_TIME_WORD
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestTally')
+
+BBFARM = '0x' + 'bb' * 20
+MEMBERSHIP = '0x' + 'cc' * 20
+BALLOT_ID = (0xabcd0123 << 224) | 7
+END_TIME = 1000
+BLOCK_TIME = 5
+
+
+def _w(n):
+    return '{:064x}'.format(n)
+
+
+class FakeChain:
+    '''Blocks every 5 seconds from t=0; logs are added to the current head block.'''
+
+    def __init__(self):
+        self.head = 0
+        self.logs = []
+
+    def mine(self, n=1):
+        self.head += n
+
+    def set_member(self, addr: int, weight, start, end):
+        self.logs.append({'address': MEMBERSHIP, 'blockNumber': self.head, 'logIndex': len(self.logs),
+                          'topics': [SET_MEMBER_TOPIC], 'data': '0x' + _w(addr) + _w(weight) + _w(start) + _w(end)})
+
+    def vote(self, voter: int, vote: int, ballot_id=BALLOT_ID):
+        self.logs.append({'address': BBFARM, 'blockNumber': self.head, 'logIndex': len(self.logs),
+                          'topics': [VOTE_TOPIC, '0x' + _w(ballot_id)],
+                          'data': '0x' + _w(vote) + _w(voter) + _w(0x60) + _w(0)})
+
+    def block_number(self):
+        return self.head
+
+    def get_block(self, n):
+        return {'number': n, 'timestamp': n * BLOCK_TIME}
+
+    def call(self, tx, block='latest'):
+        return '0x' + ''.join(_w(END_TIME if i == END_TIME_WORD else 0) for i in range(10))
+
+    def get_logs(self, address, topics, from_block, to_block):
+        return [l for l in self.logs if l['address'] == address and from_block <= l['blockNumber'] <= to_block and
+                all(t is None or t == lt for (t, lt) in zip(topics, l['topics']))]
+
+
+def by_vote(results):
+    return {int(r['Vote'], 16): (r['Weight'], r['NVoters']) for r in results['Results']}
+
+
+def test_weighted_last_vote_wins():
+    chain = FakeChain()
+    for a in range(1, 6):
+        chain.set_member(a, a, 0, 2000)
+    chain.set_member(6, 100, 0, 500)  # expires before the ballot closes
+    chain.mine()
+    chain.vote(1, 1)
+    chain.vote(2, 1)
+    chain.vote(3, 2)
+    chain.vote(6, 2)
+    chain.vote(9, 2)  # never a member
+    chain.vote(1, 0xff, ballot_id=BALLOT_ID + 1)  # another ballot
+    chain.mine()
+    chain.vote(2, 2)  # changes their vote
+    chain.mine(10)
+
+    tally = Tally(BBFARM, MEMBERSHIP, BALLOT_ID)
+    tally.catch_up(chain)
+    res = tally.results()
+    assert by_vote(res) == {1: (1, 1), 2: (5, 2)}
+    assert (res['NVoters'], res['NIneligible'], res['Closed']) == (5, 2, False)
+
+    # voter 4 joins the vote and voter 1's weight changes before the close; afterwards nothing counts
+    chain.vote(4, 1)
+    chain.set_member(1, 10, 0, 2000)
+    chain.mine(END_TIME // BLOCK_TIME)
+    chain.vote(5, 1)
+    chain.set_member(3, 50, 0, 2000)
+    chain.mine(5)
+    tally.catch_up(chain)
+    res = tally.results()
+    assert res['Closed'] and tally.meta['CloseBlock'] == END_TIME // BLOCK_TIME + 1
+    assert by_vote(res) == {1: (14, 2), 2: (5, 2)}
+    return True
+
+
+def test_checkpoint_resume():
+    chain = FakeChain()
+    for a in range(1, 101):
+        chain.set_member(a, 1, 0, 2000)
+    for step in range(10):
+        chain.mine()
+        for a in range(1 + step * 10, 11 + step * 10):
+            chain.vote(a, a % 3)
+    chain.mine(3)
+
+    full = Tally(BBFARM, MEMBERSHIP, BALLOT_ID)
+    full.catch_up(chain)
+
+    part = Tally(BBFARM, MEMBERSHIP, BALLOT_ID)
+    part.catch_up(chain, head=6)
+    resumed = Tally.loads(BBFARM, MEMBERSHIP, BALLOT_ID, part.dumps())
+    assert resumed.last_block == 4
+    stats = resumed.catch_up(chain)
+    assert stats['FromBlock'] == 5 and stats['NVotes'] == 60
+    assert resumed.results()['Results'] == full.results()['Results']
+    assert sum(r['NVoters'] for r in full.results()['Results']) == 100
+    return True
+
+
+def test_unknown_ballot():
+    chain = FakeChain()
+    # no contract at the address, then a bbfarm that doesn't have the ballot
+    for ret in ['0x', '0x' + _w(0) * 10]:
+        chain.call = lambda tx, block='latest', ret=ret: ret
+        try:
+            Tally(BBFARM, MEMBERSHIP, BALLOT_ID).end_time(chain)
+            assert False
+        except BallotNotFound:
+            pass
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_weighted_last_vote_wins, test_checkpoint_resume, test_unknown_ballot]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -0,0 +1,160 @@
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+cr_common_dir = os.path.join(main_dir, '../../cr/common')
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'api'))
+sys.path.insert(0, os.path.join(main_dir, '../common'))
+sys.path.insert(0, os.path.join(cr_common_dir, 'deps'))
+sys.path.insert(0, cr_common_dir)
+
+import io
+import logging
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+from eth_account import Account
+from common.membersnap import MemberSnapshot, SnapshotMissing
+from api.ballots import parse_ballot, ballot_hash
+from api.verify import Verifier, SentSequences, recover_voters, sign_ballot, chain_weights, REJECT_BAD_SIG, \
+    REJECT_NOT_MEMBER, REJECT_DUPLICATE, REJECT_STALE_SEQUENCE
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestVerify')
+
+NOW = 1000
+BALLOT_ID = '0x' + '0b' * 32
+MEMBERSHIP = '0x' + 'aa' * 20
+BBFARM = '0x' + 'bb' * 20
+
+
+def mk_ballot(key: bytes, seq: int, vote=1, ballot_id=BALLOT_ID, extra='0x'):
+    # through parse_ballot, as the API would take it
+    b = sign_ballot(key, ballot_id, '0x{:064x}'.format(vote), seq, extra)
+    return parse_ballot({'proxyReq': b.proxy_req, 'extra': b.extra})
+
+
+def mk_voters(n):
+    keys = [(i + 1).to_bytes(32, 'big') for i in range(n)]
+    return keys, [Account.privateKeyToAccount(k).address for k in keys]
+
+
+def test_recover_across_processes():
+    keys, addrs = mk_voters(200)
+    ballots = [mk_ballot(k, 1) for k in keys]
+    assert recover_voters(ballots, workers=3) == addrs
+    assert recover_voters(ballots, workers=1) == addrs
+    return True
+
+
+def test_verifier_filters():
+    keys, addrs = mk_voters(4)
+    # voter 2 has expired and voter 3 was never added
+    snap = MemberSnapshot.build([(addrs[0], 1, 0, 2000), (addrs[1], 5, 0, 2000), (addrs[2], 1, 0, 500)])
+    verifier = Verifier(lambda: snap, clock=lambda: NOW)
+    forged = mk_ballot(keys[0], 7)
+    forged = forged._replace(proxy_req=forged.proxy_req[:4] + ['0x{:064x}'.format(2)])
+    ballots = [mk_ballot(keys[0], 1), mk_ballot(keys[0], 3, vote=2), mk_ballot(keys[0], 2), mk_ballot(keys[1], 1),
+               mk_ballot(keys[2], 1), mk_ballot(keys[3], 1), forged]
+    checked = verifier.check(ballots)
+    reasons = [r for (_, r) in checked]
+    assert reasons[:6] == [REJECT_DUPLICATE, None, REJECT_DUPLICATE, None, REJECT_NOT_MEMBER, REJECT_NOT_MEMBER]
+    # a changed vote still has a well formed signature, but it recovers some other address, which isn't a member
+    assert reasons[6] == REJECT_NOT_MEMBER and checked[6][0] not in addrs
+
+    # later batches can't go back to a sequence number already accepted
+    # and bbfarm sequence numbers start above 0
+    zero_seq = mk_ballot(keys[1], 0, ballot_id='0x' + '0c' * 32)
+    reasons = [r for (_, r) in verifier.check([mk_ballot(keys[0], 3), mk_ballot(keys[0], 4), zero_seq])]
+    assert reasons == [REJECT_STALE_SEQUENCE, None, REJECT_STALE_SEQUENCE]
+    assert verifier.stats == {'Verified': 3, 'Rejected': 7, 'CheckedOnChain': 0}
+    return True
+
+
+class FakeS3:
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+
+def test_sent_across_runs():
+    keys, addrs = mk_voters(2)
+    snap = MemberSnapshot.build([(a, 1, 0, 2000) for a in addrs])
+    store = SentSequences('receipts', BBFARM, s3=FakeS3())
+    first = Verifier(lambda: snap, clock=lambda: NOW, sent_store=store)
+    ballots = [mk_ballot(keys[0], 2), mk_ballot(keys[1], 5)]
+    assert [r for (_, r) in first.check(ballots)] == [None, None]
+    # only voter 0's ballot is sent before the run ends; voter 1's is queued again
+    first.record_sent([ballot_hash(ballots[0])])
+    assert list(store.s3.objects) == [f"sent/{BBFARM}/{BALLOT_ID[2:]}.json"]
+
+    # a later run drops replays and older ballots from voter 0, even ones that hash differently
+    later = Verifier(lambda: snap, clock=lambda: NOW, sent_store=store)
+    retry = [mk_ballot(keys[0], 2, extra='0x01'), mk_ballot(keys[0], 1), ballots[1], mk_ballot(keys[0], 3, vote=2)]
+    assert [r for (_, r) in later.check(retry)] == [REJECT_STALE_SEQUENCE, REJECT_STALE_SEQUENCE, None, None]
+    # ...but not on other ballots
+    assert later.check([mk_ballot(keys[0], 1, ballot_id='0x' + '0c' * 32)]) == [(addrs[0], None)]
+    # sending nothing new doesn't rewrite the file; an unknown receipt is ignored
+    saved = dict(store.s3.objects)
+    later.record_sent(['0x' + '00' * 32])
+    assert store.s3.objects == saved
+    later.record_sent([ballot_hash(b) for b in retry])
+    assert store.load(BALLOT_ID) == {addrs[0]: 3, addrs[1]: 5}
+    return True
+
+
+class FakeMembership:
+    '''Answers batches of Membership.balanceOf calls.'''
+
+    def __init__(self, weights):
+        self.weights = {a.lower(): w for (a, w) in weights.items()}
+        self.n_calls = 0
+
+    def batch(self, calls):
+        self.n_calls += len(calls)
+        assert all(m == 'eth_call' and p[0]['to'] == MEMBERSHIP for (m, p) in calls)
+        return ['0x{:064x}'.format(self.weights.get('0x' + p[0]['data'][-40:], 0)) for (_, p) in calls]
+
+
+def test_snapshot_missing():
+    keys, addrs = mk_voters(3)
+    chain = FakeMembership({addrs[0]: 1, addrs[1]: 2})
+
+    def load_snapshot():
+        raise SnapshotMissing("no member snapshot at s3://members/snap.npz yet")
+
+    # before the first snapshot is published members are checked on chain rather than the relay failing
+    verifier = Verifier(load_snapshot, clock=lambda: NOW,
+                        fallback_weights=lambda voters: chain_weights(chain, MEMBERSHIP, voters, batch_size=2))
+    reasons = [r for (_, r) in verifier.check([mk_ballot(k, 1) for k in keys])]
+    assert reasons == [None, None, REJECT_NOT_MEMBER]
+    assert chain.n_calls == 3 and verifier.stats['CheckedOnChain'] == 3
+    # ballots with bad signatures never get that far
+    bad = mk_ballot(keys[0], 2)
+    bad = bad._replace(proxy_req=bad.proxy_req[:2] + ['0x1f' + bad.proxy_req[2][4:]] + bad.proxy_req[3:])
+    assert verifier.check([bad]) == [(None, REJECT_BAD_SIG)] and chain.n_calls == 3
+
+    try:
+        Verifier(load_snapshot).check([mk_ballot(keys[0], 1)])
+        assert False
+    except SnapshotMissing:
+        pass
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_recover_across_processes, test_verifier_filters, test_sent_across_runs, test_snapshot_missing]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -0,0 +1,91 @@
+'''A bounded LRU cache whose entries also expire after a TTL. Meant to live at module level in a lambda so it survives
+between invocations of a warm container.'''
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+_MISSING = object()
+
+
+class TtlLruCache:
+    def __init__(self, maxsize=10000, ttl=60, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._d = OrderedDict()  # type: OrderedDict[Hashable, Tuple[float, Any]]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            return self._get(key, default)
+
+    def _get(self, key, default):
+        entry = self._d.get(key, _MISSING)
+        if entry is _MISSING:
+            self.misses += 1
+            return default
+        (expires, value) = entry
+        if self.clock() >= expires:
+            del self._d[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._d.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def get_many(self, keys: Iterable[Hashable]) -> Tuple[Dict[Hashable, Any], List[Hashable]]:
+        '''(cached values by key, keys that missed)'''
+        found, missing = {}, []
+        with self._lock:
+            for k in keys:
+                v = self._get(k, _MISSING)
+                if v is _MISSING:
+                    missing.append(k)
+                else:
+                    found[k] = v
+        return found, missing
+
+    def put(self, key: Hashable, value, ttl: Optional[float] = None):
+        with self._lock:
+            self._d[key] = (self.clock() + (self.ttl if ttl is None else ttl), value)
+            self._d.move_to_end(key)
+            while len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> bool:
+        with self._lock:
+            if self._d.pop(key, _MISSING) is _MISSING:
+                return False
+            self.invalidations += 1
+            return True
+
+    def invalidate_where(self, pred: Callable[[Hashable], bool]) -> int:
+        with self._lock:
+            keys = [k for k in self._d if pred(k)]
+            for k in keys:
+                del self._d[k]
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._d)
+            self._d.clear()
+
+    def __len__(self):
+        return len(self._d)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {'Size': len(self._d), 'Hits': self.hits, 'Misses': self.misses,
+                'HitRate': self.hits / lookups if lookups else 0.0, 'Evictions': self.evictions,
+                'Expirations': self.expirations, 'Invalidations': self.invalidations}
@@ -0,0 +1,182 @@
+'''A columnar snapshot of the membership set for answering "who is active, with what weight, at time T" in bulk.
+
+Columns (address, weight, start, end) are stored sorted by address, next to an interval index: the start times and the
+end times of every valid interval (start <= end) each sorted, with running weight totals. Because a valid interval
+that ended before T also started before T,
+
+    active weight at T = weight(start <= T) - weight(end < T)
+
+which is two `searchsorted`s per query, vectorised over any number of Ts.
+
+The file is a small JSON header followed by 64-byte aligned raw arrays, so `load` just memory maps it.'''
+
+import json
+import mmap
+import os
+from typing import Dict, Iterable, Tuple, Union
+
+import numpy as np
+
+MAGIC = b'SVMEMBERS1\n'
+ALIGN = 64
+
+ADDR_DTYPE = np.dtype('S20')
+COLUMNS = [('addr', ADDR_DTYPE), ('weight', np.dtype('<u4')), ('start', np.dtype('<u8')), ('end', np.dtype('<u8')),
+           ('idx_start', np.dtype('<u8')), ('idx_start_cumw', np.dtype('<u8')),
+           ('idx_end', np.dtype('<u8')), ('idx_end_cumw', np.dtype('<u8'))]
+
+Times = Union[int, np.ndarray]
+
+# head_object gives a bare 404, or 403 when the caller can't list the bucket
+MISSING_CODES = {'404', 'NoSuchKey', 'NotFound', '403', 'AccessDenied'}
+
+
+class SnapshotMissing(Exception):
+    '''Nothing has been published at the snapshot's key yet.'''
+
+
+def _to_addr_bytes(addrs) -> np.ndarray:
+    return np.array([a if type(a) is bytes else bytes.fromhex(a[2:] if a[:2] in ('0x', '0X') else a)
+                     for a in addrs], dtype=ADDR_DTYPE)
+
+
+def _cumw(times: np.ndarray, weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(times, kind='stable')
+    cumw = np.zeros(len(times) + 1, dtype=np.uint64)
+    np.cumsum(weights[order], out=cumw[1:])
+    return times[order], cumw
+
+
+class MemberSnapshot:
+    def __init__(self, cols: Dict[str, np.ndarray], meta: Dict):
+        self.cols = cols
+        self.meta = meta
+        self._mmap = None
+
+    @classmethod
+    def build(cls, members: Iterable[Tuple], **meta) -> 'MemberSnapshot':
+        '''`members` is (voting address, weight, start, end) tuples; addresses as hex strings or 20 raw bytes.'''
+        rows = list(members)
+        addr = _to_addr_bytes([r[0] for r in rows])
+        order = np.argsort(addr, kind='stable')
+        weight = np.array([r[1] for r in rows], dtype=np.uint32)[order]
+        start = np.array([r[2] for r in rows], dtype=np.uint64)[order]
+        end = np.array([r[3] for r in rows], dtype=np.uint64)[order]
+        # intervals with end < start can never be active, so they're left out of the index
+        valid = start <= end
+        w = weight[valid].astype(np.uint64)
+        idx_start, idx_start_cumw = _cumw(start[valid], w)
+        idx_end, idx_end_cumw = _cumw(end[valid], w)
+        cols = {'addr': addr[order], 'weight': weight, 'start': start, 'end': end,
+                'idx_start': idx_start, 'idx_start_cumw': idx_start_cumw,
+                'idx_end': idx_end, 'idx_end_cumw': idx_end_cumw}
+        return cls(cols, dict(meta, NMembers=len(rows)))
+
+    def __len__(self):
+        return len(self.cols['addr'])
+
+    # interval queries
+
+    def _n_and_w(self, idx: str, ts: Times, side: str) -> Tuple[np.ndarray, np.ndarray]:
+        i = np.searchsorted(self.cols[idx], np.asarray(ts, dtype=np.uint64), side=side)
+        return i, self.cols[idx + '_cumw'][i]
+
+    def active_count(self, ts: Times) -> np.ndarray:
+        (n_started, _) = self._n_and_w('idx_start', ts, 'right')
+        (n_ended, _) = self._n_and_w('idx_end', ts, 'left')
+        return n_started - n_ended
+
+    def total_active_weight(self, ts: Times) -> np.ndarray:
+        (_, w_started) = self._n_and_w('idx_start', ts, 'right')
+        (_, w_ended) = self._n_and_w('idx_end', ts, 'left')
+        return w_started - w_ended
+
+    def active_count_between(self, t0: Times, t1: Times) -> np.ndarray:
+        '''Members active at any point in [t0, t1] (their interval overlaps it).'''
+        (n_started, _) = self._n_and_w('idx_start', t1, 'right')
+        (n_ended, _) = self._n_and_w('idx_end', t0, 'left')
+        return n_started - n_ended
+
+    # per address queries
+
+    def find(self, addrs) -> np.ndarray:
+        '''Row of each address, or -1 where it isn't a member.'''
+        needles = _to_addr_bytes(addrs)
+        i = np.searchsorted(self.cols['addr'], needles)
+        found = i < len(self)
+        found[found] = self.cols['addr'][i[found]] == needles[found]
+        return np.where(found, i, -1)
+
+    def eligible(self, addrs, ts: Times) -> np.ndarray:
+        '''Bool mask: is each address an active member at its time (a single T or one per address)?'''
+        i = self.find(addrs)
+        known = i >= 0
+        if len(self) == 0:
+            return known
+        j = np.where(known, i, 0)
+        ts = np.asarray(ts, dtype=np.uint64)
+        return known & (self.cols['start'][j] <= ts) & (self.cols['end'][j] >= ts)
+
+    def weights(self, addrs, ts: Times) -> np.ndarray:
+        '''Each address's voting weight at its time; 0 for non-members and inactive members.'''
+        i = self.find(addrs)
+        mask = self.eligible(addrs, ts)
+        if len(self) == 0:
+            return np.zeros(len(i), dtype=np.uint64)
+        return np.where(mask, self.cols['weight'][np.maximum(i, 0)], 0).astype(np.uint64)
+
+    # file format
+
+    def save(self, path: str):
+        header = {'meta': self.meta, 'columns': []}
+        offset = 0
+        for (name, dtype) in COLUMNS:
+            offset = -(-offset // ALIGN) * ALIGN
+            arr = np.ascontiguousarray(self.cols[name], dtype=dtype)
+            header['columns'].append({'name': name, 'dtype': dtype.str, 'offset': offset, 'len': len(arr)})
+            offset += arr.nbytes
+        header_bytes = json.dumps(header).encode()
+        data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGN) * ALIGN
+        with open(path, 'wb') as f:
+            f.write(MAGIC + len(header_bytes).to_bytes(8, 'little') + header_bytes)
+            for (c, (name, dtype)) in zip(header['columns'], COLUMNS):
+                f.seek(data_start + c['offset'])
+                f.write(np.ascontiguousarray(self.cols[name], dtype=dtype).tobytes())
+
+    @classmethod
+    def load(cls, path: str) -> 'MemberSnapshot':
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a member snapshot")
+        header_len = int.from_bytes(mm[len(MAGIC):len(MAGIC) + 8], 'little')
+        header = json.loads(mm[len(MAGIC) + 8:len(MAGIC) + 8 + header_len].decode())
+        data_start = -(-(len(MAGIC) + 8 + header_len) // ALIGN) * ALIGN
+        cols = {c['name']: np.frombuffer(mm, dtype=np.dtype(c['dtype']), count=c['len'], offset=data_start + c['offset'])
+                if c['len'] > 0 else np.zeros(0, dtype=np.dtype(c['dtype'])) for c in header['columns']}
+        snap = cls(cols, header['meta'])
+        snap._mmap = mm
+        return snap
+
+
+def snapshot_key(contract: str) -> str:
+    '''Where the members indexer publishes the snapshot for a Membership contract, in the members jobs bucket.'''
+    return f"members-snapshot/{contract.lower()}.snap"
+
+
+def fetch_snapshot(s3, bucket: str, key: str, local_dir='/tmp') -> MemberSnapshot:
+    '''Load the snapshot at s3://bucket/key, downloading it only when the local copy's ETag is out of date. Raises
+    SnapshotMissing before the first one is published.'''
+    path = os.path.join(local_dir, key.replace('/', '_'))
+    try:
+        etag = s3.head_object(Bucket=bucket, Key=key)['ETag']
+    except Exception as e:
+        if str(getattr(e, 'response', {}).get('Error', {}).get('Code')) in MISSING_CODES:
+            raise SnapshotMissing(f"no member snapshot at s3://{bucket}/{key}") from e
+        raise
+    if not os.path.exists(path) or not os.path.exists(path + '.etag') or open(path + '.etag').read() != etag:
+        s3.download_file(bucket, key, path + '.tmp')
+        os.rename(path + '.tmp', path)
+        with open(path + '.etag', 'w') as f:
+            f.write(etag)
+    return MemberSnapshot.load(path)
@@ -0,0 +1,104 @@
+'''A small message queue interface with an SQS implementation and an in-process stand-in for tests.
+
+Messages are JSON-able dicts. `receive` hides messages until they're `delete`d (done) or `release`d (put back for
+another receiver), mirroring SQS's visibility timeout.'''
+
+import itertools
+import json
+import threading
+from collections import OrderedDict
+from typing import List, Dict, NamedTuple
+
+Message = NamedTuple('Message', [('body', Dict), ('handle', str)])
+
+SQS_MAX_BATCH = 10
+
+
+class LocalQueue:
+    def __init__(self):
+        self._ready = OrderedDict()  # id -> body
+        self._in_flight = {}  # handle -> (id, body)
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def send(self, body: Dict):
+        self.send_many([body])
+
+    def send_many(self, bodies: List[Dict]):
+        with self._lock:
+            for body in bodies:
+                # round trip through json so tests see exactly what SQS would hand back
+                self._ready[next(self._ids)] = json.loads(json.dumps(body))
+
+    def receive(self, max_n=SQS_MAX_BATCH) -> List[Message]:
+        with self._lock:
+            msgs = []
+            while self._ready and len(msgs) < max_n:
+                (i, body) = self._ready.popitem(last=False)
+                handle = f"{i}-{next(self._ids)}"
+                self._in_flight[handle] = (i, body)
+                msgs.append(Message(body, handle))
+            return msgs
+
+    def delete(self, handles: List[str]):
+        with self._lock:
+            for h in handles:
+                self._in_flight.pop(h, None)
+
+    def release(self, handles: List[str]):
+        with self._lock:
+            for h in handles:
+                if h in self._in_flight:
+                    (i, body) = self._in_flight.pop(h)
+                    self._ready[i] = body
+                    self._ready.move_to_end(i, last=False)
+
+    def __len__(self):
+        return len(self._ready)
+
+
+class SqsQueue:
+    def __init__(self, url: str, sqs=None):
+        import boto3
+        self.url = url
+        self.sqs = boto3.client('sqs') if sqs is None else sqs
+
+    def send(self, body: Dict):
+        self.sqs.send_message(QueueUrl=self.url, MessageBody=json.dumps(body))
+
+    def send_many(self, bodies: List[Dict]):
+        for i in range(0, len(bodies), SQS_MAX_BATCH):
+            entries = [{'Id': str(j), 'MessageBody': json.dumps(b)}
+                       for (j, b) in enumerate(bodies[i:i + SQS_MAX_BATCH])]
+            resp = self.sqs.send_message_batch(QueueUrl=self.url, Entries=entries)
+            if resp.get('Failed'):
+                raise Exception(f"Failed to queue {len(resp['Failed'])} messages: {resp['Failed'][0]}")
+
+    def receive(self, max_n=SQS_MAX_BATCH, wait_seconds=1) -> List[Message]:
+        '''Receive up to `max_n` messages, 10 per call, stopping early once the queue is empty. `wait_seconds` must be
+        at least 1: a short poll (0) only samples some of SQS's servers, so it can come back empty while messages are
+        waiting, whereas a long poll asks all of them.'''
+        msgs = []
+        while len(msgs) < max_n:
+            resp = self.sqs.receive_message(QueueUrl=self.url, WaitTimeSeconds=wait_seconds,
+                                            MaxNumberOfMessages=min(SQS_MAX_BATCH, max_n - len(msgs)))
+            got = resp.get('Messages', [])
+            msgs += [Message(json.loads(m['Body']), m['ReceiptHandle']) for m in got]
+            if len(got) == 0:
+                break
+        return msgs
+
+    def _batched(self, fn, handles: List[str], **extra):
+        for i in range(0, len(handles), SQS_MAX_BATCH):
+            fn(QueueUrl=self.url, Entries=[dict(Id=str(j), ReceiptHandle=h, **extra)
+                                           for (j, h) in enumerate(handles[i:i + SQS_MAX_BATCH])])
+
+    def delete(self, handles: List[str]):
+        self._batched(self.sqs.delete_message_batch, handles)
+
+    def release(self, handles: List[str]):
+        self._batched(self.sqs.change_message_visibility_batch, handles, VisibilityTimeout=0)
+
+    def __len__(self):
+        attrs = self.sqs.get_queue_attributes(QueueUrl=self.url, AttributeNames=['ApproximateNumberOfMessages'])
+        return int(attrs['Attributes']['ApproximateNumberOfMessages'])
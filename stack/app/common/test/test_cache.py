@@ -0,0 +1,34 @@
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+
+import logging
+
+from common.cache import TtlLruCache
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestCache')
+
+
+def test_ttl_lru():
+    now = [0.0]
+    c = TtlLruCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    c.put('a', 1)
+    c.put('b', 2)
+    assert c.get('a') == 1
+    c.put('c', 3)  # evicts b, the least recently used
+    assert c.get('b') is None and c.get('c') == 3
+    now[0] = 11
+    assert c.get('a') is None
+    s = c.stats()
+    assert (s['Hits'], s['Misses'], s['Evictions'], s['Expirations']) == (2, 2, 1, 1)
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_ttl_lru]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -0,0 +1,96 @@
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+
+import logging
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from common.membersnap import MemberSnapshot, fetch_snapshot, SnapshotMissing
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestMemberSnap')
+
+
+def mk_members(n, seed=1):
+    rnd = random.Random(seed)
+    members = []
+    for i in range(n):
+        start = rnd.randrange(0, 1000)
+        end = start + rnd.randrange(-50, 500)  # some intervals are empty (end < start)
+        members.append(('0x{:040x}'.format(rnd.getrandbits(160)), rnd.randrange(1, 100), start, max(0, end)))
+    return members
+
+
+def brute_weight(members, t):
+    return sum(w for (_, w, s, e) in members if s <= t <= e)
+
+
+def test_interval_queries():
+    members = mk_members(2000)
+    snap = MemberSnapshot.build(members, Block=1)
+    ts = np.arange(0, 1600, 7)
+    assert list(snap.total_active_weight(ts)) == [brute_weight(members, t) for t in ts]
+    assert list(snap.active_count(ts)) == [sum(1 for (_, _, s, e) in members if s <= t <= e) for t in ts]
+    assert snap.active_count_between(100, 200) == sum(1 for (_, _, s, e) in members if s <= 200 and e >= 100 and s <= e)
+    return True
+
+
+def test_eligibility_and_roundtrip():
+    members = mk_members(5000)
+    snap = MemberSnapshot.build(members, Block=42)
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'members.snap')
+        snap.save(path)
+        t = time.time()
+        loaded = MemberSnapshot.load(path)
+        log.info(f"loaded {len(loaded)} members in {(time.time() - t) * 1000:.2f}ms")
+        assert loaded.meta == {'Block': 42, 'NMembers': 5000}
+        addrs = [m[0] for m in members[:100]] + ['0x' + 'ff' * 20]
+        mask = loaded.eligible(addrs, 300)
+        assert list(mask) == [s <= 300 <= e for (_, _, s, e) in members[:100]] + [False]
+        assert list(loaded.weights(addrs, 300)) == [w if s <= 300 <= e else 0 for (_, w, s, e) in members[:100]] + [0]
+        assert list(loaded.total_active_weight([10, 500])) == list(snap.total_active_weight([10, 500]))
+        del loaded
+    return True
+
+
+def test_fetch_missing_snapshot():
+    class S3Error(Exception):
+        def __init__(self, code):
+            super().__init__(code)
+            self.response = {'Error': {'Code': code}}
+
+    class FakeS3:
+        def __init__(self, code):
+            self.code = code
+
+        def head_object(self, Bucket, Key):
+            raise S3Error(self.code)
+
+    with tempfile.TemporaryDirectory() as d:
+        for code in ['404', '403']:
+            try:
+                fetch_snapshot(FakeS3(code), 'bucket', 'members-snapshot/x.snap', local_dir=d)
+                assert False
+            except SnapshotMissing:
+                pass
+        # anything else is still an error
+        try:
+            fetch_snapshot(FakeS3('SlowDown'), 'bucket', 'members-snapshot/x.snap', local_dir=d)
+            assert False
+        except S3Error:
+            pass
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_interval_queries, test_eligibility_and_roundtrip, test_fetch_missing_snapshot]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -1,5 +1,7 @@
 import bootstrap
 # from common import *
 
-from .onboard import onboard_handler, list_members_handler
+from .onboard import onboard_handler, onboard_worker_handler, job_status_handler, list_members_handler, \
+    lookup_members_handler, members_indexer_handler, members_stats_handler, \
+    member_pages_handler
 
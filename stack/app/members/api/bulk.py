@@ -0,0 +1,243 @@
+'''Bulk member onboarding.
+
+An upload of (votingAddr, weight, startTime, endTime) rows, as CSV or NDJSON, is validated line by line against
+Membership.setMember's argument types. API Gateway hands us the whole upload (up to its 10MB limit) in the event, so
+lines are sliced out of that string as they're parsed rather than copied again. The rows are stored as a job in S3 and
+a worker lambda signs one setMember tx per row with the members service key and broadcasts them through a pipelined
+nonce stream. Job status (counts, how many are mined) can be polled, and the txids of each chunk of rows are stored
+alongside it.'''
+
+import csv
+import json
+import logging
+import time
+import uuid
+from typing import List, Dict, Iterable, Iterator, NamedTuple, Callable, Tuple, Optional, Union
+
+import boto3
+from eth_abi import encode_abi
+from eth_account import Account
+from eth_account.signers.local import LocalAccount
+from eth_utils import keccak, is_address, to_checksum_address
+
+from lib import get_ssm_param_with_enc, get_ssm_param_no_enc, gen_ssm_nodekey_service, gen_ssm_networkid, SVC_MEMBERS
+from txpipe import NonceStream, sign_txs, broadcast
+
+log = logging.getLogger("members-bulk")
+log.setLevel(logging.INFO)
+
+SET_MEMBER_SIG = 'setMember(address,uint32,uint48,uint48)'
+SET_MEMBER_SELECTOR = keccak(text=SET_MEMBER_SIG)[:4]
+SET_MEMBER_TYPES = ['address', 'uint32', 'uint48', 'uint48']
+SET_MEMBER_GAS = 150000
+
+FIELDS = ['votingAddr', 'weight', 'startTime', 'endTime']
+MAX_ERRORS = 100  # stop collecting row errors after this many
+
+MemberRow = NamedTuple('MemberRow', [('voting_addr', str), ('weight', int), ('start_time', int), ('end_time', int)])
+
+
+class RowError(Exception):
+    def __init__(self, line_no: int, msg: str):
+        super().__init__(f"line {line_no}: {msg}")
+        self.line_no = line_no
+
+
+class InvalidUpload(Exception):
+    def __init__(self, errors: List[str]):
+        super().__init__(f"{len(errors)} invalid rows; first: {errors[0]}")
+        self.errors = errors
+
+
+def _to_uint(line_no: int, name: str, v, bits: int) -> int:
+    if type(v) is bool or type(v) is float:
+        raise RowError(line_no, f"{name} must be an integer, got {v!r}")
+    try:
+        n = int(v.strip()) if type(v) is str else int(v)
+    except (TypeError, ValueError):
+        raise RowError(line_no, f"{name} must be an integer, got {v!r}")
+    if not 0 <= n < 2 ** bits:
+        raise RowError(line_no, f"{name} must fit in a uint{bits}, got {n}")
+    return n
+
+
+def validate_row(line_no: int, voting_addr, weight, start_time, end_time) -> MemberRow:
+    if type(voting_addr) is not str or not is_address(voting_addr.strip()):
+        raise RowError(line_no, f"votingAddr is not an address: {voting_addr!r}")
+    return MemberRow(to_checksum_address(voting_addr.strip()),
+                     _to_uint(line_no, 'weight', weight, 32),
+                     _to_uint(line_no, 'startTime', start_time, 48),
+                     _to_uint(line_no, 'endTime', end_time, 48))
+
+
+def parse_csv_line(line_no: int, line: str) -> Optional[MemberRow]:
+    rec = next(csv.reader([line]), [])
+    if len(rec) == 0 or (len(rec) == 1 and rec[0].strip() == ''):
+        return None
+    if line_no == 1 and rec[0].strip().lower() == FIELDS[0].lower():
+        return None  # header
+    if len(rec) != len(FIELDS):
+        raise RowError(line_no, f"expected {len(FIELDS)} columns ({','.join(FIELDS)}), got {len(rec)}")
+    return validate_row(line_no, *rec)
+
+
+def parse_ndjson_line(line_no: int, line: str) -> Optional[MemberRow]:
+    if line.strip() == '':
+        return None
+    try:
+        obj = json.loads(line)
+    except ValueError as e:
+        raise RowError(line_no, f"invalid json: {e}")
+    if type(obj) is not dict or any(f not in obj for f in FIELDS):
+        raise RowError(line_no, f"expected an object with keys {FIELDS}")
+    return validate_row(line_no, *[obj[f] for f in FIELDS])
+
+
+def detect_format(content_type: str, body: str) -> str:
+    content_type = (content_type or '').lower()
+    if 'csv' in content_type:
+        return 'csv'
+    if 'ndjson' in content_type or 'jsonl' in content_type:
+        return 'ndjson'
+    return 'ndjson' if body.lstrip()[:1] == '{' else 'csv'
+
+
+def iter_lines(body: str) -> Iterator[str]:
+    '''The lines of `body`, without building a list of them (or a StringIO copy of it).'''
+    start = 0
+    while start < len(body):
+        end = body.find('\n', start)
+        if end == -1:
+            end = len(body)
+        yield body[start:end].rstrip('\r')
+        start = end + 1
+
+
+def iter_rows(lines: Iterable[str], fmt: str) -> Iterator[Union[MemberRow, RowError]]:
+    '''Parse one line at a time, yielding a MemberRow or a RowError for each non-blank line.'''
+    parse_line = parse_csv_line if fmt == 'csv' else parse_ndjson_line
+    for (line_no, line) in enumerate(lines, 1):
+        try:
+            row = parse_line(line_no, line)
+        except RowError as e:
+            row = e
+        if row is not None:
+            yield row
+
+
+def parse_rows(body: str, fmt: str) -> List[MemberRow]:
+    '''Validate every row of an upload; raises InvalidUpload listing (up to MAX_ERRORS) bad rows.'''
+    rows, errors = [], []
+    for row in iter_rows(iter_lines(body), fmt):
+        if isinstance(row, RowError):
+            errors.append(str(row))
+            if len(errors) >= MAX_ERRORS:
+                break
+        else:
+            rows.append(row)
+    if errors:
+        raise InvalidUpload(errors)
+    if len(rows) == 0:
+        raise InvalidUpload(["no members in upload"])
+    return rows
+
+
+def encode_set_member(row: MemberRow) -> bytes:
+    return SET_MEMBER_SELECTOR + encode_abi(SET_MEMBER_TYPES, list(row))
+
+
+def mk_set_member_tx(membership_addr: str, row: MemberRow, gas=SET_MEMBER_GAS) -> Dict:
+    return {'to': membership_addr, 'data': encode_set_member(row), 'value': 0, 'gas': gas, 'gasPrice': 1}
+
+
+def load_members_acct(name_prefix: str) -> LocalAccount:
+    return Account.privateKeyToAccount(get_ssm_param_with_enc(gen_ssm_nodekey_service(name_prefix, SVC_MEMBERS)))
+
+
+def get_chainid(name_prefix: str) -> int:
+    return int(get_ssm_param_no_enc(gen_ssm_networkid(name_prefix)))
+
+
+class JobStore:
+    '''Jobs live in S3 as jobs/<id>/rows.ndjson (validated rows), jobs/<id>/status.json (counts only, so saving it
+    after every chunk stays cheap) and jobs/<id>/txids/<n>.json for the n-th chunk sent.'''
+
+    def __init__(self, bucket: str, s3=None):
+        self.bucket = bucket
+        self.s3 = boto3.client('s3') if s3 is None else s3
+
+    def _key(self, job_id, name):
+        return f"jobs/{job_id}/{name}"
+
+    def create(self, rows: List[MemberRow], kind='bulk') -> Dict:
+        job_id = uuid.uuid4().hex
+        body = '\n'.join(json.dumps(list(r)) for r in rows)
+        self.s3.put_object(Bucket=self.bucket, Key=self._key(job_id, 'rows.ndjson'), Body=body.encode())
+        status = {'JobId': job_id, 'Kind': kind, 'State': 'queued', 'NRows': len(rows), 'NSent': 0, 'NTxidChunks': 0,
+                  'Segments': [], 'Created': int(time.time())}
+        self.save_status(status)
+        return status
+
+    def rows(self, job_id) -> List[MemberRow]:
+        body = self.s3.get_object(Bucket=self.bucket, Key=self._key(job_id, 'rows.ndjson'))['Body'].read().decode()
+        return [MemberRow(*json.loads(line)) for line in body.split('\n') if line]
+
+    def status(self, job_id) -> Dict:
+        return json.loads(self.s3.get_object(Bucket=self.bucket, Key=self._key(job_id, 'status.json'))['Body'].read())
+
+    def save_status(self, status: Dict):
+        self.s3.put_object(Bucket=self.bucket, Key=self._key(status['JobId'], 'status.json'),
+                           Body=json.dumps(status).encode(), ContentType='application/json')
+
+    def txids(self, job_id, chunk: int) -> Dict:
+        return json.loads(self.s3.get_object(Bucket=self.bucket, Key=self._key(job_id, f"txids/{chunk}.json"))['Body']
+                          .read())
+
+    def save_txids(self, job_id, chunk: int, first_row: int, txids: List[str]):
+        self.s3.put_object(Bucket=self.bucket, Key=self._key(job_id, f"txids/{chunk}.json"),
+                           Body=json.dumps({'Chunk': chunk, 'FirstRow': first_row, 'Txids': txids}).encode(),
+                           ContentType='application/json')
+
+
+def run_job(store: JobStore, job_id: str, rpc, acct: LocalAccount, membership_addr: str, chainid: int,
+            remaining_time: Callable[[], float], chunk_size=500, window=4096, margin=60, gas=SET_MEMBER_GAS) -> Dict:
+    '''Sign and broadcast the job's remaining rows, `chunk_size` at a time, saving each chunk's txids and then the
+    progress. Returns
+    the status; State is 'sent' when every row has been broadcast, otherwise we ran low on time and the caller should
+    continue the job in a new invocation.
+
+    Nonces are read from the chain each time we (re)start so other senders using the members key can't collide with
+    us; `Segments` records the [first nonce, count] runs we used so progress can be computed from the mined nonce.'''
+    status = store.status(job_id)
+    rows = store.rows(job_id)
+    status.update({'State': 'sending', 'Sender': acct.address})
+    nonces = NonceStream.from_chain(rpc, acct.address)
+    while status['NSent'] < len(rows):
+        if remaining_time() < margin:
+            break
+        chunk = rows[status['NSent']:status['NSent'] + chunk_size]
+        signed = sign_txs(acct, [mk_set_member_tx(membership_addr, r, gas) for r in chunk], nonces, chainid=chainid)
+        broadcast(rpc, acct.address, signed, window=window)
+        store.save_txids(job_id, status['NTxidChunks'], status['NSent'], [stx.txid for stx in signed])
+        status['NTxidChunks'] += 1
+        _add_segment(status['Segments'], signed[0].nonce, len(signed))
+        status['NSent'] += len(signed)
+        store.save_status(status)
+    if status['NSent'] == len(rows):
+        status['State'] = 'sent'
+        store.save_status(status)
+    log.info(f"[run_job] {job_id}: {status['NSent']}/{len(rows)} sent")
+    return status
+
+
+def _add_segment(segments: List[List[int]], first_nonce: int, n: int):
+    if segments and segments[-1][0] + segments[-1][1] == first_nonce:
+        segments[-1][1] += n
+    else:
+        segments.append([first_nonce, n])
+
+
+def job_progress(status: Dict, mined_nonce: int) -> Tuple[int, int]:
+    '''(n mined, n rows): a tx is mined once the sender's mined nonce has passed it.'''
+    n_mined = sum(min(n, max(0, mined_nonce - first)) for (first, n) in status['Segments'])
+    return n_mined, status['NRows']
@@ -0,0 +1,99 @@
+'''A warm-container cache of Membership reads (getMember records and isAdmin) shared by the members handlers.
+
+Entries expire after a TTL as a backstop, but mostly they're kept exact: before serving reads we fetch the contract's
+SetMember / AddAdmin / RevokeAdmin logs since the last block we looked at (one eth_blockNumber, and one eth_getLogs
+when there's a new block) and update or drop exactly the entries they affect.'''
+
+import logging
+import time
+from typing import List, Dict
+
+from eth_utils import keccak, to_checksum_address
+
+from common.cache import TtlLruCache
+from .memberdb import SET_MEMBER_TOPIC, ADD_ADMIN_TOPIC, REVOKE_ADMIN_TOPIC, decode_set_member
+from .slots import read_members
+
+log = logging.getLogger("members-cache")
+log.setLevel(logging.INFO)
+
+IS_ADMIN_SELECTOR = keccak(text='isAdmin(address)')[:4].hex()
+MAX_SYNC_BLOCKS = 5000  # if we've been cold for longer than this, dropping everything is cheaper than catching up
+SYNC_INTERVAL = 1.0  # seconds; reads within this long of a sync don't check for new blocks
+
+
+class MembershipCache:
+    def __init__(self, contract: str, maxsize=50000, ttl=300):
+        self.contract = to_checksum_address(contract)
+        self.cache = TtlLruCache(maxsize=maxsize, ttl=ttl)
+        self.last_block = None
+        self.last_sync = 0.0
+
+    def sync(self, rpc, force=False) -> int:
+        '''Apply membership events since the last sync. Returns the number of logs applied.'''
+        if not force and time.monotonic() - self.last_sync < SYNC_INTERVAL:
+            return 0
+        self.last_sync = time.monotonic()
+        head = rpc.block_number()
+        if self.last_block is None or head - self.last_block > MAX_SYNC_BLOCKS:
+            self.cache.clear()
+            self.last_block = head
+            return 0
+        if head <= self.last_block:
+            return 0
+        logs = rpc.get_logs(self.contract, [[SET_MEMBER_TOPIC, ADD_ADMIN_TOPIC, REVOKE_ADMIN_TOPIC]],
+                            self.last_block + 1, head)
+        for l in sorted(logs, key=lambda l: (l['blockNumber'], l['logIndex'])):
+            topic = l['topics'][0]
+            if topic == SET_MEMBER_TOPIC:
+                m = decode_set_member(l)
+                # the event carries the whole new record, so update in place rather than dropping it
+                self.cache.put(('member', m['votingAddr']), _member(m['votingAddr'], m['weight'], m['startTime'],
+                                                                    m['endTime']))
+            else:
+                # AddAdmin names the caller rather than the new admin, so any admin entry could be stale
+                self.cache.invalidate_where(lambda k: k[0] == 'admin')
+        self.last_block = head
+        return len(logs)
+
+    def get_members(self, rpc, voting_addrs: List[str]) -> List[Dict]:
+        self.sync(rpc)
+        addrs = [to_checksum_address(a) for a in voting_addrs]
+        found, missing = self.cache.get_many(('member', a) for a in addrs)
+        if missing:
+            (_, members) = read_members(rpc, self.contract, [k[1] for k in missing])
+            for m in members:
+                found[('member', m['votingAddr'])] = m
+                self.cache.put(('member', m['votingAddr']), m)
+        return [found[('member', a)] for a in addrs]
+
+    def get_member(self, rpc, voting_addr: str) -> Dict:
+        return self.get_members(rpc, [voting_addr])[0]
+
+    def is_admin(self, rpc, addr: str) -> bool:
+        self.sync(rpc)
+        addr = to_checksum_address(addr)
+        v = self.cache.get(('admin', addr))
+        if v is None:
+            ret = rpc.call({'to': self.contract, 'data': '0x' + IS_ADMIN_SELECTOR + addr[2:].lower().rjust(64, '0')})
+            v = int(ret, 16) != 0
+            self.cache.put(('admin', addr), v)
+        return v
+
+    def stats(self) -> Dict:
+        return dict(self.cache.stats(), LastBlock=self.last_block)
+
+
+def _member(addr, weight, start, end) -> Dict:
+    return {'votingAddr': addr, 'isMember': (weight, start, end) != (0, 0, 0), 'weight': weight, 'startTime': start,
+            'endTime': end}
+
+
+_cache = None  # type: MembershipCache
+
+
+def membership_cache(contract: str) -> MembershipCache:
+    global _cache
+    if _cache is None or _cache.contract != to_checksum_address(contract):
+        _cache = MembershipCache(contract)
+    return _cache
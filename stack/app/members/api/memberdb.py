@@ -0,0 +1,219 @@
+'''A local index of the Membership contract, built from its events.
+
+SetMember / AddAdmin / RevokeAdmin logs are pulled with LogScan and folded into a SQLite db in /tmp along with the last
+indexed block, so each invocation only has to catch up on blocks since the last one. Listing, counting and paging
+members are then plain queries. Cold containers start from a snapshot of the db in S3 (when a bucket is configured)
+rather than re-reading the whole chain.'''
+
+import logging
+import os
+import sqlite3
+import time
+from typing import List, Dict, Optional, Iterator, Tuple
+
+from eth_utils import keccak, to_checksum_address
+
+from logscan import fetch_logs
+
+log = logging.getLogger("members-db")
+log.setLevel(logging.INFO)
+
+SET_MEMBER_TOPIC = '0x' + keccak(text='SetMember(address,uint48,uint48,uint48)').hex()
+ADD_ADMIN_TOPIC = '0x' + keccak(text='AddAdmin(address)').hex()
+REVOKE_ADMIN_TOPIC = '0x' + keccak(text='RevokeAdmin(address)').hex()
+ADD_ADMIN_SELECTOR = '0x' + keccak(text='addAdmin(address)')[:4].hex()
+
+CONFIRMATIONS = 2  # don't index the newest blocks so a short reorg can't leave stale rows behind
+SNAPSHOT_EVERY = 300  # seconds between db snapshots to S3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS members (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    voting_addr TEXT NOT NULL UNIQUE,
+    weight INTEGER NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    updated_block INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS admins (
+    addr TEXT PRIMARY KEY,
+    is_admin INTEGER NOT NULL,
+    updated_block INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+
+def _word(data: bytes, i: int) -> int:
+    return int.from_bytes(data[32 * i:32 * (i + 1)], 'big')
+
+
+def _addr(word: int) -> str:
+    return to_checksum_address(word.to_bytes(20, 'big'))
+
+
+def decode_set_member(l: Dict) -> Dict:
+    # nothing is indexed, so all four values are in the data
+    data = bytes.fromhex(l['data'][2:])
+    return {'votingAddr': _addr(_word(data, 0)), 'weight': _word(data, 1), 'startTime': _word(data, 2),
+            'endTime': _word(data, 3)}
+
+
+def _member_dict(r: sqlite3.Row) -> Dict:
+    return {'Seq': r['seq'], 'votingAddr': r['voting_addr'], 'weight': r['weight'], 'startTime': r['start_time'],
+            'endTime': r['end_time']}
+
+
+def db_path(contract: str) -> str:
+    return f"/tmp/sv-members-{contract.lower()}.db"
+
+
+def snapshot_key(contract: str) -> str:
+    return f"members-index/{contract.lower()}.db"
+
+
+class MemberDb:
+    def __init__(self, contract: str, path=None, from_block=0):
+        self.contract = to_checksum_address(contract)
+        self.path = path or db_path(contract)
+        self.from_block = from_block
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    # meta
+
+    def get_meta(self, key, default=None) -> Optional[str]:
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row['value']
+
+    def set_meta(self, key, value):
+        if self.db.execute('UPDATE meta SET value = ? WHERE key = ?', (str(value), key)).rowcount == 0:
+            self.db.execute('INSERT INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    @property
+    def last_block(self) -> int:
+        return int(self.get_meta('last_block', self.from_block - 1))
+
+    # indexing
+
+    def _apply_set_member(self, m: Dict, block: int):
+        # the contract appends to memberList on a voter's first SetMember; `seq` keeps that order
+        args = (m['weight'], m['startTime'], m['endTime'], block, m['votingAddr'])
+        if self.db.execute('UPDATE members SET weight = ?, start_time = ?, end_time = ?, updated_block = ? '
+                           'WHERE voting_addr = ?', args).rowcount == 0:
+            self.db.execute('INSERT INTO members (weight, start_time, end_time, updated_block, voting_addr) '
+                            'VALUES (?, ?, ?, ?, ?)', args)
+
+    def _apply_admin(self, addr: str, is_admin: bool, block: int):
+        args = (int(is_admin), block, addr)
+        if self.db.execute('UPDATE admins SET is_admin = ?, updated_block = ? WHERE addr = ?', args).rowcount == 0:
+            self.db.execute('INSERT INTO admins (is_admin, updated_block, addr) VALUES (?, ?, ?)', args)
+
+    def _added_admin(self, rpc, l: Dict) -> Optional[str]:
+        '''addAdmin emits the caller rather than the new admin, so read the new admin from the tx's calldata. That only
+        works for a direct call; when another contract calls addAdmin the new admin isn't in the tx or the log (and
+        the nodes don't serve traces), so that admin is skipped. The constructor's AddAdmin (the deployer) is right.'''
+        tx = rpc.get_transaction(l['transactionHash'])
+        if tx is not None and tx['to'] is None:
+            return _addr(int(l['data'][2:66], 16))
+        if tx is not None and tx['to'].lower() == self.contract.lower() and tx['input'][:10] == ADD_ADMIN_SELECTOR:
+            return _addr(int(tx['input'][10:74], 16))
+        log.warning(f"[MemberDb] can't tell who AddAdmin in {l['transactionHash']} (block {l['blockNumber']}) added; "
+                    f"not indexing it")
+        return None
+
+    def catch_up(self, rpc, to_block: Optional[int] = None, max_blocks: Optional[int] = None, **scan_kwargs) -> Dict:
+        '''Index everything from the last indexed block up to `to_block` (default: the head less CONFIRMATIONS), or only
+        the next `max_blocks` of that. `Behind` says how many blocks were left for a later call.'''
+        start = time.time()
+        if to_block is None:
+            to_block = rpc.block_number() - CONFIRMATIONS
+        from_block = self.last_block + 1
+        target = to_block
+        if max_blocks is not None:
+            to_block = min(to_block, from_block + max_blocks - 1)
+        if to_block < from_block:
+            return {'FromBlock': from_block, 'ToBlock': to_block, 'NLogs': 0, 'Behind': 0,
+                    'Duration': time.time() - start}
+
+        logs = fetch_logs(rpc, self.contract, [[SET_MEMBER_TOPIC, ADD_ADMIN_TOPIC, REVOKE_ADMIN_TOPIC]],
+                          from_block, to_block, **scan_kwargs)
+        with self.db:
+            for l in logs:
+                topic = l['topics'][0]
+                if topic == SET_MEMBER_TOPIC:
+                    self._apply_set_member(decode_set_member(l), l['blockNumber'])
+                elif topic == ADD_ADMIN_TOPIC:
+                    admin = self._added_admin(rpc, l)
+                    if admin is not None:
+                        self._apply_admin(admin, True, l['blockNumber'])
+                elif topic == REVOKE_ADMIN_TOPIC:
+                    self._apply_admin(_addr(int(l['data'][2:66], 16)), False, l['blockNumber'])
+            self.set_meta('last_block', to_block)
+        ret = {'FromBlock': from_block, 'ToBlock': to_block, 'NLogs': len(logs), 'Behind': target - to_block,
+               'Duration': time.time() - start}
+        log.info(f"[MemberDb.catch_up] {ret}")
+        return ret
+
+    # queries
+
+    def count(self, active_at: Optional[int] = None) -> int:
+        if active_at is None:
+            return self.db.execute('SELECT COUNT(*) FROM members').fetchone()[0]
+        return self.db.execute('SELECT COUNT(*) FROM members WHERE start_time <= ? AND end_time >= ?',
+                               (active_at, active_at)).fetchone()[0]
+
+    def list_members(self, after=0, limit=100, active_at: Optional[int] = None) -> List[Dict]:
+        '''Members in the order they were added, starting after the member with seq `after` (keyset paging).'''
+        q = 'SELECT * FROM members WHERE seq > ?'
+        args = [after]
+        if active_at is not None:
+            q += ' AND start_time <= ? AND end_time >= ?'
+            args += [active_at, active_at]
+        rows = self.db.execute(q + ' ORDER BY seq LIMIT ?', args + [limit]).fetchall()
+        return [_member_dict(r) for r in rows]
+
+    def iter_members(self) -> Iterator[Dict]:
+        for r in self.db.execute('SELECT * FROM members ORDER BY seq'):
+            yield _member_dict(r)
+
+    def get_member(self, voting_addr: str) -> Optional[Dict]:
+        r = self.db.execute('SELECT * FROM members WHERE voting_addr = ?',
+                            (to_checksum_address(voting_addr),)).fetchone()
+        return None if r is None else {'votingAddr': r['voting_addr'], 'weight': r['weight'],
+                                       'startTime': r['start_time'], 'endTime': r['end_time']}
+
+    def rows(self) -> Iterator[Tuple[str, int, int, int]]:
+        '''(votingAddr, weight, startTime, endTime) for every member, in the order they were added.'''
+        for r in self.db.execute('SELECT voting_addr, weight, start_time, end_time FROM members ORDER BY seq'):
+            yield tuple(r)
+
+    def admins(self) -> List[str]:
+        return [r['addr'] for r in self.db.execute('SELECT addr FROM admins WHERE is_admin = 1 ORDER BY addr')]
+
+    # snapshots
+
+    def save_snapshot(self, s3, bucket: str, force=False) -> bool:
+        if not force and time.time() - float(self.get_meta('snapshot_at', 0)) < SNAPSHOT_EVERY:
+            return False
+        with self.db:
+            self.set_meta('snapshot_at', time.time())
+        s3.upload_file(self.path, bucket, snapshot_key(self.contract))
+        return True
+
+    @classmethod
+    def open(cls, contract: str, s3=None, bucket: Optional[str] = None, from_block=0) -> 'MemberDb':
+        '''Open the local db, seeding it from the S3 snapshot when this container doesn't have one yet.'''
+        path = db_path(contract)
+        if s3 is not None and bucket is not None and not os.path.exists(path):
+            try:
+                s3.download_file(bucket, snapshot_key(contract), path)
+            except Exception as e:
+                log.info(f"[MemberDb.open] no snapshot to start from ({e}); indexing from block {from_block}")
+                if os.path.exists(path):
+                    os.remove(path)
+        return cls(contract, path=path, from_block=from_block)
@@ -1,7 +1,27 @@
 import bootstrap
 
+import base64
+import json
+import os
+import time
+
+import boto3
+
 # from common.lib import mk_logger
 
+from common.queue import SqsQueue
+from eth_utils import is_address
+from rpc import JsonRpcClient
+from multirpc import connect
+from rpccache import CachingRpc
+from .membercache import membership_cache
+from .memberdb import MemberDb
+from .pages import publish_pages, get_index, INDEX_KEY
+from .slots import read_members
+from .updates import TicketStore, enqueue_update, run_flusher
+from .bulk import parse_rows, detect_format, validate_row, RowError, InvalidUpload, JobStore, run_job, job_progress, \
+    load_members_acct, get_chainid, FIELDS
+
 
 #log = mk_logger('members-onboard')
 
@@ -11,13 +31,295 @@ class log:
         print('LOG INFO >>', str)
 
 
+lambda_client = boto3.client('lambda')
+s3 = boto3.client('s3')
+
+_member_db = None  # type: MemberDb
+_rpc = None  # type: JsonRpcClient
+
+MAX_LOOKUP = 1000
+# an API request only indexes this many blocks, so a cold start far behind the head can't run into the 29s API
+# timeout; the scheduled indexer does the bulk of any catching up
+MAX_API_CATCH_UP_BLOCKS = 20000
+INDEXER_CATCH_UP_BLOCKS = 200000
+INDEXER_MARGIN = 30  # seconds left when the indexer stops catching up and publishes
+
+_pages_index = (0, None)  # (fetched at, index)
+PAGES_INDEX_TTL = 15
+
+
+def _resp(status_code, body):
+    return {'statusCode': status_code, 'headers': {'Content-Type': 'application/json'}, 'body': json.dumps(body)}
+
+
+def _get_body(event) -> str:
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode()
+    return body
+
+
+def _header(event, name):
+    headers = event.get('headers') or {}
+    return next((v for (k, v) in headers.items() if k.lower() == name.lower()), None)
+
+
+def _api_key_id(event):
+    '''The id of the API key the request came with. API Gateway refuses /admin/* requests without a valid key, so
+    this is only missing if a route has lost its ApiKeyRequired (or the function is invoked some other way).'''
+    return ((event.get('requestContext') or {}).get('identity') or {}).get('apiKeyId')
+
+
+def _no_key():
+    return _resp(403, {'Errors': ['an API key is required']})
+
+
+def _start_job(job_id):
+    lambda_client.invoke(FunctionName=os.environ['pOnboardWorker'], InvocationType='Event',
+                         Payload=json.dumps({'JobId': job_id}).encode())
+
+
 def onboard_handler(event, ctx):
-    print('hi', event, ctx)
-    log.info(f'onboard lambda: {event}, {ctx}')
-    return {'statusCode': 200, 'body': '-'}
+    '''POST /admin/add: either one member as a JSON object, or a CSV / NDJSON upload of many members. Rows are
+    validated here and then sent as setMember txs by the worker. A single member is queued (and coalesced with any
+    other pending update for the same voter) and answered with a ticket; an upload becomes a job.'''
+    if not _api_key_id(event):
+        return _no_key()
+    body = _get_body(event)
+    try:
+        single = json.loads(body)
+    except ValueError:
+        single = None
+    try:
+        if type(single) is dict:
+            if any(f not in single for f in FIELDS):
+                raise InvalidUpload([f"expected an object with keys {FIELDS}"])
+            rows = [validate_row(1, *[single[f] for f in FIELDS])]
+        else:
+            rows = parse_rows(body, detect_format(_header(event, 'Content-Type'), body))
+    except RowError as e:
+        return _resp(400, {'Errors': [str(e)]})
+    except InvalidUpload as e:
+        return _resp(400, {'Errors': e.errors})
+
+    if type(single) is dict:
+        ticket = enqueue_update(SqsQueue(os.environ['pUpdatesQueue']), TicketStore(os.environ['pJobsBucket']),
+                                rows[0])
+        log.info(f"onboard: ticket {ticket['Ticket']} for {ticket['VotingAddr']}")
+        return _resp(202, {'Ticket': ticket['Ticket'], 'StatusPath': f"/admin/tickets/{ticket['Ticket']}"})
+
+    status = JobStore(os.environ['pJobsBucket']).create(rows)
+    _start_job(status['JobId'])
+    log.info(f"onboard: job {status['JobId']} with {len(rows)} members (api key {_api_key_id(event)})")
+    return _resp(202, {'JobId': status['JobId'], 'NRows': status['NRows'],
+                       'StatusPath': f"/admin/jobs/{status['JobId']}"})
+
+
+def onboard_worker_handler(event, ctx):
+    '''Sends setMember txs: a bulk job's rows when invoked with a JobId, otherwise (on its schedule) the queued single
+    member updates. Runs with a reserved concurrency of 1 so it's the only user of the members service key's nonces;
+    when close to the timeout a job saves progress and re-invokes itself to carry on.'''
+    name_prefix = os.environ['pNamePrefix']
+    rpc = _get_rpc()
+    remaining_time = lambda: ctx.get_remaining_time_in_millis() / 1000
+    acct = load_members_acct(name_prefix)
+    if not membership_cache(os.environ['pMembershipContract']).is_admin(rpc, acct.address):
+        # every setMember would revert; leave the queue and the job alone until the account is made an admin
+        raise Exception(f"Members service account {acct.address} is not a Membership admin")
+    if 'JobId' not in event:
+        # storage is read directly rather than through the cache, which can lag the chain by SYNC_INTERVAL
+        read_current = lambda addrs: read_members(rpc, os.environ['pMembershipContract'], addrs)[1]
+        return run_flusher(SqsQueue(os.environ['pUpdatesQueue']), TicketStore(os.environ['pJobsBucket']), rpc, acct,
+                           os.environ['pMembershipContract'], get_chainid(name_prefix), remaining_time=remaining_time,
+                           read_current=read_current)
+
+    job_id = event['JobId']
+    status = run_job(JobStore(os.environ['pJobsBucket']), job_id, rpc, acct, os.environ['pMembershipContract'],
+                     get_chainid(name_prefix), remaining_time=remaining_time)
+    if status['State'] != 'sent':
+        _start_job(job_id)
+    return {'JobId': job_id, 'State': status['State'], 'NSent': status['NSent']}
+
+
+def job_status_handler(event, ctx):
+    '''GET /admin/jobs/{jobId}, GET /admin/jobs/{jobId}?txids=<chunk> (the txids of one chunk of rows) and
+    GET /admin/tickets/{ticket}'''
+    if not _api_key_id(event):
+        return _no_key()
+    params = event.get('pathParameters') or {}
+    if 'ticket' in params:
+        return _ticket_status(params['ticket'])
+    job_id = params.get('jobId', '')
+    store = JobStore(os.environ['pJobsBucket'])
+    chunk = (event.get('queryStringParameters') or {}).get('txids')
+    if chunk is not None:
+        if not chunk.isdigit():
+            return _resp(400, {'Errors': [f"txids must be a chunk number, got {chunk!r}"]})
+        try:
+            return _resp(200, dict(store.txids(job_id, int(chunk)), JobId=job_id))
+        except store.s3.exceptions.NoSuchKey:
+            return _resp(404, {'Errors': [f"no chunk {chunk} for job {job_id}"]})
+    try:
+        status = store.status(job_id)
+    except store.s3.exceptions.NoSuchKey:
+        return _resp(404, {'Errors': [f"no job {job_id}"]})
+    n_mined = 0
+    if 'Sender' in status:
+        mined_nonce = _get_rpc().get_transaction_count(status['Sender'], 'latest')
+        n_mined, _ = job_progress(status, mined_nonce)
+    if status['State'] == 'sent' and n_mined == status['NRows']:
+        status['State'] = 'mined'
+    status['NMined'] = n_mined
+    return _resp(200, status)
+
+
+def _ticket_status(ticket_id):
+    store = TicketStore(os.environ['pJobsBucket'])
+    try:
+        ticket = store.get(ticket_id)
+    except store.s3.exceptions.NoSuchKey:
+        return _resp(404, {'Errors': [f"no ticket {ticket_id}"]})
+    if ticket['State'] == 'sent':
+        mined_nonce = _get_rpc().get_transaction_count(ticket['Sender'], 'latest')
+        if mined_nonce > ticket['Nonce']:
+            ticket['State'] = 'mined'
+    return _resp(200, ticket)
+
+
+def _get_rpc() -> JsonRpcClient:
+    # kept for the life of the container so node latencies and health, and final chain data, carry over
+    global _rpc
+    if _rpc is None:
+        _rpc = CachingRpc(connect(os.environ['pEthHost'], os.environ.get('pEthNodeIps', '')))
+    return _rpc
+
+
+def _get_member_db() -> MemberDb:
+    # kept for the life of the container; each request only indexes blocks since the last one
+    global _member_db
+    if _member_db is None:
+        _member_db = MemberDb.open(os.environ['pMembershipContract'], s3=s3, bucket=os.environ['pJobsBucket'],
+                                   from_block=int(os.environ.get('pMembershipFromBlock', 0)))
+    return _member_db
 
 
 def list_members_handler(event, ctx):
-    print('list members', event, ctx)
-    log.info(f'list members lambda: {event}, {ctx}')
-    return {'statusCode': 200, 'body': '-'}
\ No newline at end of file
+    '''GET /members?after=<seq>&limit=<n>&active=1 -- pages through members in the order they were added. `Next` is
+    the `after` to pass for the following page. GET /members?votingAddr=<addr> returns just that voter's record.'''
+    params = event.get('queryStringParameters') or {}
+    if 'votingAddr' in params:
+        if not is_address(params['votingAddr']):
+            return _resp(400, {'Errors': ['votingAddr is not an address']})
+        cache = membership_cache(os.environ['pMembershipContract'])
+        member = cache.get_member(_get_rpc(), params['votingAddr'])
+        log.info(f"list members: lookup {params['votingAddr']}; cache {cache.stats()}")
+        return _resp(200, member)
+    try:
+        after = int(params.get('after', 0))
+        limit = max(1, min(1000, int(params.get('limit', 100))))
+    except ValueError:
+        return _resp(400, {'Errors': ['after and limit must be integers']})
+    active_at = int(time.time()) if params.get('active') in ('1', 'true') else None
+
+    mdb = _get_member_db()
+    stats = mdb.catch_up(_get_rpc(), max_blocks=MAX_API_CATCH_UP_BLOCKS)
+    if stats['NLogs'] > 0:
+        mdb.save_snapshot(s3, os.environ['pJobsBucket'])
+    members = mdb.list_members(after=after, limit=limit, active_at=active_at)
+    log.info(f'list members: {len(members)} after {after}; {stats}')
+    return _resp(200, {'Members': members, 'Count': mdb.count(active_at=active_at),
+                       'Next': members[-1]['Seq'] if len(members) == limit else None,
+                       'IndexedBlock': mdb.last_block, 'BlocksBehind': stats['Behind']})
+
+
+def lookup_members_handler(event, ctx):
+    '''POST /members/lookup with {"votingAddrs": [...]} -- every voter's current record, read from contract storage in
+    one batch.'''
+    try:
+        addrs = json.loads(_get_body(event)).get('votingAddrs')
+    except (ValueError, AttributeError):
+        addrs = None
+    if type(addrs) is not list or not all(type(a) is str and is_address(a) for a in addrs):
+        return _resp(400, {'Errors': ['expected {"votingAddrs": [address, ...]}']})
+    if len(addrs) > MAX_LOOKUP:
+        return _resp(400, {'Errors': [f"at most {MAX_LOOKUP} addresses per lookup"]})
+    block, members = read_members(_get_rpc(), os.environ['pMembershipContract'], addrs)
+    return _resp(200, {'Block': block, 'Members': members})
+
+
+def members_indexer_handler(event, ctx):
+    '''Scheduled: catch the member index up with the chain and, when it changed, republish the member snapshot and the
+    static member list pages.'''
+    # numpy is only needed by the snapshot handlers, so keep it out of the other handlers' cold starts
+    from common.membersnap import MemberSnapshot, snapshot_key
+
+    mdb = _get_member_db()
+    stats = mdb.catch_up(_get_rpc(), max_blocks=INDEXER_CATCH_UP_BLOCKS)
+    # a cold index works through the chain a step at a time (each step is committed) until it's near the deadline
+    while stats['Behind'] > 0 and ctx.get_remaining_time_in_millis() / 1000 > INDEXER_MARGIN:
+        step = mdb.catch_up(_get_rpc(), max_blocks=INDEXER_CATCH_UP_BLOCKS)
+        stats.update(ToBlock=step['ToBlock'], NLogs=stats['NLogs'] + step['NLogs'], Behind=step['Behind'])
+    bucket = os.environ['pJobsBucket']
+    if stats['NLogs'] > 0 or mdb.get_meta('published_block') is None:
+        snap = MemberSnapshot.build(mdb.rows(), Block=mdb.last_block, Contract=os.environ['pMembershipContract'])
+        path = '/tmp/members.snap'
+        snap.save(path)
+        s3.upload_file(path, bucket, snapshot_key(os.environ['pMembershipContract']))
+        stats['PublishedSnapshot'] = len(snap)
+        pages = publish_pages(s3, os.environ['pStaticBucket'], mdb.iter_members(), mdb.last_block)
+        stats['PublishedPages'] = len(pages['Pages'])
+        stats['UploadedPages'] = pages['NUploaded']
+        # only recorded once everything is published, so a failure above is retried on the next run
+        with mdb.db:
+            mdb.set_meta('published_block', mdb.last_block)
+        mdb.save_snapshot(s3, bucket, force=True)
+    log.info(f'members indexer: {stats}')
+    return stats
+
+
+def members_stats_handler(event, ctx):
+    '''GET /members/stats?t=<unix time>[&until=<unix time>] -- active member count and total weight at `t` (default
+    now), answered from the published snapshot.'''
+    from common.membersnap import fetch_snapshot, snapshot_key, SnapshotMissing
+
+    params = event.get('queryStringParameters') or {}
+    try:
+        t = int(params.get('t', time.time()))
+        until = int(params['until']) if 'until' in params else None
+    except ValueError:
+        return _resp(400, {'Errors': ['t and until must be unix times']})
+    if t < 0 or (until is not None and until < 0):
+        return _resp(400, {'Errors': ['t and until must not be negative']})
+    try:
+        snap = fetch_snapshot(s3, os.environ['pJobsBucket'], snapshot_key(os.environ['pMembershipContract']))
+    except SnapshotMissing:
+        return _resp(503, {'Errors': ['members are not indexed yet; try again shortly']})
+    ret = {'T': t, 'Block': snap.meta['Block'], 'NMembers': len(snap), 'ActiveCount': int(snap.active_count(t)),
+           'ActiveWeight': int(snap.total_active_weight(t))}
+    if until is not None:
+        ret.update({'Until': until, 'ActiveCountBetween': int(snap.active_count_between(t, until))})
+    return _resp(200, ret)
+
+
+def member_pages_handler(event, ctx):
+    '''GET /members/pages and GET /members/pages/{page} -- redirect to the member list index or one of its pages in the
+    static bucket, so reads are served (and cached) by S3 rather than by this lambda or the chain.'''
+    global _pages_index
+    bucket = os.environ['pStaticBucket']
+    page = (event.get('pathParameters') or {}).get('page')
+    if page is None:
+        return {'statusCode': 302, 'headers': {'Location': f"{s3.meta.endpoint_url}/{bucket}/{INDEX_KEY}",
+                                               'Cache-Control': 'public, max-age=300'}, 'body': ''}
+    (fetched_at, index) = _pages_index
+    if index is None or time.time() - fetched_at > PAGES_INDEX_TTL:
+        index = get_index(s3, bucket) or {'Pages': []}
+        _pages_index = (time.time(), index)
+    try:
+        if int(page) < 0:
+            raise IndexError(page)
+        entry = index['Pages'][int(page)]
+    except (ValueError, IndexError):
+        return _resp(404, {'Errors': [f"no page {page}"], 'NPages': len(index['Pages'])})
+    # pages are immutable, but which page is "page n" changes, so the redirect itself is only briefly cacheable
+    return {'statusCode': 302, 'headers': {'Location': entry['Url'], 'ETag': '"' + entry['Sha256'] + '"',
+                                           'Cache-Control': f'public, max-age={PAGES_INDEX_TTL}'}, 'body': ''}
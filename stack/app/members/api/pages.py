@@ -0,0 +1,91 @@
+'''The member list as static, immutable pages in the stack's static bucket.
+
+Members are cut into fixed-size pages in the order they were added. Each page is gzipped JSON stored under its own
+content hash (members/pages/<sha256>.json), so a page's URL and ETag change exactly when its content does and pages can
+be cached forever. members/index.json lists the current pages and is the only object that's overwritten. Republishing
+after new SetMember events only uploads pages whose content changed: new members only touch the last page, and an
+update to an existing member only touches the page it's on.'''
+
+import hashlib
+import json
+import logging
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Iterable, Optional, Tuple
+
+log = logging.getLogger("members-pages")
+log.setLevel(logging.INFO)
+
+PAGE_SIZE = 1000
+INDEX_KEY = 'members/index.json'
+PAGES_PREFIX = 'members/pages/'
+PAGE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+INDEX_CACHE_CONTROL = 'public, max-age=15'
+
+
+def encode_page(obj) -> Tuple[bytes, str]:
+    '''(gzipped json, sha256 of the json). Sorted keys and a zero gzip mtime make the output deterministic.'''
+    raw = json.dumps(obj, sort_keys=True, separators=(',', ':')).encode()
+    gz = zlib.compressobj(9, zlib.DEFLATED, 31)
+    return gz.compress(raw) + gz.flush(), hashlib.sha256(raw).hexdigest()
+
+
+def build_pages(members: Iterable[Dict], page_size=PAGE_SIZE) -> List[Tuple[Dict, bytes]]:
+    '''[(page entry for the index, gzipped page)] for `members` (dicts with Seq, in Seq order).'''
+    pages = []
+    batch = []
+
+    def flush():
+        n = len(pages)
+        body, sha = encode_page({'Page': n, 'Members': batch})
+        pages.append(({'Page': n, 'Key': f"{PAGES_PREFIX}{sha}.json", 'Sha256': sha, 'Count': len(batch),
+                       'FirstSeq': batch[0]['Seq'], 'LastSeq': batch[-1]['Seq']}, body))
+
+    for m in members:
+        batch.append(m)
+        if len(batch) == page_size:
+            flush()
+            batch = []
+    if batch:
+        flush()
+    return pages
+
+
+# without s3:ListBucket on the static bucket (see its policy) a missing object is a 403 rather than a NoSuchKey
+MISSING_CODES = {'NoSuchKey', '404', 'AccessDenied', '403'}
+
+
+def get_index(s3, bucket: str) -> Optional[Dict]:
+    '''The published index, or None before the first publish.'''
+    try:
+        obj = s3.get_object(Bucket=bucket, Key=INDEX_KEY)
+    except Exception as e:
+        if str(getattr(e, 'response', {}).get('Error', {}).get('Code')) in MISSING_CODES:
+            return None
+        raise
+    return json.loads(zlib.decompress(obj['Body'].read(), 31))
+
+
+def publish_pages(s3, bucket: str, members: Iterable[Dict], block: int, page_size=PAGE_SIZE) -> Dict:
+    '''Upload new or changed pages, then the index pointing at them. Returns the index.'''
+    prev = get_index(s3, bucket) or {'Pages': []}
+    existing = {p['Key'] for p in prev['Pages']}
+    pages = build_pages(members, page_size)
+    base_url = f"{s3.meta.endpoint_url}/{bucket}"
+    to_upload = [(entry, body) for (entry, body) in pages if entry['Key'] not in existing]
+
+    def upload(page):
+        (entry, body) = page
+        s3.put_object(Bucket=bucket, Key=entry['Key'], Body=body, ContentType='application/json',
+                      ContentEncoding='gzip', CacheControl=PAGE_CACHE_CONTROL)
+
+    # pages go up before the index that references them
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(upload, to_upload))
+    index = {'Block': block, 'PageSize': page_size, 'NMembers': sum(e['Count'] for (e, _) in pages),
+             'Pages': [dict(e, Url=f"{base_url}/{e['Key']}") for (e, _) in pages]}
+    body, _ = encode_page(index)
+    s3.put_object(Bucket=bucket, Key=INDEX_KEY, Body=body, ContentType='application/json', ContentEncoding='gzip',
+                  CacheControl=INDEX_CACHE_CONTROL)
+    log.info(f"[publish_pages] {len(pages)} pages ({len(to_upload)} uploaded) for {index['NMembers']} members")
+    return dict(index, NUploaded=len(to_upload), IndexUrl=f"{base_url}/{INDEX_KEY}")
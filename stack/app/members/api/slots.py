@@ -0,0 +1,53 @@
+'''Read Membership.members straight from contract storage.
+
+`members` is the mapping at storage slot 1 (slot 0 is the admins role), so a voter's packed record lives at
+keccak(pad32(addr) || pad32(1)). Reading the slot with eth_getStorageAt skips ABI encoding and the EVM call that
+getMember costs, and thousands of reads fit in one JSON-RPC batch.'''
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple
+
+from eth_utils import keccak, to_checksum_address, to_int
+
+log = logging.getLogger("members-slots")
+log.setLevel(logging.INFO)
+
+MEMBERS_SLOT = 1
+UINT_48_MASK = 0xffffffffffff
+UINT_32_MASK = 0xffffffff
+
+
+def member_slot(voting_addr: str) -> str:
+    addr = bytes.fromhex(to_checksum_address(voting_addr)[2:])
+    return '0x' + keccak(addr.rjust(32, b'\0') + MEMBERS_SLOT.to_bytes(32, 'big')).hex()
+
+
+def unpack(packed: int) -> Tuple[int, int, int]:
+    '''(weight, start, end), the same as Membership.unpack.'''
+    return (packed >> 96) & UINT_32_MASK, (packed >> 48) & UINT_48_MASK, packed & UINT_48_MASK
+
+
+def read_members(rpc, contract: str, voting_addrs: List[str], block='latest', batch_size=1000,
+                 workers=4) -> Tuple[int, List[Dict]]:
+    '''Returns (block number read at, members in the same order as `voting_addrs`). Every batch reads the same block
+    so the result is a consistent view even when it takes several requests.'''
+    if block == 'latest':
+        block = rpc.block_number()
+    block_hex = hex(block)
+    addrs = [to_checksum_address(a) for a in voting_addrs]
+    batches = [addrs[i:i + batch_size] for i in range(0, len(addrs), batch_size)]
+
+    def read(batch):
+        return rpc.batch([('eth_getStorageAt', [contract, member_slot(a), block_hex]) for a in batch])
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        words = [w for ws in pool.map(read, batches) for w in ws]
+    members = []
+    for (addr, word) in zip(addrs, words):
+        packed = to_int(hexstr=word)
+        (weight, start, end) = unpack(packed)
+        # the contract treats a zero record as "never set"
+        members.append({'votingAddr': addr, 'isMember': packed != 0, 'weight': weight, 'startTime': start,
+                        'endTime': end})
+    return block, members
@@ -0,0 +1,222 @@
+'''Queued membership updates.
+
+Single-member updates from the API are put on a queue and answered with a ticket. The onboard worker drains the queue
+once per block: pending updates for the same votingAddr are collapsed into the most recent one (so a burst of weight
+corrections costs one setMember tx), and each flush is sized to what fits in a block's gas limit and to how many of
+our txs the chain has yet to mine, so a lagging chain makes updates wait in the queue rather than in the tx pool.'''
+
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, NamedTuple, Tuple, Callable, Iterable, Optional
+
+import boto3
+from eth_account.signers.local import LocalAccount
+
+from common.queue import Message
+from txpipe import NonceStream, sign_txs, broadcast
+from .bulk import MemberRow, mk_set_member_tx, SET_MEMBER_GAS
+
+log = logging.getLogger("members-updates")
+log.setLevel(logging.INFO)
+
+Update = NamedTuple('Update', [('ticket', str), ('row', MemberRow), ('queued', float)])
+
+
+def mk_update_msg(row: MemberRow) -> Dict:
+    return {'Ticket': uuid.uuid4().hex, 'Row': list(row), 'Queued': time.time()}
+
+
+class Coalescer:
+    '''Pending updates keyed by votingAddr, oldest voter first. A newer update for a voter replaces the pending one
+    (keeping its place in line); the receipt handles of every message folded in are kept so they can all be deleted
+    once the surviving update is sent. `sent` holds the last update sent per voter, including by earlier runs (see
+    `load_sent`), so an old message that turns up later is dropped rather than sent over the newer one.'''
+
+    def __init__(self):
+        self.pending = OrderedDict()  # type: Dict[str, Tuple[Update, List[str]]]
+        self.superseded = []  # type: List[Tuple[str, str]]  # (ticket, ticket that replaced it)
+        self.sent = {}  # type: Dict[str, Optional[Update]]  # last update sent per voter, None if never
+        self.stale_handles = []  # type: List[str]
+
+    def load_sent(self, tickets: 'TicketStore', msgs: List[Message]):
+        '''Look up the last sent update of any voter in `msgs` we haven't seen yet.'''
+        addrs = {msg.body['Row'][0] for msg in msgs} - set(self.sent)
+        self.sent.update(tickets.last_sent_many(addrs))
+
+    def add(self, msg: Message):
+        b = msg.body
+        u = Update(b['Ticket'], MemberRow(*b['Row']), b['Queued'])
+        addr = u.row.voting_addr
+        last_sent = self.sent.get(addr)
+        if last_sent is not None and (u.queued, u.ticket) <= (last_sent.queued, last_sent.ticket):
+            if u.ticket != last_sent.ticket:
+                # arrived after a newer update for the same voter was already sent
+                self.superseded.append((u.ticket, last_sent.ticket))
+            # (otherwise a redelivery of the update that was sent)
+            self.stale_handles.append(msg.handle)
+            return
+        if addr not in self.pending:
+            self.pending[addr] = (u, [msg.handle])
+            return
+        (cur, handles) = self.pending[addr]
+        handles.append(msg.handle)
+        # the queue doesn't guarantee order, so the newest update wins regardless of which arrived first
+        if (u.queued, u.ticket) > (cur.queued, cur.ticket):
+            self.pending[addr] = (u, handles)
+            self.superseded.append((cur.ticket, u.ticket))
+        else:
+            self.superseded.append((u.ticket, cur.ticket))
+
+    def take(self, n: int) -> List[Tuple[Update, List[str]]]:
+        batch = [self.pending.popitem(last=False)[1] for _ in range(min(n, len(self.pending)))]
+        self.sent.update({u.row.voting_addr: u for (u, _) in batch})
+        return batch
+
+    def take_superseded(self) -> List[Tuple[str, str]]:
+        (ret, self.superseded) = (self.superseded, [])
+        return ret
+
+    def handles(self) -> List[str]:
+        return [h for (_, handles) in self.pending.values() for h in handles]
+
+    def __len__(self):
+        return len(self.pending)
+
+
+class TicketStore:
+    '''Tickets live in S3 next to the bulk jobs, as tickets/<ticket>.json. The last update sent for each voter is kept
+    as voters/<votingAddr>.json so later flusher runs know which queued updates it has made stale.'''
+
+    def __init__(self, bucket: str, s3=None):
+        self.bucket = bucket
+        self.s3 = boto3.client('s3') if s3 is None else s3
+
+    def put(self, ticket: Dict):
+        self.s3.put_object(Bucket=self.bucket, Key=f"tickets/{ticket['Ticket']}.json",
+                           Body=json.dumps(ticket).encode(), ContentType='application/json')
+
+    def put_many(self, tickets: List[Dict]):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(self.put, tickets))
+
+    def get(self, ticket: str) -> Dict:
+        return json.loads(self.s3.get_object(Bucket=self.bucket, Key=f"tickets/{ticket}.json")['Body'].read())
+
+    def put_last_sent(self, updates: List[Update]):
+        def put(u: Update):
+            self.s3.put_object(Bucket=self.bucket, Key=f"voters/{u.row.voting_addr}.json",
+                               Body=json.dumps({'Ticket': u.ticket, 'Row': list(u.row), 'Queued': u.queued}).encode(),
+                               ContentType='application/json')
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(put, updates))
+
+    def last_sent(self, addr: str) -> Optional[Update]:
+        try:
+            b = json.loads(self.s3.get_object(Bucket=self.bucket, Key=f"voters/{addr}.json")['Body'].read())
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return Update(b['Ticket'], MemberRow(*b['Row']), b['Queued'])
+
+    def last_sent_many(self, addrs: Iterable[str]) -> Dict[str, Optional[Update]]:
+        addrs = list(addrs)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            return dict(zip(addrs, pool.map(self.last_sent, addrs)))
+
+
+def enqueue_update(queue, tickets: TicketStore, row: MemberRow) -> Dict:
+    msg = mk_update_msg(row)
+    ticket = {'Ticket': msg['Ticket'], 'State': 'queued', 'VotingAddr': row.voting_addr, 'Row': list(row),
+              'Queued': msg['Queued']}
+    tickets.put(ticket)
+    queue.send(msg)
+    return ticket
+
+
+def _matches(row: MemberRow, member: Dict) -> bool:
+    return (row.weight, row.start_time, row.end_time) == (member['weight'], member['startTime'], member['endTime'])
+
+
+def flush_block(queue, coalescer: Coalescer, tickets: TicketStore, rpc, acct: LocalAccount, membership_addr: str,
+                chainid: int, max_pending=256, block_fill=0.8, gas=SET_MEMBER_GAS, max_receive=5000,
+                read_current: Optional[Callable[[List[str]], List[Dict]]] = None) -> Dict:
+    '''Pull everything queued into `coalescer` and send as many updates as the current block and backlog allow.
+
+    With `read_current` (votingAddrs -> their members on chain), an update that already matches the chain is marked
+    'unchanged' instead of sent. That's only checked when none of our txs are waiting to be mined: the update taken for
+    a voter is the latest one pending, but an earlier one for them could still be in flight and would then land
+    after it.'''
+    msgs = queue.receive(max_receive)
+    coalescer.load_sent(tickets, msgs)
+    for msg in msgs:
+        coalescer.add(msg)
+    superseded = coalescer.take_superseded()
+    if superseded:
+        tickets.put_many([{'Ticket': t, 'State': 'superseded', 'SupersededBy': by} for (t, by) in superseded])
+    if coalescer.stale_handles:
+        queue.delete(coalescer.stale_handles)
+        coalescer.stale_handles = []
+
+    mined_nonce = rpc.get_transaction_count(acct.address, 'latest')
+    next_nonce = rpc.get_transaction_count(acct.address, 'pending')
+    in_flight = next_nonce - mined_nonce
+    per_block = int(rpc.get_block('latest')['gasLimit'] * block_fill) // gas
+    n = min(per_block, max_pending - in_flight, len(coalescer))
+    stats = {'Backlog': len(coalescer), 'InFlight': in_flight, 'Superseded': len(superseded), 'Sent': 0,
+             'Unchanged': 0}
+    if n <= 0:
+        return stats
+
+    taken = coalescer.take(n)
+    batch = taken  # the ones that need a tx
+    if read_current is not None and in_flight == 0:
+        current = read_current([u.row.voting_addr for (u, _) in taken])
+        batch = [b for (b, m) in zip(taken, current) if not _matches(b[0].row, m)]
+        unchanged = [b for (b, m) in zip(taken, current) if _matches(b[0].row, m)]
+        tickets.put_many([{'Ticket': u.ticket, 'State': 'unchanged', 'VotingAddr': u.row.voting_addr,
+                           'Row': list(u.row), 'Queued': u.queued} for (u, _) in unchanged])
+        stats['Unchanged'] = len(unchanged)
+    signed = []
+    if batch:
+        signed = sign_txs(acct, [mk_set_member_tx(membership_addr, u.row, gas) for (u, _) in batch],
+                          NonceStream(next_nonce), chainid=chainid)
+        broadcast(rpc, acct.address, signed, window=max_pending)
+    tickets.put_many([{'Ticket': u.ticket, 'State': 'sent', 'VotingAddr': u.row.voting_addr, 'Row': list(u.row),
+                       'Queued': u.queued, 'Sender': acct.address, 'Nonce': stx.nonce, 'Txid': stx.txid}
+                      for ((u, _), stx) in zip(batch, signed)])
+    # recorded (unchanged ones too) before the messages are deleted: a message is only gone once a later run can tell
+    # it's been handled
+    tickets.put_last_sent([u for (u, _) in taken])
+    queue.delete([h for (_, handles) in taken for h in handles])
+    stats.update({'Backlog': len(coalescer), 'Sent': len(signed)})
+    return stats
+
+
+def run_flusher(queue, tickets: TicketStore, rpc, acct: LocalAccount, membership_addr: str, chainid: int,
+                remaining_time: Callable[[], float], margin=15, idle_blocks=3, poll_rate=0.5, **flush_kwargs) -> Dict:
+    '''Flush once per new block until the queue has been idle for `idle_blocks` blocks or we're near the deadline.
+    Anything still held in the coalescer is released back to the queue for the next run.'''
+    coalescer = Coalescer()
+    totals = {'Blocks': 0, 'Sent': 0, 'Superseded': 0, 'Unchanged': 0}
+    last_block = None
+    idle = 0
+    while idle < idle_blocks and remaining_time() > margin:
+        block = rpc.block_number()
+        if block == last_block:
+            time.sleep(poll_rate)
+            continue
+        last_block = block
+        stats = flush_block(queue, coalescer, tickets, rpc, acct, membership_addr, chainid, **flush_kwargs)
+        totals['Blocks'] += 1
+        totals['Sent'] += stats['Sent']
+        totals['Superseded'] += stats['Superseded']
+        totals['Unchanged'] += stats['Unchanged']
+        idle = idle + 1 if stats['Sent'] == 0 and stats['Backlog'] == 0 else 0
+    queue.release(coalescer.handles())
+    totals['Released'] = len(coalescer)
+    log.info(f"[run_flusher] {totals}")
+    return totals
@@ -0,0 +1,106 @@
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+cr_common_dir = os.path.join(main_dir, '../../cr/common')
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'api'))
+sys.path.insert(0, os.path.join(main_dir, '../common'))
+sys.path.insert(0, os.path.join(cr_common_dir, 'deps'))
+sys.path.insert(0, cr_common_dir)
+
+import json
+import logging
+
+import yaml
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+from api import onboard
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestAdminAuth')
+
+TEMPLATE = os.path.join(main_dir, '../../nested/sv-members-app.yaml')
+ADDR = '0x' + '12' * 20
+
+
+class _CfnLoader(yaml.SafeLoader):
+    pass
+
+
+# !Ref, !Sub, !GetAtt etc. are kept as plain values
+_CfnLoader.add_multi_constructor('!', lambda loader, suffix, node: None)
+
+
+def api_events(template):
+    '''(path, method, auth) for every Api event in the template.'''
+    for r in template['Resources'].values():
+        for ev in (r.get('Properties') or {}).get('Events', {}).values():
+            if ev['Type'] == 'Api':
+                p = ev['Properties']
+                yield (p['Path'], p['Method'], p.get('Auth') or {})
+
+
+def test_template_requires_api_key():
+    with open(TEMPLATE) as f:
+        template = yaml.load(f, Loader=_CfnLoader)
+    events = list(api_events(template))
+    admin = [(path, auth) for (path, _, auth) in events if path.startswith('/admin/')]
+    assert len(admin) >= 2
+    assert all(auth.get('ApiKeyRequired') is True for (_, auth) in admin), admin
+    # ...and there is a key to give admins
+    api = template['Resources']['rMembersOnboardApi']['Properties']
+    assert api['Auth']['UsagePlan']['CreateUsagePlan'] == 'PER_API'
+    # public reads stay open
+    assert all(not auth.get('ApiKeyRequired') for (path, _, auth) in events if not path.startswith('/admin/'))
+    return True
+
+
+def test_unauthenticated_refused():
+    started = []
+    (start_job, job_store) = (onboard._start_job, onboard.JobStore)
+    onboard._start_job = started.append
+    onboard.JobStore = None  # anything past the key check would fail
+    upload = "votingAddr,weight,startTime,endTime\n{},1,0,100\n".format(ADDR)
+    try:
+        for ctx in [None, {}, {'identity': {}}, {'identity': {'apiKeyId': None}}]:
+            event = {'body': upload, 'headers': {'Content-Type': 'text/csv'}}
+            if ctx is not None:
+                event['requestContext'] = ctx
+            ret = onboard.onboard_handler(event, None)
+            assert ret['statusCode'] == 403 and 'API key' in json.loads(ret['body'])['Errors'][0]
+            ret = onboard.job_status_handler({'pathParameters': {'jobId': 'j1'}, 'requestContext': ctx}, None)
+            assert ret['statusCode'] == 403
+    finally:
+        (onboard._start_job, onboard.JobStore) = (start_job, job_store)
+    assert started == []
+    return True
+
+
+def test_single_update_needs_key():
+    queued = []
+    saved = (onboard.enqueue_update, onboard.SqsQueue, onboard.TicketStore, dict(os.environ))
+    onboard.enqueue_update = lambda queue, tickets, row: queued.append(row) or {'Ticket': 't1', 'VotingAddr': row[0]}
+    onboard.SqsQueue = onboard.TicketStore = lambda name: name
+    os.environ.update(pUpdatesQueue='updates', pJobsBucket='jobs')
+    body = json.dumps({'votingAddr': ADDR, 'weight': 1, 'startTime': 0, 'endTime': 100})
+    try:
+        assert onboard.onboard_handler({'body': body}, None)['statusCode'] == 403
+        ret = onboard.job_status_handler({'pathParameters': {'ticket': 't1'}}, None)
+        assert ret['statusCode'] == 403
+        assert queued == []
+        # with a key it's queued as before
+        ret = onboard.onboard_handler({'body': body, 'requestContext': {'identity': {'apiKeyId': 'k1'}}}, None)
+        assert ret['statusCode'] == 202 and json.loads(ret['body'])['Ticket'] == 't1' and len(queued) == 1
+    finally:
+        (onboard.enqueue_update, onboard.SqsQueue, onboard.TicketStore, env) = saved
+        os.environ.clear()
+        os.environ.update(env)
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_template_requires_api_key, test_unauthenticated_refused, test_single_update_needs_key]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
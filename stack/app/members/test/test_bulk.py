@@ -0,0 +1,136 @@
+import sys, os
+import io
+from types import SimpleNamespace
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+cr_common_dir = os.path.join(main_dir, '../../cr/common')
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'api'))
+sys.path.insert(0, os.path.join(cr_common_dir, 'deps'))
+sys.path.insert(0, cr_common_dir)
+
+import logging
+
+from eth_abi import decode_abi
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+import api.bulk as bulk
+from api.bulk import parse_rows, detect_format, encode_set_member, job_progress, _add_segment, InvalidUpload, \
+    MemberRow, SET_MEMBER_SELECTOR, SET_MEMBER_TYPES, iter_lines, JobStore, run_job
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestBulk')
+
+ADDR = '0x' + '12' * 20
+
+
+def test_parse_csv():
+    body = "votingAddr,weight,startTime,endTime\n{a},1,0,{e}\n\n{a}, 2 ,10,20\n".format(a=ADDR, e=2 ** 48 - 1)
+    rows = parse_rows(body, detect_format('text/csv', body))
+    assert len(rows) == 2
+    assert rows[0] == MemberRow('0x1212121212121212121212121212121212121212', 1, 0, 2 ** 48 - 1)
+    assert rows[1].weight == 2
+    return True
+
+
+def test_parse_ndjson():
+    body = '{{"votingAddr": "{a}", "weight": 5, "startTime": 1, "endTime": 2}}\n'.format(a=ADDR) * 3
+    assert detect_format(None, body) == 'ndjson'
+    rows = parse_rows(body, 'ndjson')
+    assert len(rows) == 3 and rows[2].weight == 5
+    return True
+
+
+def test_parse_errors_reported_per_line():
+    body = "\n".join(["{},1,0,1".format(ADDR),
+                      "0xnotanaddress,1,0,1",
+                      "{},{},0,1".format(ADDR, 2 ** 32),
+                      "{},1,0".format(ADDR),
+                      "{},1.5,0,1".format(ADDR)])
+    try:
+        parse_rows(body, 'csv')
+    except InvalidUpload as e:
+        assert [err.split(':')[0] for err in e.errors] == ['line 2', 'line 3', 'line 4', 'line 5'], e.errors
+        return True
+    raise AssertionError("expected InvalidUpload")
+
+
+def test_iter_lines():
+    assert list(iter_lines("a\r\nb\n\nc")) == ['a', 'b', '', 'c']
+    assert list(iter_lines("a\n")) == ['a'] and list(iter_lines("")) == []
+    # line numbers in errors count blank lines
+    try:
+        parse_rows("{},1,0,1\r\n\r\n0xnope,1,0,1\r\n".format(ADDR), 'csv')
+        assert False
+    except InvalidUpload as e:
+        assert e.errors[0].startswith('line 3')
+    return True
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.max_size = {}
+        self.exceptions = SimpleNamespace(NoSuchKey=KeyError)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+        self.max_size[Key] = max(len(Body), self.max_size.get(Key, 0))
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+
+def test_run_job_txids_per_chunk():
+    store = JobStore('jobs-bucket', s3=FakeS3())
+    rows = [MemberRow(ADDR, i, 0, 1) for i in range(2000)]
+    job_id = store.create(rows)['JobId']
+    nonces = iter(range(10 ** 6))
+    saved = (bulk.NonceStream, bulk.sign_txs, bulk.broadcast)
+    bulk.NonceStream = SimpleNamespace(from_chain=lambda rpc, addr: None)
+    bulk.sign_txs = lambda acct, txs, _nonces, chainid: [
+        SimpleNamespace(nonce=n, txid='0x%064x' % n) for (_, n) in zip(txs, nonces)]
+    bulk.broadcast = lambda rpc, addr, signed, window: None
+    try:
+        status = run_job(store, job_id, None, SimpleNamespace(address=ADDR), ADDR, 1, remaining_time=lambda: 1000,
+                         chunk_size=100)
+    finally:
+        (bulk.NonceStream, bulk.sign_txs, bulk.broadcast) = saved
+    assert (status['State'], status['NSent'], status['NTxidChunks']) == ('sent', 2000, 20)
+    assert status['Segments'] == [[0, 2000]] and 'Txids' not in status
+    # status.json (rewritten after every chunk) doesn't grow with the job
+    assert store.s3.max_size[f"jobs/{job_id}/status.json"] < 1000
+    chunk = store.txids(job_id, 7)
+    assert chunk['FirstRow'] == 700 and chunk['Txids'][0] == '0x%064x' % 700 and len(chunk['Txids']) == 100
+    return True
+
+
+def test_encode_set_member():
+    row = MemberRow('0x1212121212121212121212121212121212121212', 7, 100, 200)
+    data = encode_set_member(row)
+    assert data[:4] == SET_MEMBER_SELECTOR == bytes.fromhex('d5e3b6b4')
+    assert list(decode_abi(SET_MEMBER_TYPES, data[4:]))[1:] == [7, 100, 200]
+    return True
+
+
+def test_job_progress():
+    segments = []
+    _add_segment(segments, 10, 500)
+    _add_segment(segments, 510, 500)
+    _add_segment(segments, 1100, 100)  # someone else used the key in between
+    assert segments == [[10, 1000], [1100, 100]]
+    status = {'Segments': segments, 'NRows': 1100}
+    assert job_progress(status, 10) == (0, 1100)
+    assert job_progress(status, 600) == (590, 1100)
+    assert job_progress(status, 1150) == (1050, 1100)
+    assert job_progress(status, 5000) == (1100, 1100)
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_parse_csv, test_parse_ndjson, test_parse_errors_reported_per_line, test_iter_lines,
+             test_run_job_txids_per_chunk, test_encode_set_member, test_job_progress]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
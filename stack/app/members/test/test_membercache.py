@@ -0,0 +1,98 @@
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+cr_common_dir = os.path.join(main_dir, '../../cr/common')
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'api'))
+sys.path.insert(0, os.path.join(main_dir, '../common'))
+sys.path.insert(0, os.path.join(cr_common_dir, 'deps'))
+sys.path.insert(0, cr_common_dir)
+
+import logging
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+from api import membercache
+from api.membercache import MembershipCache
+from api.memberdb import SET_MEMBER_TOPIC, REVOKE_ADMIN_TOPIC
+from api.slots import member_slot
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestMemberCache')
+
+CONTRACT = '0x' + 'cc' * 20
+ADMIN = '0x' + '0a' * 20
+
+
+def _w(n):
+    return '{:064x}'.format(n)
+
+
+class FakeNode:
+    def __init__(self):
+        self.head = 100
+        self.storage = {}
+        self.logs = []
+        self.admins = {ADMIN.lower()}
+        self.n_storage_reads = 0
+        self.n_calls = 0
+
+    def set_member(self, addr, weight, start, end, log_it=True):
+        self.storage[member_slot(addr)] = hex((weight << 96) | (start << 48) | end)
+        if log_it:
+            self.head += 1
+            self.logs.append({'blockNumber': self.head, 'logIndex': 0, 'topics': [SET_MEMBER_TOPIC],
+                              'data': '0x' + _w(int(addr, 16)) + _w(weight) + _w(start) + _w(end)})
+
+    def block_number(self):
+        return self.head
+
+    def batch(self, calls):
+        self.n_storage_reads += len(calls)
+        return [self.storage.get(p[1], '0x0') for (_, p) in calls]
+
+    def get_logs(self, address, topics, from_block, to_block):
+        return [l for l in self.logs if from_block <= l['blockNumber'] <= to_block]
+
+    def call(self, tx, block='latest'):
+        self.n_calls += 1
+        return '0x' + _w(int('0x' + tx['data'][-40:] in self.admins))
+
+
+def test_event_invalidation():
+    interval = membercache.SYNC_INTERVAL
+    membercache.SYNC_INTERVAL = 0
+    try:
+        node = FakeNode()
+        voter = '0x' + '11' * 20
+        node.set_member(voter, 1, 0, 100, log_it=False)
+        cache = MembershipCache(CONTRACT)
+
+        assert cache.get_member(node, voter)['weight'] == 1
+        assert cache.get_member(node, voter)['weight'] == 1
+        assert node.n_storage_reads == 1
+
+        # a SetMember event updates the cached record without another storage read
+        node.set_member(voter, 7, 5, 50)
+        assert cache.get_member(node, voter)['weight'] == 7
+        assert node.n_storage_reads == 1
+
+        assert cache.is_admin(node, ADMIN) and cache.is_admin(node, ADMIN)
+        assert node.n_calls == 1
+        node.admins = set()
+        node.head += 1
+        node.logs.append({'blockNumber': node.head, 'logIndex': 0, 'topics': [REVOKE_ADMIN_TOPIC],
+                          'data': '0x' + _w(int(ADMIN, 16))})
+        assert not cache.is_admin(node, ADMIN)
+        assert node.n_calls == 2
+        assert (cache.stats()['Hits'], cache.stats()['Misses']) == (3, 3)
+    finally:
+        membercache.SYNC_INTERVAL = interval
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_event_invalidation]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -0,0 +1,137 @@
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+cr_common_dir = os.path.join(main_dir, '../../cr/common')
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'api'))
+sys.path.insert(0, os.path.join(main_dir, '../common'))
+sys.path.insert(0, os.path.join(cr_common_dir, 'deps'))
+sys.path.insert(0, cr_common_dir)
+
+import logging
+import tempfile
+import threading
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+from rpc import RpcError
+from api.memberdb import MemberDb, SET_MEMBER_TOPIC, ADD_ADMIN_TOPIC, REVOKE_ADMIN_TOPIC, ADD_ADMIN_SELECTOR
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestMemberDb')
+
+CONTRACT = '0x' + 'cc' * 20
+OWNER = '0x' + '0a' * 20
+MEMBERS_SVC = '0x' + '0b' * 20
+
+
+def _w(n: int) -> str:
+    return '{:064x}'.format(n)
+
+
+class FakeNode:
+    '''Serves a fixed set of logs, refusing any eth_getLogs over `max_results` results like a real node does.'''
+
+    def __init__(self, logs, head, max_results=50):
+        self.logs = logs
+        self.head = head
+        self.max_results = max_results
+        self.calls = 0
+        self.txs = {}
+        self._lock = threading.Lock()
+
+    def block_number(self):
+        return self.head
+
+    def get_logs(self, address, topics, from_block, to_block):
+        with self._lock:
+            self.calls += 1
+        got = [dict(l) for l in self.logs if from_block <= l['blockNumber'] <= to_block and l['topics'][0] in topics[0]]
+        if len(got) > self.max_results:
+            raise RpcError('eth_getLogs', {'code': -32005, 'message': 'query returned more than 50 results'})
+        return got
+
+    def get_transaction(self, txid):
+        return self.txs.get(txid)
+
+
+def set_member_log(block, i, addr: int, weight, start, end):
+    return {'blockNumber': block, 'logIndex': i, 'topics': [SET_MEMBER_TOPIC], 'transactionHash': f"0x{block:064x}",
+            'data': '0x' + _w(addr) + _w(weight) + _w(start) + _w(end)}
+
+
+def mk_chain(n_members=400):
+    logs = [{'blockNumber': 1, 'logIndex': 0, 'topics': [ADD_ADMIN_TOPIC], 'transactionHash': '0x' + _w(1),
+             'data': '0x' + _w(int(OWNER, 16))},
+            # addAdmin(MEMBERS_SVC) called by OWNER: the event says OWNER
+            {'blockNumber': 2, 'logIndex': 0, 'topics': [ADD_ADMIN_TOPIC], 'transactionHash': '0x' + _w(2),
+             'data': '0x' + _w(int(OWNER, 16))}]
+    for i in range(n_members):
+        logs.append(set_member_log(10 + i * 25, 0, 1000 + i, 1, 0, 100))
+    # a later update to the first member keeps its position
+    logs.append(set_member_log(20000, 0, 1000, 5, 50, 200))
+    node = FakeNode(logs, head=20100)
+    node.txs['0x' + _w(1)] = {'to': None, 'input': '0x6080'}  # deployment
+    node.txs['0x' + _w(2)] = {'to': CONTRACT, 'input': ADD_ADMIN_SELECTOR + _w(int(MEMBERS_SVC, 16))}
+    return node
+
+
+def test_index_and_page():
+    node = mk_chain()
+    with tempfile.TemporaryDirectory() as d:
+        mdb = MemberDb(CONTRACT, path=os.path.join(d, 'm.db'))
+        stats = mdb.catch_up(node, initial_span=100000)
+        assert stats['NLogs'] == 403, stats
+        assert mdb.count() == 400
+        assert mdb.last_block == 20100 - 2
+        first = mdb.list_members(limit=2)
+        assert first[0]['votingAddr'].lower() == '0x' + '{:040x}'.format(1000)
+        assert (first[0]['weight'], first[0]['startTime'], first[0]['endTime']) == (5, 50, 200)
+        page = mdb.list_members(after=first[-1]['Seq'], limit=1000)
+        assert len(page) == 398
+        assert mdb.count(active_at=150) == 1
+        assert sorted(a.lower() for a in mdb.admins()) == sorted([OWNER, MEMBERS_SVC])
+
+        # nothing new: no getLogs calls at all
+        calls = node.calls
+        assert mdb.catch_up(node)['NLogs'] == 0 and node.calls == calls
+        # a new block with a new member is picked up incrementally
+        node.logs.append(set_member_log(20099, 0, 5000, 1, 0, 100))
+        node.head = 20101
+        assert mdb.catch_up(node)['NLogs'] == 1 and mdb.count() == 401
+    return True
+
+
+def test_admin_added_by_contract_skipped():
+    node = mk_chain(n_members=0)
+    # a multisig calls addAdmin: the event names the multisig and the tx calls the multisig
+    multisig = '0x' + '0d' * 20
+    node.logs.append({'blockNumber': 3, 'logIndex': 0, 'topics': [ADD_ADMIN_TOPIC], 'transactionHash': '0x' + _w(3),
+                      'data': '0x' + _w(int(multisig, 16))})
+    node.txs['0x' + _w(3)] = {'to': multisig, 'input': '0xc6427474' + _w(int(CONTRACT, 16))}
+    with tempfile.TemporaryDirectory() as d:
+        mdb = MemberDb(CONTRACT, path=os.path.join(d, 'm.db'))
+        mdb.catch_up(node)
+        assert sorted(a.lower() for a in mdb.admins()) == sorted([OWNER, MEMBERS_SVC])
+    return True
+
+
+def test_bounded_catch_up():
+    node = mk_chain()
+    with tempfile.TemporaryDirectory() as d:
+        mdb = MemberDb(CONTRACT, path=os.path.join(d, 'm.db'))
+        stats = mdb.catch_up(node, max_blocks=5000)
+        assert (stats['FromBlock'], stats['ToBlock'], stats['Behind']) == (0, 4999, 20098 - 4999)
+        assert mdb.last_block == 4999 and mdb.count() == 200
+        # each call carries on where the last one stopped
+        while stats['Behind'] > 0:
+            stats = mdb.catch_up(node, max_blocks=5000)
+        assert mdb.last_block == 20098 and mdb.count() == 400
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_index_and_page, test_admin_added_by_contract_skipped, test_bounded_catch_up]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -0,0 +1,98 @@
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+cr_common_dir = os.path.join(main_dir, '../../cr/common')
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'api'))
+sys.path.insert(0, os.path.join(main_dir, '../common'))
+sys.path.insert(0, os.path.join(cr_common_dir, 'deps'))
+sys.path.insert(0, cr_common_dir)
+
+import io
+import json
+import logging
+import zlib
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+from api.pages import publish_pages, get_index, INDEX_KEY
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestPages')
+
+
+class AccessDenied(Exception):
+    '''What botocore raises for a missing key when the caller can't list the bucket.'''
+    response = {'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}
+
+
+class FakeS3:
+    class meta:
+        endpoint_url = 'https://s3.example'
+
+    def __init__(self):
+        self.objects = {}
+        self.puts = []
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+        self.puts.append(Key)
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise AccessDenied(Key)
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+
+def mk_members(n):
+    return [{'Seq': i + 1, 'votingAddr': '0x{:040x}'.format(i), 'weight': 1, 'startTime': 0, 'endTime': 100}
+            for i in range(n)]
+
+
+def test_only_changed_pages_uploaded():
+    s3 = FakeS3()
+    members = mk_members(2500)
+    index = publish_pages(s3, 'static', members, block=10)
+    assert len(index['Pages']) == 3 and index['NUploaded'] == 3 and index['NMembers'] == 2500
+
+    # republishing the same members uploads nothing but the index
+    s3.puts = []
+    assert publish_pages(s3, 'static', members, block=11)['NUploaded'] == 0
+    assert s3.puts == [INDEX_KEY]
+
+    # an update on page 0 and a new member on the last page touch just those two
+    members[5]['weight'] = 9
+    members.append({'Seq': 2501, 'votingAddr': '0x' + 'ff' * 20, 'weight': 1, 'startTime': 0, 'endTime': 1})
+    index2 = publish_pages(s3, 'static', members, block=12)
+    assert index2['NUploaded'] == 2
+    assert index2['Pages'][1]['Key'] == index['Pages'][1]['Key']
+
+    page0 = json.loads(zlib.decompress(s3.objects[index2['Pages'][0]['Key']], 31))
+    assert page0['Members'][5]['weight'] == 9
+    return True
+
+
+def test_missing_index():
+    s3 = FakeS3()
+    # before the first publish the index is a 403, like the real bucket
+    assert get_index(s3, 'static') is None
+
+    class Throttled(Exception):
+        response = {'Error': {'Code': 'SlowDown'}}
+
+    def get_object(Bucket, Key):
+        raise Throttled(Key)
+    s3.get_object = get_object
+    try:
+        get_index(s3, 'static')
+        assert False
+    except Throttled:
+        pass
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_only_changed_pages_uploaded, test_missing_index]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
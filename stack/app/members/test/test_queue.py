@@ -0,0 +1,195 @@
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+cr_common_dir = os.path.join(main_dir, '../../cr/common')
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'api'))
+sys.path.insert(0, os.path.join(main_dir, '../common'))
+sys.path.insert(0, os.path.join(cr_common_dir, 'deps'))
+sys.path.insert(0, cr_common_dir)
+
+import logging
+
+from eth_account import Account
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+from common.queue import LocalQueue, SqsQueue
+from api.bulk import MemberRow, SET_MEMBER_GAS
+from api.updates import Coalescer, enqueue_update, flush_block
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestQueue')
+
+MEMBERSHIP = '0x' + 'aa' * 20
+
+
+class FakeTickets:
+    def __init__(self):
+        self.tickets = {}
+        self.voters = {}
+
+    def put(self, ticket):
+        self.tickets[ticket['Ticket']] = ticket
+
+    def put_many(self, tickets):
+        for t in tickets:
+            self.put(t)
+
+    def get(self, ticket):
+        return self.tickets[ticket]
+
+    def put_last_sent(self, updates):
+        self.voters.update({u.row.voting_addr: u for u in updates})
+
+    def last_sent_many(self, addrs):
+        return {a: self.voters.get(a) for a in addrs}
+
+
+class FakeChain:
+    '''Just enough of JsonRpcClient for flush_block: txs sit in the pool until `mine` is called.'''
+
+    def __init__(self, gas_limit):
+        self.gas_limit = gas_limit
+        self.mined = 0
+        self.sent = []
+
+    def get_transaction_count(self, addr, block='pending'):
+        return self.mined if block == 'latest' else len(self.sent)
+
+    def get_block(self, block='latest', full_txs=False):
+        return {'gasLimit': self.gas_limit}
+
+    def send_raw_transaction(self, raw):
+        self.sent.append(raw)
+
+    def send_raw_transactions(self, raws):
+        self.sent.extend(raws)
+
+    def mine(self):
+        self.mined = len(self.sent)
+
+
+def mk_row(i, weight=1):
+    return MemberRow('0x{:040x}'.format(i + 1), weight, 0, 2 ** 40)
+
+
+def test_coalesce_latest_wins():
+    q, tickets = LocalQueue(), FakeTickets()
+    first = enqueue_update(q, tickets, mk_row(0, weight=1))
+    enqueue_update(q, tickets, mk_row(1))
+    last = enqueue_update(q, tickets, mk_row(0, weight=3))
+    c = Coalescer()
+    for m in q.receive(100):
+        c.add(m)
+    assert len(c) == 2
+    (u, handles) = c.take(1)[0]
+    assert u.ticket == last['Ticket'] and u.row.weight == 3 and len(handles) == 2
+    assert c.take_superseded() == [(first['Ticket'], last['Ticket'])]
+    return True
+
+
+def test_flush_batches_and_backpressure():
+    acct = Account.create()
+    q, tickets = LocalQueue(), FakeTickets()
+    chain = FakeChain(gas_limit=SET_MEMBER_GAS * 10)  # 8 txs per block at the default 80% fill
+    for i in range(30):
+        enqueue_update(q, tickets, mk_row(i))
+    c = Coalescer()
+
+    stats = flush_block(q, c, tickets, chain, acct, MEMBERSHIP, 1, max_pending=12)
+    assert stats['Sent'] == 8 and stats['Backlog'] == 22
+    # the chain hasn't mined anything, so only 4 more fit under max_pending
+    stats = flush_block(q, c, tickets, chain, acct, MEMBERSHIP, 1, max_pending=12)
+    assert stats['Sent'] == 4 and stats['InFlight'] == 8
+    stats = flush_block(q, c, tickets, chain, acct, MEMBERSHIP, 1, max_pending=12)
+    assert stats['Sent'] == 0 and stats['Backlog'] == 18
+    chain.mine()
+    stats = flush_block(q, c, tickets, chain, acct, MEMBERSHIP, 1, max_pending=12)
+    assert stats['Sent'] == 8
+
+    sent = [t for t in tickets.tickets.values() if t['State'] == 'sent']
+    assert sorted(t['Nonce'] for t in sent) == list(range(20))
+    assert len(q) == 0  # everything is either deleted or held by the coalescer
+    return True
+
+
+def test_stale_update_after_send():
+    acct = Account.create()
+    q, tickets = LocalQueue(), FakeTickets()
+    chain = FakeChain(gas_limit=SET_MEMBER_GAS * 10)
+    old = {'Ticket': 'a' * 32, 'Row': list(mk_row(0, weight=1)), 'Queued': 1.0}
+    new = {'Ticket': 'b' * 32, 'Row': list(mk_row(0, weight=2)), 'Queued': 2.0}
+    q.send(new)
+    flush_block(q, Coalescer(), tickets, chain, acct, MEMBERSHIP, 1)
+    # the old update turns up in a later flusher run, with a fresh coalescer
+    q.send(old)
+    q.send(new)  # ...along with a redelivery of the one already sent
+    stats = flush_block(q, Coalescer(), tickets, chain, acct, MEMBERSHIP, 1)
+    assert stats['Sent'] == 0 and len(chain.sent) == 1 and len(q) == 0
+    assert tickets.get(old['Ticket'])['SupersededBy'] == new['Ticket']
+    assert tickets.get(new['Ticket'])['State'] == 'sent'
+    return True
+
+
+def test_unchanged_only_when_nothing_in_flight():
+    acct = Account.create()
+    q, tickets = LocalQueue(), FakeTickets()
+    chain = FakeChain(gas_limit=SET_MEMBER_GAS * 10)
+    on_chain = {}  # what's been mined, by voter
+
+    def read_current(addrs):
+        return [dict(zip(['weight', 'startTime', 'endTime'], on_chain.get(a, (0, 0, 0)))) for a in addrs]
+
+    def mine():
+        chain.mine()
+        on_chain.update({t['VotingAddr']: tuple(t['Row'][1:]) for t in tickets.tickets.values()
+                         if t['State'] == 'sent'})
+
+    enqueue_update(q, tickets, mk_row(0, weight=1))
+    flush_block(q, Coalescer(), tickets, chain, acct, MEMBERSHIP, 1, read_current=read_current)
+    mine()
+    enqueue_update(q, tickets, mk_row(0, weight=2))
+    flush_block(q, Coalescer(), tickets, chain, acct, MEMBERSHIP, 1, read_current=read_current)
+    # weight 1 matches the chain, but the weight 2 update ahead of it hasn't been mined: it has to be sent
+    back = enqueue_update(q, tickets, mk_row(0, weight=1))
+    stats = flush_block(q, Coalescer(), tickets, chain, acct, MEMBERSHIP, 1, read_current=read_current)
+    assert (stats['Sent'], stats['Unchanged']) == (1, 0) and tickets.get(back['Ticket'])['State'] == 'sent'
+    mine()
+    # once everything is mined a repeat costs nothing
+    again = enqueue_update(q, tickets, mk_row(0, weight=1))
+    stats = flush_block(q, Coalescer(), tickets, chain, acct, MEMBERSHIP, 1, read_current=read_current)
+    assert (stats['Sent'], stats['Unchanged']) == (0, 1) and len(chain.sent) == 3 and len(q) == 0
+    assert tickets.get(again['Ticket'])['State'] == 'unchanged'
+    # ...and it counts as the voter's latest, so an older update that turns up now is superseded
+    q.send({'Ticket': 'c' * 32, 'Row': list(mk_row(0, weight=5)), 'Queued': 1.0})
+    stats = flush_block(q, Coalescer(), tickets, chain, acct, MEMBERSHIP, 1, read_current=read_current)
+    assert stats['Sent'] == 0 and tickets.get('c' * 32)['SupersededBy'] == again['Ticket']
+    return True
+
+
+def test_sqs_long_polls():
+    class FakeSqs:
+        def __init__(self, n):
+            self.n = n
+            self.waits = []
+
+        def receive_message(self, QueueUrl, WaitTimeSeconds, MaxNumberOfMessages):
+            self.waits.append(WaitTimeSeconds)
+            got = min(self.n, MaxNumberOfMessages)
+            self.n -= got
+            return {'Messages': [{'Body': '{}', 'ReceiptHandle': str(i)} for i in range(got)]}
+
+    sqs = FakeSqs(25)
+    assert len(SqsQueue('url', sqs=sqs).receive(100)) == 25
+    # only a long poll coming back empty means the queue is empty
+    assert len(sqs.waits) == 4 and min(sqs.waits) >= 1
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_coalesce_latest_wins, test_flush_batches_and_backpressure, test_stale_update_after_send,
+             test_unchanged_only_when_nothing_in_flight, test_sqs_long_polls]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -0,0 +1,65 @@
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+cr_common_dir = os.path.join(main_dir, '../../cr/common')
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'api'))
+sys.path.insert(0, os.path.join(main_dir, '../common'))
+sys.path.insert(0, os.path.join(cr_common_dir, 'deps'))
+sys.path.insert(0, cr_common_dir)
+
+import logging
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+from api.slots import member_slot, unpack, read_members
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestSlots')
+
+CONTRACT = '0x' + 'cc' * 20
+
+
+def pack(weight, start, end):
+    # Membership.pack
+    return (weight << 96) | (start << 48) | end
+
+
+class FakeStorage:
+    def __init__(self, slots):
+        self.slots = slots
+        self.n_batches = 0
+
+    def block_number(self):
+        return 7
+
+    def batch(self, calls):
+        self.n_batches += 1
+        assert all(m == 'eth_getStorageAt' and p[0] == CONTRACT and p[2] == '0x7' for (m, p) in calls)
+        return [self.slots.get(p[1], '0x0') for (_, p) in calls]
+
+
+def test_unpack():
+    assert unpack(pack(2 ** 32 - 1, 2 ** 48 - 1, 0)) == (2 ** 32 - 1, 2 ** 48 - 1, 0)
+    assert unpack(pack(3, 1000, 2000)) == (3, 1000, 2000)
+    return True
+
+
+def test_read_members():
+    addrs = ['0x{:040x}'.format(i + 1) for i in range(2500)]
+    members = {a: (i % 7 + 1, i, i + 100) for (i, a) in enumerate(addrs) if i % 3 != 0}
+    node = FakeStorage({member_slot(a): hex(pack(*m)) for (a, m) in members.items()})
+    block, got = read_members(node, CONTRACT, addrs, batch_size=1000)
+    assert block == 7 and node.n_batches == 3 and len(got) == 2500
+    for (a, g) in zip(addrs, got):
+        assert g['votingAddr'].lower() == a
+        assert g['isMember'] == (a in members)
+        assert (g['weight'], g['startTime'], g['endTime']) == members.get(a, (0, 0, 0))
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_unpack, test_read_members]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -0,0 +1,101 @@
+import hashlib
+import logging
+import os
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict
+
+import boto3
+
+log = logging.getLogger("artifacts")
+log.setLevel(logging.INFO)
+
+# /tmp survives between warm invocations of the same lambda container
+CACHE_DIR = os.environ.get('SV_ARTIFACT_CACHE_DIR', '/tmp/sv-artifacts')
+FETCH_TIMEOUT = 30
+
+_pool = ThreadPoolExecutor(max_workers=8)
+_lock = threading.Lock()
+_inflight = {}  # type: Dict[str, Future]
+_s3 = None
+
+
+class ArtifactError(Exception):
+    pass
+
+
+def cache_path(sha256: str) -> str:
+    return os.path.join(CACHE_DIR, sha256)
+
+
+def _s3_client():
+    '''One client for every download: boto3 clients are thread safe, but slow to create.'''
+    global _s3
+    with _lock:
+        if _s3 is None:
+            _s3 = boto3.client('s3')
+        return _s3
+
+
+def _download(url: str) -> bytes:
+    u = urllib.parse.urlparse(url)
+    if u.scheme == 's3':
+        return _s3_client().get_object(Bucket=u.netloc, Key=u.path.lstrip('/'))['Body'].read()
+    if u.scheme in ('http', 'https'):
+        with urllib.request.urlopen(url, timeout=FETCH_TIMEOUT) as r:
+            return r.read()
+    if u.scheme == 'file':
+        with open(u.path, 'rb') as f:
+            return f.read()
+    raise ArtifactError(f"Unsupported artifact URL scheme: {url}")
+
+
+def _load(url: str, sha256: str) -> bytes:
+    path = cache_path(sha256)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        # /tmp outlives this process, so what's there is re-checked rather than trusted
+        if hashlib.sha256(data).hexdigest() == sha256:
+            log.info(f"[artifacts] cache hit for {url} ({sha256})")
+            return data
+        log.warning(f"[artifacts] cached {sha256} is corrupt; fetching it again")
+        os.remove(path)
+
+    log.info(f"[artifacts] fetching {url}")
+    data = _download(url)
+    actual = hashlib.sha256(data).hexdigest()
+    if actual != sha256:
+        raise ArtifactError(f"Hash mismatch for {url}: expected {sha256}, got {actual}")
+
+    # write to a temp name and rename so a crashed/timed out invocation can never leave a partial file in the cache
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+    return data
+
+
+def _submit(url: str, sha256: str) -> Future:
+    sha256 = sha256.lower()
+    with _lock:
+        fut = _inflight.get(sha256)
+        # failed fetches are forgotten so a later call can retry them
+        if fut is None or (fut.done() and fut.exception() is not None):
+            fut = _pool.submit(_load, url, sha256)
+            _inflight[sha256] = fut
+        return fut
+
+
+def fetch_artifact(url: str, sha256: str) -> bytes:
+    '''Return the artifact with content hash `sha256`, downloading it from `url` only if it is not already cached
+    (or being fetched by a prefetch).'''
+    return _submit(url, sha256).result()
+
+
+def prefetch(plan: List[Dict]) -> List[Future]:
+    '''Start fetching every remote artifact in `plan` in the background.'''
+    return [_submit(op['URL'], op['Sha256']) for op in plan if 'URL' in op]
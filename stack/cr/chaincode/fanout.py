@@ -0,0 +1,141 @@
+'''Run one chaincode plan against many voting networks at once.
+
+usage: python3 fanout.py plan.json targets.json [--dry-run] [--workers N]
+
+plan.json is a pSmartContracts list (as in sv-chaincode-loader.yaml); targets.json is a list of
+{"NamePrefix": ..., "RpcUrl": ...} objects (or [NamePrefix, RpcUrl] pairs).'''
+
+import argparse
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, NamedTuple, Callable
+
+import bootstrap
+
+from web3 import Web3
+from web3.middleware import http_retry_request_middleware, attrdict_middleware, pythonic_middleware
+
+from lib import SVC_CHAINCODE, Timer
+from rpc import JsonRpcClient
+from artifacts import prefetch
+from chaincode import compile_plan, mk_contract, load_privkey, get_chainid, get_next_nonce
+
+log = logging.getLogger("fanout")
+log.setLevel(logging.INFO)
+
+Target = NamedTuple('Target', [('name_prefix', str), ('rpc_url', str)])
+
+_pool_lock = threading.Lock()
+_rpc_pool = {}  # type: Dict[str, JsonRpcClient]
+_w3_pool = {}  # type: Dict[str, Web3]
+
+
+def get_rpc(url: str) -> JsonRpcClient:
+    '''Clients are pooled per endpoint so repeated runs (or targets sharing a node) reuse connections.'''
+    with _pool_lock:
+        if url not in _rpc_pool:
+            _rpc_pool[url] = JsonRpcClient(url)
+        return _rpc_pool[url]
+
+
+def get_w3(url: str) -> Web3:
+    with _pool_lock:
+        if url not in _w3_pool:
+            _w3_pool[url] = Web3(Web3.HTTPProvider(url),
+                                 middlewares=[http_retry_request_middleware, attrdict_middleware, pythonic_middleware])
+        return _w3_pool[url]
+
+
+def parse_targets(raw: List) -> List[Target]:
+    return [Target(t['NamePrefix'], t['RpcUrl']) if type(t) is dict else Target(*t) for t in raw]
+
+
+def log_progress(target: Target, i: int, n_ops: int, result, duration: float):
+    cached = ' (cached)' if result.cached else ''
+    log.info(f"[{target.name_prefix}] {i + 1}/{n_ops} {result}{cached} in {duration:.2f}s")
+
+
+def run_target(plan: List[Dict], target: Target, dry_run=False,
+               on_progress: Callable = log_progress) -> Dict:
+    with Timer() as t:
+        rpc = get_rpc(target.rpc_url)
+        acct = load_privkey(target.name_prefix, SVC_CHAINCODE)
+        chainid = int(get_chainid(target.name_prefix))
+        fold = mk_contract(target.name_prefix, get_w3(target.rpc_url), acct, chainid,
+                           nonce=get_next_nonce(rpc, acct), dry_run=dry_run, rpc=rpc)
+        outs = dict()
+        for (i, op) in enumerate(plan):
+            with Timer() as t_op:
+                outs = fold(outs, op)
+            on_progress(target, i, len(plan), outs[op['Name']], t_op.interval)
+    return {
+        'NamePrefix': target.name_prefix,
+        'Ok': True,
+        'Duration': t.interval,
+        'NCached': sum(1 for r in outs.values() if r.cached),
+        'Outputs': dict([r.mk_output() for r in outs.values() if 'Output' in r.op]),
+    }
+
+
+def run_fanout(plan: List[Dict], targets: List[Target], workers=8, dry_run=False,
+               on_progress: Callable = log_progress) -> Dict:
+    '''Execute `plan` against every target concurrently. One target failing doesn't stop the others; its error is
+    recorded in the report instead.'''
+    plan = compile_plan(plan)
+    prefetch(plan)
+
+    def _run(target):
+        start = time.time()
+        try:
+            return run_target(plan, target, dry_run=dry_run, on_progress=on_progress)
+        except Exception as e:
+            log.error(f"[{target.name_prefix}] failed: {repr(e)}")
+            return {'NamePrefix': target.name_prefix, 'Ok': False, 'Duration': time.time() - start,
+                    'Error': repr(e)}
+
+    with Timer() as t:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(targets)))) as pool:
+            results = list(pool.map(_run, targets))
+
+    durations = sorted(r['Duration'] for r in results)
+    return {
+        'Targets': results,
+        'NOk': sum(1 for r in results if r['Ok']),
+        'NFailed': sum(1 for r in results if not r['Ok']),
+        'WallTime': t.interval,
+        'SerialTime': sum(durations),
+        'SlowestTarget': durations[-1] if durations else 0,
+        'MedianTarget': durations[len(durations) // 2] if durations else 0,
+    }
+
+
+def format_report(report: Dict) -> str:
+    lines = [f"{'NamePrefix':<30} {'Status':<8} {'Time(s)':>8} {'Cached':>7}"]
+    for r in report['Targets']:
+        status = 'ok' if r['Ok'] else 'FAILED'
+        lines.append(f"{r['NamePrefix']:<30} {status:<8} {r['Duration']:>8.2f} {r.get('NCached', '-'):>7}")
+    lines.append(f"\n{report['NOk']} ok, {report['NFailed']} failed; wall time {report['WallTime']:.2f}s vs "
+                 f"{report['SerialTime']:.2f}s one stack at a time (slowest {report['SlowestTarget']:.2f}s, "
+                 f"median {report['MedianTarget']:.2f}s)")
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('plan')
+    parser.add_argument('targets')
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--json', action='store_true', help="print the report as json")
+    args = parser.parse_args()
+
+    with open(args.plan) as f:
+        _plan = json.load(f)
+    with open(args.targets) as f:
+        _targets = parse_targets(json.load(f))
+
+    _report = run_fanout(_plan, _targets, workers=args.workers, dry_run=args.dry_run)
+    print(json.dumps(_report, indent=2) if args.json else format_report(_report))
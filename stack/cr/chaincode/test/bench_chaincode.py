@@ -0,0 +1,361 @@
+'''Benchmarks for the chaincode engine: synthetic pSmartContracts plans run through mk_contract on PyEVM.
+
+Each plan runs the way chaincode_handler runs it (compile_plan, prefetch, then the mk_contract fold) against a
+StandinNode (eth_tester over HTTP, see standin.py) and an in-memory SSM, twice: `cold`, on a fresh chain and SSM, and
+`cached`, again on the same chain and SSM, where every op should be skipped. Each plan gets an empty artifact cache, so
+`cold` fetches every remote artifact and `cached` none. For each run we record wall time, JSON-RPC
+calls by method, SSM calls by API and peak (python) memory, and compare them with a stored baseline; the exit status is
+1 if any metric regressed by more than its tolerance, or if there is no baseline.
+
+The call counts are the same on any machine, so their baseline is committed (bench_chaincode_baseline.json). Wall time
+and memory aren't: --update-baseline also keeps them in bench_chaincode_baseline.local.json (not committed), and they
+are only compared once that exists.
+
+usage: python3 test/bench_chaincode.py [--shapes independent,fanout,chain,calls,send,stack] [--sizes 4,16]
+                                       [--latency 0] [--block-interval S] [--update-baseline] [--json]'''
+
+import argparse
+import functools
+import hashlib
+import json
+import sys, os
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+sys.path.insert(0, os.path.join(main_dir, 'test'))
+
+import logging
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+from web3 import Web3
+from eth_account import Account
+
+import lib
+import chaincode
+import artifacts
+from chaincode import mk_contract, compile_plan, get_next_nonce
+from rpc import JsonRpcClient
+from standin import StandinNode, TesterBackend
+
+log = logging.getLogger('BenchChaincode')
+
+NAME_PREFIX = 'bench'
+BASELINE = os.path.join(main_dir, 'test', 'bench_chaincode_baseline.json')
+LOCAL_BASELINE = os.path.join(main_dir, 'test', 'bench_chaincode_baseline.local.json')
+# allowed increase over the baseline: relative, and an absolute slack for small values
+TOLERANCES = OrderedDict([('WallS', (0.25, 0.05)), ('PeakMemMb', (0.20, 0.5)), ('RpcCalls', (0.0, 0)),
+                          ('SsmCalls', (0.0, 0))])
+COUNTS = ['RpcCalls', 'SsmCalls']  # the metrics that don't depend on the machine
+SHAPES = ['independent', 'fanout', 'chain', 'calls', 'send', 'stack']
+
+
+class LocalSsm:
+    '''A moto-style in-memory SSM client with the parameter APIs lib and chaincode use. Errors are raised as the
+    same-named boto exceptions would be, write events fire like botocore's (lib uses them to keep its snapshot
+    honest), and calls are counted by API.'''
+
+    class exceptions:
+        class ParameterNotFound(Exception):
+            pass
+
+        class ParameterAlreadyExists(Exception):
+            pass
+
+    class _Events:
+        def __init__(self):
+            self.handlers = {}
+
+        def register(self, event, handler):
+            self.handlers.setdefault(event, []).append(handler)
+
+    def __init__(self):
+        self.params = {}
+        self.calls = Counter()
+        self.meta = type('Meta', (), {})()
+        self.meta.events = self._Events()
+
+    def _call(self, api, params):
+        self.calls[api] += 1
+        for h in self.meta.events.handlers.get(f'provide-client-params.ssm.{api}', []):
+            h(params=params)
+
+    def _param(self, name):
+        if name not in self.params:
+            raise self.exceptions.ParameterNotFound(f"ParameterNotFound: {name}")
+        (value, ty, version) = self.params[name]
+        return {'Name': name, 'Type': ty, 'Value': value, 'Version': version}
+
+    def get_parameter(self, Name, WithDecryption=False):
+        self._call('GetParameter', {'Name': Name})
+        return {'Parameter': self._param(Name)}
+
+    def get_parameters(self, Names, WithDecryption=False):
+        self._call('GetParameters', {'Names': Names})
+        return {'Parameters': [self._param(n) for n in Names if n in self.params],
+                'InvalidParameters': [n for n in Names if n not in self.params]}
+
+    def put_parameter(self, Name, Value, Type='String', Description='', Overwrite=False):
+        self._call('PutParameter', {'Name': Name})
+        if Name in self.params and not Overwrite:
+            raise self.exceptions.ParameterAlreadyExists(f"ParameterAlreadyExists: {Name}")
+        version = self.params[Name][2] + 1 if Name in self.params else 1
+        self.params[Name] = (Value, Type, version)
+        return {'Version': version}
+
+    def delete_parameter(self, Name):
+        self._call('DeleteParameter', {'Name': Name})
+        self._param(Name)
+        del self.params[Name]
+        return {}
+
+    def delete_parameters(self, Names):
+        self._call('DeleteParameters', {'Names': Names})
+        deleted = [n for n in Names if self.params.pop(n, None) is not None]
+        return {'DeletedParameters': deleted, 'InvalidParameters': [n for n in Names if n not in deleted]}
+
+    def describe_parameters(self, ParameterFilters=(), MaxResults=50, NextToken=''):
+        self._call('DescribeParameters', {})
+        prefixes = [v for f in ParameterFilters if f['Option'] == 'BeginsWith' for v in f['Values']]
+        names = sorted(n for n in self.params if not prefixes or any(n.startswith(p) for p in prefixes))
+        start = int(NextToken or 0)
+        page = names[start:start + MaxResults]
+        ret = {'Parameters': [{'Name': n, 'Type': self.params[n][1]} for n in page]}
+        if len(page) == MaxResults:
+            ret['NextToken'] = str(start + MaxResults)
+        return ret
+
+
+def use_local_ssm() -> LocalSsm:
+    ssm = LocalSsm()
+    lib.ssm = chaincode.ssm = ssm
+    for op in ['PutParameter', 'DeleteParameter', 'DeleteParameters']:
+        ssm.meta.events.register(f'provide-client-params.ssm.{op}', lib._drop_from_ssm_snapshot)
+    return ssm
+
+
+# plans
+
+
+def _remote(name, bin_name, **kwargs):
+    '''A deploy of bytecode/<bin_name>.bin under any name, served from a file:// URL as a remote artifact.'''
+    path = os.path.join(main_dir, 'bytecode', f'{bin_name}.bin')
+    with open(path, 'rb') as f:
+        sha256 = hashlib.sha256(f.read()).hexdigest()
+    return dict({'Name': name, 'Type': 'deploy', 'URL': f'file://{path}', 'Sha256': sha256}, **kwargs)
+
+
+def _addr(i):
+    # digits only, so it's the same checksummed or not; and clear of the precompiles (0x01..0x09), which a plain
+    # transfer can't pay
+    return '0x%040d' % (i + 1000)
+
+
+def mk_plan(shape: str, n: int) -> list:
+    if shape == 'independent':
+        # n deploys that don't depend on each other
+        return [_remote(f'm{i}', 'membership') for i in range(n)]
+    if shape == 'fanout':
+        # one contract, n - 1 txs against it
+        return [_remote('m', 'membership')] + [
+            {'Name': f'admin{i}', 'Type': 'calltx', 'Function': '$m.addAdmin', 'Inputs': [f'address:{_addr(i)}']}
+            for i in range(n - 1)]
+    if shape == 'chain':
+        # each deploy is then made an admin of the one before it
+        plan = [_remote('m0', 'membership')]
+        for i in range(1, n // 2 + 1):
+            plan += [_remote(f'm{i}', 'membership'),
+                     {'Name': f'admin{i}', 'Type': 'calltx', 'Function': f'$m{i - 1}.addAdmin', 'Inputs': [f'$m{i}']}]
+        return plan
+    if shape == 'calls':
+        return [_remote('m', 'membership')] + [
+            {'Name': f'is-admin{i}', 'Type': 'call', 'Function': '$m.isAdmin', 'Inputs': [f'address:{_addr(i)}'],
+             'ReturnTypes': ['bool']} for i in range(n - 1)]
+    if shape == 'send':
+        return [{'Name': 'fund', 'Type': 'send', 'Recipients': [_addr(i) for i in range(n)], 'Value': 1000}]
+    if shape == 'stack':
+        # the plan test_mk_contract runs, which is the one sv-chaincode-loader.yaml deploys (its size is fixed)
+        return [
+            {'Name': 'membership', 'Type': 'deploy'},
+            {'Name': 'membership-add-admin', 'Type': 'calltx', 'Function': '$membership.addAdmin',
+             'Inputs': ['_members']},
+            {'Name': 'bblib-v7', 'Type': 'deploy'},
+            {'Name': 'bbfarm', 'Type': 'deploy',
+             'Libraries': {'__./contracts/BBLib.v7.sol:BBLibV7______': '$bblib-v7'}},
+            {'Name': 'sv-payments', 'Type': 'deploy', 'Inputs': ['^self']},
+            {'Name': 'sv-backend', 'Type': 'deploy'},
+            _remote('sv-comm-auction', 'sv-comm-auction'),
+            {'Name': 'sv-index', 'Type': 'deploy',
+             'Inputs': ['$sv-backend', '$sv-payments', '^addr-ones', '$bbfarm', '$sv-comm-auction']},
+            {'Name': 'ix-backend-perms', 'Type': 'calltx', 'Function': '$sv-backend.setPermissions',
+             'Inputs': ['$sv-index', 'bool:true']},
+            {'Name': 'ix-payments-perms', 'Type': 'calltx', 'Function': '$sv-payments.setPermissions',
+             'Inputs': ['$sv-index', 'bool:true']},
+            {'Name': 'ix-bbfarm-perms', 'Type': 'calltx', 'Function': '$bbfarm.setPermissions',
+             'Inputs': ['$sv-index', 'bool:true']},
+            {'Name': 'ix-mk-democ', 'Type': 'calltx', 'Function': '$sv-index.dInit', 'Value': 1,
+             'Inputs': ['$membership', 'bool:true']},
+            {'Name': 'democ-hash', 'Type': 'call', 'Function': '$sv-backend.getGDemoc', 'Inputs': ['uint256:0'],
+             'ReturnTypes': ['bytes32']},
+            {'Name': 'democ-add-admin', 'Type': 'calltx', 'Function': '$sv-index.setDEditor',
+             'Inputs': ['$democ-hash', '_members', 'bool:true']},
+            {'Name': 'fund-services', 'Type': 'send', 'Recipients': ['_members', '^addr-ones'],
+             'Values': ['uint256:1000', '2000']},
+            {'Name': 'fund-voters', 'Type': 'send', 'Recipients': [_addr(i) for i in range(50)], 'Value': 10 ** 9},
+        ]
+    raise ValueError(f"unknown plan shape {shape}; expected one of {SHAPES}")
+
+
+# running
+
+
+def run_plan(plan: list, latency=0.0, block_interval=None) -> OrderedDict:
+    '''`cold` and `cached` metrics for one plan, on a chain, SSM and artifact cache of its own.'''
+    artifacts.CACHE_DIR = tempfile.mkdtemp(prefix='sv-bench-artifacts-')
+    artifacts._inflight.clear()
+    ssm = use_local_ssm()
+    acct = Account.privateKeyToAccount(Web3.sha3(text='bench-chaincode'))
+    ssm.put_parameter(Name=lib.gen_ssm_service_pks(NAME_PREFIX), Value=json.dumps({'members': _addr(999)}))
+    backend = TesterBackend()
+    backend.fund(acct.address)
+    node = StandinNode(backend, latency=latency, block_interval=block_interval).start()
+    w3 = Web3(Web3.HTTPProvider(node.url))
+    # PyEVM mines each tx as it arrives, so a batch of sends can take longer than a real node would to answer; a
+    # timeout (and retry) would make the call counts vary
+    rpc = JsonRpcClient(node.url, timeout=300)
+    ret = OrderedDict()
+    try:
+        for phase in ('cold', 'cached'):
+            node.calls.clear()
+            node.n_requests = 0
+            ssm.calls.clear()
+            tracemalloc.start()
+            start = time.perf_counter()
+            compiled = compile_plan(plan)
+            artifacts.prefetch(compiled)
+            functools.reduce(mk_contract(NAME_PREFIX, w3, acct, None, nonce=get_next_nonce(rpc, acct), rpc=rpc),
+                             compiled, dict())
+            wall = time.perf_counter() - start
+            (_, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            stats = node.stats()
+            ret[phase] = OrderedDict([
+                ('WallS', round(wall, 3)), ('PeakMemMb', round(peak / 2 ** 20, 2)),
+                ('RpcCalls', sum(stats['Calls'].values())), ('SsmCalls', sum(ssm.calls.values())),
+                ('RpcRequests', stats['Requests']), ('RpcByMethod', dict(sorted(stats['Calls'].items()))),
+                ('SsmByApi', dict(sorted(ssm.calls.items())))])
+    finally:
+        node.stop()
+    return ret
+
+
+def compare(results: dict, baseline: dict) -> list:
+    '''Regressions past TOLERANCES, as messages.'''
+    regressions = []
+    for (key, metrics) in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        for (m, (rel, slack)) in TOLERANCES.items():
+            if m in old and metrics[m] > old[m] * (1 + rel) + slack:
+                regressions.append(f"{key} {m}: {metrics[m]} vs baseline {old[m]} (allowed +{rel:.0%} +{slack})")
+    return regressions
+
+
+def split_baseline(results: dict) -> (dict, dict):
+    '''(call counts, machine-local metrics) of each result, for the committed and the local baseline.'''
+    counts = {k: {m: v[m] for m in COUNTS} for (k, v) in results.items()}
+    local = {k: {m: v[m] for m in TOLERANCES if m not in COUNTS} for (k, v) in results.items()}
+    return counts, local
+
+
+def load_baseline(path: str, local_path: str) -> dict:
+    '''The committed baseline with the local one (if any) on top: {'Config': ..., 'Results': ..., 'Local': bool}.'''
+    with open(path) as f:
+        baseline = json.load(f)
+    baseline['Local'] = os.path.exists(local_path)
+    if baseline['Local']:
+        with open(local_path) as f:
+            local = json.load(f)
+        for (key, metrics) in local['Results'].items():
+            baseline['Results'].setdefault(key, {}).update(metrics)
+    return baseline
+
+
+def update_baseline(path: str, config: dict, results: dict):
+    '''Store `results` in the baseline at `path`, keeping entries for plans that weren't run.'''
+    baseline = {'Config': config, 'Results': {}}
+    if os.path.exists(path):
+        with open(path) as f:
+            baseline['Results'] = json.load(f)['Results']
+    baseline['Results'].update(results)
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2)
+        f.write('\n')
+
+
+def run_suite(shapes, sizes, latency=0.0, block_interval=None) -> OrderedDict:
+    results = OrderedDict()
+    for shape in shapes:
+        for n in ([0] if shape == 'stack' else sizes):
+            name = shape if shape == 'stack' else f"{shape}-{n}"
+            for (phase, metrics) in run_plan(mk_plan(shape, n), latency, block_interval).items():
+                results[f"{name}/{phase}"] = metrics
+                print(f"{name + '/' + phase:<24} {metrics['WallS']:>8.2f}s {metrics['PeakMemMb']:>8.2f}MB "
+                      f"rpc {metrics['RpcCalls']:>5} ({metrics['RpcRequests']} requests) ssm {metrics['SsmCalls']:>5}",
+                      file=sys.stderr)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shapes', default=','.join(SHAPES))
+    parser.add_argument('--sizes', default='4,16', help="ops per plan (the stack plan has a fixed size)")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each RPC response")
+    parser.add_argument('--block-interval', type=float, help="seconds between blocks (default: mine each tx)")
+    parser.add_argument('--baseline', default=BASELINE, help="call counts (committed)")
+    parser.add_argument('--local-baseline', default=LOCAL_BASELINE, help="wall time and memory on this machine")
+    parser.add_argument('--update-baseline', action='store_true', help="store these results as the new baselines")
+    parser.add_argument('--json', action='store_true', help="print the results as json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    os.chdir(main_dir)  # local bytecode is read from bytecode/<name>.bin
+    config = {'Latency': args.latency, 'BlockInterval': args.block_interval}
+    results = run_suite(args.shapes.split(','), [int(s) for s in args.sizes.split(',')], args.latency,
+                        args.block_interval)
+    if args.json:
+        print(json.dumps({'Config': config, 'Results': results}, indent=2))
+
+    if args.update_baseline:
+        (counts, local) = split_baseline(results)
+        update_baseline(args.local_baseline, config, local)
+        print(f"baseline written to {args.local_baseline}", file=sys.stderr)
+        # counts only repeat exactly with txs mined on arrival and no latency, which is how the committed ones are taken
+        if os.path.exists(args.baseline) and load_baseline(args.baseline, '')['Config'] != config:
+            print(f"{args.baseline} was taken with another config; not updating it", file=sys.stderr)
+        else:
+            update_baseline(args.baseline, config, counts)
+            print(f"baseline written to {args.baseline}", file=sys.stderr)
+        sys.exit(0)
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}; run with --update-baseline to take one", file=sys.stderr)
+        sys.exit(1)
+    baseline = load_baseline(args.baseline, args.local_baseline)
+    if not baseline['Local']:
+        print(f"no local baseline at {args.local_baseline}, so only call counts are compared; run with "
+              f"--update-baseline to take one", file=sys.stderr)
+    if baseline.get('Config') != config:
+        print(f"warning: baseline was taken with {baseline.get('Config')}, not {config}", file=sys.stderr)
+    regressions = compare(results, baseline['Results'])
+    for r in regressions:
+        print(f"REGRESSION {r}", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
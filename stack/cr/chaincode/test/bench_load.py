@@ -0,0 +1,375 @@
+'''Load generator for the chain: sends a mix of txs from the service keys at a target rate and measures what the
+network accepts -- included txs/s, gas per block and inclusion latency (from broadcast to the block being seen).
+
+Tx kinds: `transfer` (1 wei to a fresh address) and `deploy` (a tiny contract) from the publish key, `setMember` on
+Membership from the members key, and `ballot` (a signed submitProxyVote on bbfarm) from the castvote key.
+
+usage:
+  # in-process eth_tester (instant mining, so latencies are ~0; a baseline for the tool itself)
+  python3 test/bench_load.py --tester --rate 20 --duration 30 --mix transfer=1,setMember=1,deploy=0.1
+  # a local dev chain, every kind sent from one funded key
+  python3 test/bench_load.py --url http://127.0.0.1:8545 --key 0x<privkey> --mix transfer=1,setMember=1 --json
+  # a live stack: service keys, chain id and contract addresses come from SSM
+  python3 test/bench_load.py --url http://<public-node>:8545 --name-prefix <prefix> --ballot-id 0x<id> \\
+      --rate 100 --duration 120 --mix setMember=1,ballot=1 --json > report.json'''
+
+import argparse
+import json
+import random
+import sys, os
+import time
+from collections import Counter, OrderedDict
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+# ballots are signed by the castvote API's own code
+castvote_dir = os.path.join(one_up_dir, '../app/castvote')
+sys.path.insert(0, castvote_dir)
+sys.path.insert(0, os.path.join(castvote_dir, 'api'))
+sys.path.insert(0, os.path.join(castvote_dir, '../common'))
+
+from eth_abi import encode_abi
+from eth_account import Account
+from eth_utils import keccak
+
+import boto3
+boto3.setup_default_session(region_name=os.environ.get('AWS_DEFAULT_REGION', 'ap-southeast-2'))
+from lib import get_ssm_param_with_enc, get_ssm_param_no_enc, gen_ssm_nodekey_service, gen_ssm_networkid, \
+    gen_ssm_sc_addr, SVC_CHAINCODE, SVC_MEMBERS, SVC_CASTVOTE
+from rpc import JsonRpcClient, Web3Rpc, RpcError
+from txpipe import NonceStream, sign_txs, wait_for_receipts
+from api.verify import sign_ballot
+
+KINDS = ['transfer', 'deploy', 'setMember', 'ballot']
+KIND_SENDER = {'transfer': SVC_CHAINCODE, 'deploy': SVC_CHAINCODE, 'setMember': SVC_MEMBERS, 'ballot': SVC_CASTVOTE}
+KIND_GAS = {'transfer': 21000, 'deploy': 100000, 'setMember': 150000, 'ballot': 150000}
+
+# init code returning a 10 byte runtime that returns 42
+TINY_CONTRACT = '0x600a600c600039600a6000f3602a60005260206000f3'
+SET_MEMBER_SELECTOR = keccak(text='setMember(address,uint32,uint48,uint48)')[:4]
+SUBMIT_PROXY_VOTE_SELECTOR = keccak(text='submitProxyVote(bytes32[5],bytes)')[:4]
+MAX_UINT48 = 2 ** 48 - 1
+
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))] if xs else None
+
+
+def summary_ms(secs):
+    return {'p50': _ms(percentile(secs, 0.5)), 'p99': _ms(percentile(secs, 0.99)), 'max': _ms(max(secs, default=None))}
+
+
+def _ms(s):
+    return None if s is None else round(s * 1000, 1)
+
+
+def _hexstr(v) -> str:
+    return v if type(v) is str else '0x' + bytes(v).hex()
+
+
+def parse_mix(mix: str) -> OrderedDict:
+    ret = OrderedDict()
+    for part in mix.split(','):
+        (kind, weight) = part.split('=')
+        if kind not in KINDS:
+            raise ValueError(f"unknown tx kind {kind}; expected one of {KINDS}")
+        ret[kind] = float(weight)
+    return ret
+
+
+# tx builders
+
+
+class Voters:
+    '''A pool of voter keys signing bbfarm proxy votes, each with its own sequence.'''
+
+    def __init__(self, ballot_id: int, n=64, seed=0):
+        rng = random.Random(seed)
+        self.ballot_id = '0x{:064x}'.format(ballot_id)
+        self.keys = [rng.getrandbits(256).to_bytes(32, 'big') for _ in range(n)]
+        self.seqs = [0] * n
+        self.i = 0
+
+    def next_proxy_req(self, vote: int) -> list:
+        i = self.i = (self.i + 1) % len(self.keys)
+        self.seqs[i] += 1
+        ballot = sign_ballot(self.keys[i], self.ballot_id, '0x{:064x}'.format(vote), self.seqs[i])
+        return [bytes.fromhex(w[2:]) for w in ballot.proxy_req]
+
+
+def mk_tx(kind: str, rng: random.Random, membership=None, bbfarm=None, voters: Voters = None) -> dict:
+    tx = {'value': 0, 'gas': KIND_GAS[kind], 'gasPrice': 1}
+    if kind == 'transfer':
+        return dict(tx, to=_hexstr(rng.getrandbits(160).to_bytes(20, 'big')), value=1, data='0x')
+    if kind == 'deploy':
+        return dict(tx, data=TINY_CONTRACT)
+    if kind == 'setMember':
+        addr = _hexstr(rng.getrandbits(160).to_bytes(20, 'big'))
+        return dict(tx, to=membership, data=SET_MEMBER_SELECTOR + encode_abi(
+            ['address', 'uint32', 'uint48', 'uint48'], [addr, 1, 0, MAX_UINT48]))
+    if kind == 'ballot':
+        return dict(tx, to=bbfarm, data=SUBMIT_PROXY_VOTE_SELECTOR + encode_abi(
+            ['bytes32[5]', 'bytes'], [voters.next_proxy_req(rng.randrange(1, 4)), b'']))
+    raise ValueError(kind)
+
+
+# accounts and targets
+
+
+def accts_from_ssm(name_prefix: str):
+    '''Service accounts, chain id, and the Membership and bbfarm addresses of a live stack.'''
+    accts = {svc: Account.privateKeyToAccount(get_ssm_param_with_enc(gen_ssm_nodekey_service(name_prefix, svc)))
+             for svc in (SVC_CHAINCODE, SVC_MEMBERS, SVC_CASTVOTE)}
+    chainid = int(get_ssm_param_no_enc(gen_ssm_networkid(name_prefix)))
+    return accts, chainid, get_ssm_param_no_enc(gen_ssm_sc_addr(name_prefix, 'membership')), \
+        get_ssm_param_no_enc(gen_ssm_sc_addr(name_prefix, 'bbfarm'))
+
+
+def tester_rpc():
+    '''A Web3Rpc over an in-process eth_tester chain, and one funded account per service.'''
+    from web3 import Web3, EthereumTesterProvider
+    from eth_tester import PyEVMBackend, EthereumTester
+    backend = PyEVMBackend(genesis_parameters=PyEVMBackend._generate_genesis_params({'gas_limit': 8000000}))
+    w3 = Web3(EthereumTesterProvider(ethereum_tester=EthereumTester(backend=backend)))
+    accts = {}
+    for svc in (SVC_CHAINCODE, SVC_MEMBERS, SVC_CASTVOTE):
+        accts[svc] = Account.privateKeyToAccount(keccak(text=f'bench-load-{svc}'))
+        w3.eth.sendTransaction({'to': accts[svc].address, 'from': w3.eth.accounts[0], 'value': 10 ** 21})
+    return Web3Rpc(w3), accts
+
+
+def deploy_membership(rpc, acct, chainid) -> str:
+    '''Deploy Membership from `acct`, which makes it an admin that can call setMember.'''
+    with open(os.path.join(main_dir, 'bytecode', 'membership.bin')) as f:
+        bytecode = '0x' + f.read().strip()
+    [stx] = sign_txs(acct, [{'data': bytecode, 'gas': 3000000, 'gasPrice': 1, 'value': 0}],
+                     NonceStream.from_chain(rpc, acct.address), chainid=chainid)
+    rpc.send_raw_transaction(stx.raw)
+    [r] = wait_for_receipts(rpc, [stx.txid], timeout=120, poll_rate=0.2)
+    return r['contractAddress']
+
+
+# the run
+
+
+class LoadRun:
+    '''Sends pre-signed txs at `rate` per second and watches new blocks for them, in one loop: polling between sends
+    keeps the latency resolution at about `tick` and works on eth_tester, which isn't thread safe.
+
+    A rejected tx leaves a gap in its sender's nonces, so nothing that sender sends after it can be mined. The sender
+    is stopped there: its remaining txs aren't sent, and any of its later txs already sent are counted as stranded
+    rather than waited for.'''
+
+    def __init__(self, rpc, signed, rate: float, duration: float, window=4096, tick=0.05, drain=60.0,
+                 batch_size=100, check_status=True):
+        self.rpc = rpc
+        self.signed = signed  # [(kind, sender address, SignedTx)] in send order
+        self.rate = rate
+        self.duration = duration
+        self.window = window
+        self.tick = tick
+        self.drain = drain
+        self.batch_size = batch_size
+        self.check_status = check_status
+        self.sent_at = {}  # txid -> (kind, sender, monotonic time)
+        self.in_flight = Counter()  # sender -> sent but not yet seen in a block
+        self.included = {}  # txid -> (kind, latency)
+        self.rejected = Counter()
+        self.stopped = {}  # sender -> nonce of its first rejected tx
+        self.not_sent = Counter()  # sender -> txs not sent because it was stopped
+        self.stranded = set()  # txids sent after a gap in their sender's nonces
+        self.blocks = []
+        self.receipts = {}
+        self.last_block = None
+
+    def _send_due(self, elapsed: float, i: int) -> int:
+        due = min(len(self.signed), int(self.rate * elapsed)) - i
+        batch = []
+        n = 0
+        for (kind, sender, stx) in self.signed[i:i + max(0, due)]:
+            if sender in self.stopped:
+                self.not_sent[sender] += 1
+                n += 1
+                continue
+            # don't overflow the node's per-sender queue; the offered rate drops instead
+            if self.in_flight[sender] >= self.window:
+                break
+            batch.append((kind, sender, stx))
+            self.in_flight[sender] += 1
+            n += 1
+        while batch:
+            (chunk, batch) = (batch[:self.batch_size], batch[self.batch_size:])
+            now = time.monotonic()
+            results = self.rpc.batch([('eth_sendRawTransaction', [_hexstr(stx.raw)]) for (_, _, stx) in chunk],
+                                     raise_errors=False)
+            for ((kind, sender, stx), r) in zip(chunk, results):
+                if isinstance(r, RpcError):
+                    self.rejected[r.message] += 1
+                    self.in_flight[sender] -= 1
+                    self.stopped.setdefault(sender, stx.nonce)
+                else:
+                    self.sent_at[stx.txid] = (kind, sender, now)
+                    if sender in self.stopped:
+                        self.stranded.add(stx.txid)
+            # a stopped sender's txs still to come in this call are after its gap too
+            for (_, sender, _) in batch:
+                if sender in self.stopped:
+                    self.not_sent[sender] += 1
+                    self.in_flight[sender] -= 1
+            batch = [b for b in batch if b[1] not in self.stopped]
+        return i + n
+
+    def _poll_blocks(self):
+        head = self.rpc.block_number()
+        if self.last_block is None:
+            self.last_block = head
+        while self.last_block < head:
+            self.last_block += 1
+            b = self.rpc.get_block(self.last_block)
+            now = time.monotonic()
+            txids = [_hexstr(t) for t in b['transactions']]
+            ours = [t for t in txids if t in self.sent_at]
+            for t in ours:
+                (kind, sender, sent) = self.sent_at[t]
+                self.included[t] = (kind, now - sent)
+                self.in_flight[sender] -= 1
+            if ours and self.check_status:
+                for (t, r) in zip(ours, self.rpc.get_transaction_receipts(ours)):
+                    self.receipts[t] = r
+            self.blocks.append({'Number': b['number'], 'Timestamp': b['timestamp'], 'GasUsed': b['gasUsed'],
+                                'GasLimit': b['gasLimit'], 'NTxs': len(txids), 'NOurs': len(ours), 'SeenAt': now})
+
+    def run(self):
+        self._poll_blocks()
+        self.start = time.monotonic()
+        i = 0
+        while True:
+            elapsed = time.monotonic() - self.start
+            waiting = len(self.sent_at) - len(self.included) - len(self.stranded - set(self.included))
+            if elapsed > self.duration and (waiting == 0 or elapsed > self.duration + self.drain):
+                break
+            if elapsed <= self.duration:
+                i = self._send_due(elapsed, i)
+            self._poll_blocks()
+            time.sleep(max(0.0, self.tick - (time.monotonic() - self.start - elapsed)))
+        self.end = time.monotonic()
+        return self.report()
+
+    def report(self) -> dict:
+        lats = [lat for (_, lat) in self.included.values()]
+        last_seen = max((b['SeenAt'] for b in self.blocks if b['NOurs']), default=self.start)
+        failed = {t for (t, r) in self.receipts.items() if r is not None and r.get('status', 1) == 0}
+        by_kind = {}
+        for kind in sorted({k for (k, _, _) in self.sent_at.values()}):
+            ids = [t for (t, (k, _, _)) in self.sent_at.items() if k == kind]
+            gas = [self.receipts[t]['gasUsed'] for t in ids if self.receipts.get(t) is not None]
+            by_kind[kind] = {'Sent': len(ids), 'Included': sum(t in self.included for t in ids),
+                             'Failed': sum(t in failed for t in ids),
+                             'GasPerTx': round(sum(gas) / len(gas)) if gas else None,
+                             'InclusionMs': summary_ms([self.included[t][1] for t in ids if t in self.included])}
+        blocks = [b for b in self.blocks if b['SeenAt'] >= self.start]
+        gas_used = [b['GasUsed'] for b in blocks]
+        intervals = [b2['Timestamp'] - b1['Timestamp'] for (b1, b2) in zip(blocks, blocks[1:])]
+        return {
+            'TargetTps': self.rate, 'Duration': self.duration, 'Elapsed': round(self.end - self.start, 2),
+            'Sent': len(self.sent_at), 'Rejected': sum(self.rejected.values()),
+            'NotSent': len(self.signed) - len(self.sent_at) - sum(self.rejected.values()),
+            'RejectReasons': dict(self.rejected), 'StoppedSenders': {a: {'AtNonce': n, 'NotSent': self.not_sent[a]}
+                                                                     for (a, n) in self.stopped.items()},
+            'Included': len(self.included), 'Failed': len(failed),
+            'Stranded': len(self.stranded - set(self.included)),
+            'Pending': len(self.sent_at) - len(self.included) - len(self.stranded - set(self.included)),
+            'OfferedTps': round(len(self.sent_at) / min(self.duration, self.end - self.start), 2),
+            'AcceptedTps': round(len(self.included) / max(last_seen - self.start, 1e-9), 2),
+            'InclusionMs': summary_ms(lats),
+            'ByKind': by_kind,
+            'Blocks': {'N': len(blocks), 'IntervalS': round(sum(intervals) / len(intervals), 2) if intervals else None,
+                       'GasLimit': blocks[-1]['GasLimit'] if blocks else None,
+                       'GasUsed': {'p50': percentile(gas_used, 0.5), 'max': max(gas_used, default=None)},
+                       'Fill': round(sum(b['GasUsed'] / b['GasLimit'] for b in blocks) / len(blocks), 4)
+                       if blocks else None,
+                       'MaxTxs': max((b['NTxs'] for b in blocks), default=None)},
+        }
+
+
+def prepare(rpc, accts, chainid, mix, rate, duration, membership=None, bbfarm=None, ballot_id=None, seed=0):
+    '''Every tx the run will send, signed up front so signing speed doesn't limit the offered rate.'''
+    if 'setMember' in mix and membership is None:
+        membership = deploy_membership(rpc, accts[SVC_MEMBERS], chainid)
+    if 'ballot' in mix and (bbfarm is None or ballot_id is None):
+        raise ValueError("ballot txs need a bbfarm address and --ballot-id")
+    rng = random.Random(seed)
+    voters = Voters(ballot_id, seed=seed) if 'ballot' in mix else None
+    kinds = rng.choices(list(mix.keys()), weights=list(mix.values()), k=int(rate * duration))
+    # by address: with --key every service is the same account
+    nonces = {a.address: NonceStream.from_chain(rpc, a.address) for a in accts.values()}
+    signed = []
+    for kind in kinds:
+        svc = KIND_SENDER[kind]
+        tx = mk_tx(kind, rng, membership=membership, bbfarm=bbfarm, voters=voters)
+        [stx] = sign_txs(accts[svc], [tx], nonces[accts[svc].address], chainid=chainid)
+        signed.append((kind, accts[svc].address, stx))
+    return signed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help="a node's JSON-RPC endpoint")
+    target.add_argument('--tester', action='store_true', help="an in-process eth_tester chain")
+    keys = parser.add_mutually_exclusive_group()
+    keys.add_argument('--name-prefix', help="load service keys, chain id and contract addresses from this stack's SSM")
+    keys.add_argument('--key', help="send every kind from this funded key (a local dev chain)")
+    parser.add_argument('--chainid', type=int)
+    parser.add_argument('--membership', help="Membership address (default: SSM, or deploy one)")
+    parser.add_argument('--bbfarm', help="bbfarm address (default: SSM)")
+    parser.add_argument('--ballot-id', help="an open ballot on bbfarm, for ballot txs")
+    parser.add_argument('--mix', default='transfer=1,setMember=1', help="kind=weight,... of " + ','.join(KINDS))
+    parser.add_argument('--rate', type=float, default=20, help="target txs/s")
+    parser.add_argument('--duration', type=float, default=30, help="seconds to send for")
+    parser.add_argument('--drain', type=float, default=60, help="seconds to wait for the last txs afterwards")
+    parser.add_argument('--window', type=int, default=4096, help="max unmined txs per sender")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="print the report as json")
+    args = parser.parse_args()
+
+    (chainid, membership, bbfarm) = (args.chainid, args.membership, args.bbfarm)
+    if args.tester:
+        (rpc, accts) = tester_rpc()
+    else:
+        rpc = JsonRpcClient(args.url)
+        if args.name_prefix:
+            (accts, chainid, ssm_membership, ssm_bbfarm) = accts_from_ssm(args.name_prefix)
+            (membership, bbfarm) = (membership or ssm_membership, bbfarm or ssm_bbfarm)
+        elif args.key:
+            acct = Account.privateKeyToAccount(args.key)
+            accts = {svc: acct for svc in (SVC_CHAINCODE, SVC_MEMBERS, SVC_CASTVOTE)}
+        else:
+            parser.error("--url needs --name-prefix or --key")
+        if chainid is None:
+            chainid = int(rpc.request('eth_chainId'), 16)
+
+    mix = parse_mix(args.mix)
+    ballot_id = int(args.ballot_id, 16) if args.ballot_id else None
+    signed = prepare(rpc, accts, chainid, mix, args.rate, args.duration, membership=membership, bbfarm=bbfarm,
+                     ballot_id=ballot_id, seed=args.seed)
+    report = LoadRun(rpc, signed, args.rate, args.duration, window=args.window, drain=args.drain).run()
+    report.update({'Target': 'eth_tester' if args.tester else args.url, 'Mix': mix})
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"target {report['Target']}: offered {report['OfferedTps']} tx/s (of {args.rate}), "
+              f"accepted {report['AcceptedTps']} tx/s; {report['Included']}/{report['Sent']} included, "
+              f"{report['Failed']} failed, {report['Rejected']} rejected, {report['Pending']} pending")
+        for (addr, stop) in report['StoppedSenders'].items():
+            print(f"  {addr} stopped at nonce {stop['AtNonce']} after a rejection: {stop['NotSent']} txs not sent")
+        print(f"inclusion ms: {report['InclusionMs']}")
+        for (kind, k) in report['ByKind'].items():
+            print(f"  {kind:<10} {k['Included']:>6}/{k['Sent']:<6} gas/tx {k['GasPerTx']}  inclusion ms "
+                  f"{k['InclusionMs']}")
+        print(f"blocks: {report['Blocks']}")
@@ -0,0 +1,74 @@
+'''Compare the lean JsonRpcClient against the default Web3.HTTPProvider path for the chaincode hot methods.
+
+usage: python3 test/bench_rpc.py http://<public-node>:8545 [-n 500] [--json]'''
+
+import argparse
+import json
+import sys, os
+import time
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+
+from web3 import Web3
+
+from rpc import JsonRpcClient, JSON_CODEC
+
+MISSING_TXID = '0x' + 'ab' * 32
+ZERO_ADDR = '0x0000000000000000000000000000000000000000'
+
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))]
+
+
+def run(name, f, n):
+    lats = []
+    start = time.time()
+    for _ in range(n):
+        t = time.time()
+        f()
+        lats.append(time.time() - t)
+    total = time.time() - start
+    return {'name': name, 'n': n, 'rps': n / total, 'p50_ms': percentile(lats, 0.5) * 1000,
+            'p99_ms': percentile(lats, 0.99) * 1000}
+
+
+def bench(url, n, batch_size=100):
+    w3 = Web3(Web3.HTTPProvider(url))
+    rpc = JsonRpcClient(url)
+    results = [
+        run('web3 getTransactionReceipt', lambda: w3.eth.getTransactionReceipt(MISSING_TXID), n),
+        run('lean get_transaction_receipt', lambda: rpc.get_transaction_receipt(MISSING_TXID), n),
+        run('web3 call', lambda: w3.eth.call({'to': ZERO_ADDR, 'data': '0x'}), n),
+        run('lean call', lambda: rpc.call({'to': ZERO_ADDR, 'data': '0x'}), n),
+        run('web3 blockNumber', lambda: w3.eth.blockNumber, n),
+        run('lean block_number', lambda: rpc.block_number(), n),
+    ]
+    # batched receipts: report per receipt so the numbers are comparable with the rows above
+    r = run(f'lean receipts (batch of {batch_size})',
+            lambda: rpc.get_transaction_receipts([MISSING_TXID] * batch_size), max(1, n // batch_size))
+    r.update({'n': r['n'] * batch_size, 'rps': r['rps'] * batch_size})
+    results.append(r)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('url')
+    parser.add_argument('-n', type=int, default=500)
+    parser.add_argument('--json', action='store_true', help="print results as json")
+    args = parser.parse_args()
+
+    results = bench(args.url, args.n)
+    if args.json:
+        print(json.dumps({'url': args.url, 'json_codec': JSON_CODEC, 'results': results}, indent=2))
+    else:
+        print(f"json codec: {JSON_CODEC}")
+        for r in results:
+            print(f"{r['name']:<40} {r['rps']:>10.1f} req/s   p50 {r['p50_ms']:>7.2f}ms   p99 {r['p99_ms']:>7.2f}ms")
@@ -0,0 +1,235 @@
+'''A local JSON-RPC node for benchmarks: eth_tester behind HTTP, with the network put back in.
+
+eth_tester answers instantly and mines every tx as it arrives, so batching, pipelining or fewer confirmations can't
+show a difference against it. StandinNode serves it over HTTP and adds:
+
+- `latency` seconds (+/- `jitter`) before each response, errors included
+- a block every `block_interval` seconds, txs waiting in the pending pool until then (None: mine on arrival)
+- `drop_rate`: the fraction of requests that are carried out but get no response (the connection is closed)
+- `rate_limit`: requests/second above which the node answers HTTP 429
+
+Requests are counted by method; GET /stats returns the counts.
+
+usage: python3 test/standin.py [--port 8545] [--latency 0.05] [--jitter 0.02] [--block-interval 5] [--drop 0.01]
+                               [--rate-limit 200] [--fund 0x<addr> ...]'''
+
+import argparse
+import json
+import logging
+import random
+import sys, os
+import threading
+import time
+from collections import Counter
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from typing import List, Dict, Optional
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+
+from rpc import to_json
+
+log = logging.getLogger("standin")
+log.setLevel(logging.INFO)
+
+
+class TesterBackend:
+    '''Runs JSON-RPC calls against an in-process eth_tester chain. Calls are serialized: eth_tester isn't thread
+    safe.'''
+
+    def __init__(self, ethereum_tester=None, gas_limit=8000000):
+        from web3 import Web3, EthereumTesterProvider
+        from eth_tester import PyEVMBackend, EthereumTester
+        if ethereum_tester is None:
+            genesis = PyEVMBackend._generate_genesis_params({'gas_limit': gas_limit})
+            ethereum_tester = EthereumTester(backend=PyEVMBackend(genesis_parameters=genesis))
+        self.tester = ethereum_tester
+        self.w3 = Web3(EthereumTesterProvider(ethereum_tester=ethereum_tester))
+        self._lock = threading.Lock()
+
+    def call(self, method: str, params: List):
+        with self._lock:
+            return to_json(self.w3.manager.request_blocking(method, params))
+
+    def auto_mine(self, enabled: bool):
+        with self._lock:
+            if enabled:
+                self.tester.enable_auto_mine_transactions()
+            else:
+                self.tester.disable_auto_mine_transactions()
+
+    def mine(self):
+        with self._lock:
+            self.tester.mine_blocks(1)
+
+    def fund(self, addr: str, value=10 ** 21):
+        with self._lock:
+            self.w3.eth.sendTransaction({'to': addr, 'from': self.w3.eth.accounts[0], 'value': value})
+            self.tester.mine_blocks(1)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandinNode:
+    def __init__(self, backend=None, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 block_interval: Optional[float] = None, drop_rate=0.0, rate_limit: Optional[float] = None, seed=0):
+        self.backend = backend or TesterBackend()
+        self.latency = latency
+        self.jitter = jitter
+        self.block_interval = block_interval
+        self.drop_rate = drop_rate
+        self.rate_limit = rate_limit
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = rate_limit or 0.0
+        self._tokens_at = time.monotonic()
+        self._stop = threading.Event()
+        self.calls = Counter()
+        self.n_requests = 0
+        self.n_dropped = 0
+        self.n_limited = 0
+        self.n_blocks = 0
+        self.server = _Server((host, port), self._handler())
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    # the network
+
+    def _delay(self) -> float:
+        with self._lock:
+            return max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+
+    def _drop(self) -> bool:
+        with self._lock:
+            return self._rng.random() < self.drop_rate
+
+    def _admit(self) -> bool:
+        '''A token bucket holding a second's worth of requests.'''
+        if self.rate_limit is None:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._tokens_at) * self.rate_limit)
+            self._tokens_at = now
+            if self._tokens < 1:
+                self.n_limited += 1
+                return False
+            self._tokens -= 1
+            return True
+
+    def _answer(self, req: Dict) -> Dict:
+        with self._lock:
+            self.calls[req.get('method')] += 1
+        try:
+            return {'jsonrpc': '2.0', 'id': req.get('id'),
+                    'result': self.backend.call(req['method'], req.get('params') or [])}
+        except Exception as e:
+            return {'jsonrpc': '2.0', 'id': req.get('id'), 'error': {'code': -32000, 'message': str(e)}}
+
+    def _handler(self):
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: bytes):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _reply(self, status: int, body: bytes, started: float):
+                # the network's time is taken whatever the answer
+                time.sleep(max(0.0, node._delay() - (time.monotonic() - started)))
+                self._send(status, body)
+
+            def do_GET(self):
+                if self.path != '/stats':
+                    return self._send(404, b'{}')
+                self._send(200, json.dumps(node.stats()).encode())
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                with node._lock:
+                    node.n_requests += 1
+                started = time.monotonic()
+                if not node._admit():
+                    return self._reply(429, b'{"error": "rate limited"}', started)
+                try:
+                    req = json.loads(body)
+                except ValueError:
+                    return self._reply(400, b'{"error": "parse error"}', started)
+                resp = [node._answer(r) for r in req] if isinstance(req, list) else node._answer(req)
+                if node._drop():
+                    time.sleep(max(0.0, node._delay() - (time.monotonic() - started)))
+                    with node._lock:
+                        node.n_dropped += 1
+                    # done, but the caller never hears about it
+                    self.close_connection = True
+                    return
+                self._reply(200, json.dumps(resp).encode(), started)
+
+        return Handler
+
+    # blocks
+
+    def _miner(self):
+        while not self._stop.wait(self.block_interval):
+            self.backend.mine()
+            with self._lock:
+                self.n_blocks += 1
+
+    def start(self) -> 'StandinNode':
+        if self.block_interval is not None:
+            self.backend.auto_mine(False)
+            threading.Thread(target=self._miner, daemon=True).start()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        log.info(f"[StandinNode] serving on {self.url}: latency {self.latency}s +/- {self.jitter}s, block interval "
+                 f"{self.block_interval}s, drop rate {self.drop_rate}, rate limit {self.rate_limit}/s")
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'Requests': self.n_requests, 'Calls': dict(self.calls), 'Dropped': self.n_dropped,
+                    'Limited': self.n_limited, 'Blocks': self.n_blocks}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8545)
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds added to each response")
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--block-interval', type=float, help="seconds between blocks (default: mine each tx)")
+    parser.add_argument('--drop', type=float, default=0.0, help="fraction of responses to drop")
+    parser.add_argument('--rate-limit', type=float, help="requests/s before answering 429")
+    parser.add_argument('--fund', action='append', default=[], help="address to give 1000 ether; repeatable")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    backend = TesterBackend()
+    for addr in args.fund:
+        backend.fund(addr)
+    node = StandinNode(backend, host=args.host, port=args.port, latency=args.latency, jitter=args.jitter,
+                       block_interval=args.block_interval, drop_rate=args.drop, rate_limit=args.rate_limit).start()
+    try:
+        while True:
+            time.sleep(60)
+            log.info(f"[StandinNode] {node.stats()}")
+    except KeyboardInterrupt:
+        node.stop()
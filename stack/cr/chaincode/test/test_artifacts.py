@@ -0,0 +1,88 @@
+import sys, os
+import hashlib
+import io
+import tempfile
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+
+import logging
+
+import artifacts
+from artifacts import fetch_artifact, ArtifactError
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestArtifacts')
+
+
+def mk_artifact(data: bytes) -> (str, str):
+    (fd, path) = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    return f"file://{path}", hashlib.sha256(data).hexdigest()
+
+
+def fresh_cache():
+    artifacts.CACHE_DIR = tempfile.mkdtemp()
+    artifacts._inflight.clear()
+
+
+def test_cache_verified_on_read():
+    fresh_cache()
+    (url, sha256) = mk_artifact(b'6060')
+    assert fetch_artifact(url, sha256) == b'6060'
+    assert os.path.exists(artifacts.cache_path(sha256))
+
+    # a later process finds a corrupt file in /tmp: it's fetched again, not served
+    artifacts._inflight.clear()
+    with open(artifacts.cache_path(sha256), 'wb') as f:
+        f.write(b'6061')
+    assert fetch_artifact(url, sha256) == b'6060'
+    with open(artifacts.cache_path(sha256), 'rb') as f:
+        assert f.read() == b'6060'
+
+    # and a good file is served without the source
+    artifacts._inflight.clear()
+    os.remove(url[len('file://'):])
+    assert fetch_artifact(url, sha256) == b'6060'
+
+    (bad_url, _) = mk_artifact(b'6062')
+    try:
+        fetch_artifact(bad_url, hashlib.sha256(b'nope').hexdigest())
+        assert False
+    except ArtifactError:
+        pass
+    return True
+
+
+def test_one_s3_client():
+    fresh_cache()
+    created = []
+
+    class FakeS3:
+        def get_object(self, Bucket, Key):
+            return {'Body': io.BytesIO(f"{Bucket}/{Key}".encode())}
+
+    (client, artifacts._s3) = (artifacts.boto3.client, None)
+    artifacts.boto3.client = lambda name: created.append(name) or FakeS3()
+    try:
+        datas = [f"bucket/key{i}".encode() for i in range(8)]
+        artifacts.prefetch([{'URL': f"s3://bucket/key{i}", 'Sha256': hashlib.sha256(d).hexdigest()}
+                            for (i, d) in enumerate(datas)])
+        assert [fetch_artifact(f"s3://bucket/key{i}", hashlib.sha256(d).hexdigest())
+                for (i, d) in enumerate(datas)] == datas
+    finally:
+        (artifacts.boto3.client, artifacts._s3) = (client, None)
+    assert created == ['s3']
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_cache_verified_on_read, test_one_s3_client]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -0,0 +1,133 @@
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+sys.path.insert(0, os.path.join(main_dir, 'test'))
+
+import logging
+import tempfile
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+import artifacts
+from chaincode import compile_plan
+from bench_chaincode import LocalSsm, mk_plan, run_plan, compare, split_baseline, load_baseline, update_baseline, \
+    SHAPES
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestBenchChaincode')
+
+
+def test_local_ssm():
+    ssm = LocalSsm()
+    written = []
+    ssm.meta.events.register('provide-client-params.ssm.PutParameter', lambda params: written.append(params['Name']))
+    assert ssm.put_parameter(Name='/a', Value='1') == {'Version': 1}
+    assert ssm.put_parameter(Name='/a', Value='2', Overwrite=True) == {'Version': 2}
+    try:
+        ssm.put_parameter(Name='/a', Value='3')
+        assert False
+    except ssm.exceptions.ParameterAlreadyExists:
+        pass
+    try:
+        ssm.get_parameter(Name='/b')
+        assert False
+    except ssm.exceptions.ParameterNotFound:
+        pass
+    assert ssm.get_parameter(Name='/a')['Parameter']['Value'] == '2'
+    assert ssm.get_parameters(Names=['/a', '/b'])['InvalidParameters'] == ['/b']
+
+    for i in range(3):
+        ssm.put_parameter(Name=f'/p/{i}', Value=str(i))
+    filters = [{'Key': 'Name', 'Option': 'BeginsWith', 'Values': ['/p/']}]
+    page = ssm.describe_parameters(ParameterFilters=filters, MaxResults=2)
+    assert [p['Name'] for p in page['Parameters']] == ['/p/0', '/p/1']
+    page = ssm.describe_parameters(ParameterFilters=filters, MaxResults=2, NextToken=page['NextToken'])
+    assert [p['Name'] for p in page['Parameters']] == ['/p/2'] and 'NextToken' not in page
+
+    assert ssm.delete_parameters(Names=['/p/0', '/p/9']) == {'DeletedParameters': ['/p/0'],
+                                                             'InvalidParameters': ['/p/9']}
+    # writes fire events, even when they fail, and every call is counted
+    assert written == ['/a'] * 3 + ['/p/0', '/p/1', '/p/2']
+    assert ssm.calls['PutParameter'] == 6 and ssm.calls['DescribeParameters'] == 2
+    return True
+
+
+def test_mk_plan():
+    for shape in SHAPES:
+        plan = mk_plan(shape, 4)
+        assert compile_plan(plan) == plan
+    assert len(mk_plan('independent', 2)) == 2 and len(mk_plan('fanout', 4)) == 4
+    try:
+        mk_plan('nope', 2)
+        assert False
+    except ValueError:
+        pass
+    return True
+
+
+def test_run_plan():
+    downloads = []
+    orig = artifacts._download
+    artifacts._download = lambda url: downloads.append(url) or orig(url)
+    cwd = os.getcwd()
+    os.chdir(main_dir)  # local bytecode is read from bytecode/<name>.bin
+    try:
+        plan = mk_plan('independent', 2)
+        first = run_plan(plan)
+        # the two deploys share a binary
+        assert len(downloads) == 1
+        # ...and a second plan starts cold too
+        second = run_plan(plan)
+        assert len(downloads) == 2
+    finally:
+        artifacts._download = orig
+        os.chdir(cwd)
+
+    for ret in (first, second):
+        assert list(ret) == ['cold', 'cached']
+        assert ret['cold']['RpcByMethod']['eth_sendRawTransaction'] == 2
+        # everything was deployed already
+        assert 'eth_sendRawTransaction' not in ret['cached']['RpcByMethod']
+        assert ret['cached']['RpcCalls'] < ret['cold']['RpcCalls']
+    return True
+
+
+def test_compare():
+    baseline = {'a/cold': {'WallS': 1.0, 'PeakMemMb': 10.0, 'RpcCalls': 20, 'SsmCalls': 5}}
+    within = {'a/cold': {'WallS': 1.2, 'PeakMemMb': 12.0, 'RpcCalls': 20, 'SsmCalls': 4},
+              'b/cold': {'WallS': 9.0, 'PeakMemMb': 99.0, 'RpcCalls': 99, 'SsmCalls': 99}}
+    assert compare(within, baseline) == []
+    regressed = {'a/cold': {'WallS': 1.4, 'PeakMemMb': 10.0, 'RpcCalls': 21, 'SsmCalls': 5}}
+    assert [r.split(':')[0] for r in compare(regressed, baseline)] == ['a/cold WallS', 'a/cold RpcCalls']
+    return True
+
+
+def test_baseline_files():
+    results = {'a/cold': {'WallS': 1.0, 'PeakMemMb': 10.0, 'RpcCalls': 20, 'SsmCalls': 5, 'RpcRequests': 3}}
+    (counts, local) = split_baseline(results)
+    assert counts == {'a/cold': {'RpcCalls': 20, 'SsmCalls': 5}}
+    assert local == {'a/cold': {'WallS': 1.0, 'PeakMemMb': 10.0}}
+    with tempfile.TemporaryDirectory() as d:
+        (path, local_path) = (os.path.join(d, 'base.json'), os.path.join(d, 'base.local.json'))
+        update_baseline(path, {'Latency': 0.0}, counts)
+        # plans that weren't run keep their entries
+        update_baseline(path, {'Latency': 0.0}, {'b/cold': {'RpcCalls': 1, 'SsmCalls': 0}})
+        baseline = load_baseline(path, local_path)
+        assert not baseline['Local'] and set(baseline['Results']) == {'a/cold', 'b/cold'}
+        update_baseline(local_path, {'Latency': 0.0}, local)
+        baseline = load_baseline(path, local_path)
+        assert baseline['Local'] and baseline['Results']['a/cold'] == {'WallS': 1.0, 'PeakMemMb': 10.0, 'RpcCalls': 20,
+                                                                       'SsmCalls': 5}
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_local_ssm, test_mk_plan, test_run_plan, test_compare, test_baseline_files]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
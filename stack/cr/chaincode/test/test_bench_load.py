@@ -0,0 +1,108 @@
+import sys, os
+from collections import OrderedDict
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+sys.path.insert(0, os.path.join(main_dir, 'test'))
+
+import logging
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+from rpc import RpcError
+from txpipe import SignedTx
+from bench_load import LoadRun, parse_mix
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestBenchLoad')
+
+
+class FakeChain:
+    '''Mines a block whenever it's asked for the head, with every pooled tx that has no gap in its sender's nonces
+    before it. Raw txs are b"<sender>:<nonce>".'''
+
+    def __init__(self, reject=()):
+        self.reject = set(reject)
+        self.pool = {}  # (sender, nonce) -> txid
+        self.next_nonce = {}
+        self.blocks = [[]]
+
+    def batch(self, calls, raise_errors=False):
+        ret = []
+        for (_, [raw]) in calls:
+            (sender, nonce) = bytes.fromhex(raw[2:]).decode().split(':')
+            if raw in self.reject:
+                ret.append(RpcError('eth_sendRawTransaction', {'code': -32010, 'message': 'gas price too low'}))
+                continue
+            self.pool[(sender, int(nonce))] = raw
+            ret.append(raw)
+        return ret
+
+    def block_number(self):
+        block = []
+        for (sender, nonce) in sorted(self.pool):
+            if nonce == self.next_nonce.get(sender, 0):
+                block.append(self.pool.pop((sender, nonce)))
+                self.next_nonce[sender] = nonce + 1
+        if block:
+            self.blocks.append(block)
+        return len(self.blocks) - 1
+
+    def get_block(self, n):
+        return {'number': n, 'timestamp': 5 * n, 'gasUsed': 21000 * len(self.blocks[n]), 'gasLimit': 8000000,
+                'transactions': self.blocks[n]}
+
+
+def mk_signed(senders='ab', n=5):
+    '''n txs from each sender, interleaved, as (kind, sender, SignedTx)'''
+    ret = []
+    for nonce in range(n):
+        for sender in senders:
+            raw = f"{sender}:{nonce}".encode()
+            ret.append(('transfer', sender, SignedTx(nonce, '0x' + raw.hex(), raw)))
+    return ret
+
+
+def run(chain, batch_size):
+    return LoadRun(chain, mk_signed(), rate=10 ** 6, duration=0.05, tick=0.01, drain=5, batch_size=batch_size,
+                   check_status=False).run()
+
+
+def test_parse_mix():
+    assert parse_mix('transfer=1,setMember=0.5') == OrderedDict([('transfer', 1.0), ('setMember', 0.5)])
+    for bad in ['transfer=1,vote=1', 'transfer', 'transfer=x']:
+        try:
+            parse_mix(bad)
+            assert False, bad
+        except ValueError:
+            pass
+    return True
+
+
+def test_rejection_stops_sender():
+    rejected = '0x' + b'a:2'.hex()
+    # a's third tx is rejected in the second batch of three; its later txs aren't sent at all
+    report = run(FakeChain(reject={rejected}), batch_size=3)
+    assert (report['Sent'], report['Rejected'], report['NotSent']) == (7, 1, 2)
+    assert report['StoppedSenders'] == {'a': {'AtNonce': 2, 'NotSent': 2}}
+    assert (report['Included'], report['Stranded'], report['Pending']) == (7, 0, 0)
+    assert report['RejectReasons'] == {'gas price too low': 1}
+    assert report['ByKind']['transfer']['Sent'] == 7 and report['Blocks']['MaxTxs'] >= 1
+
+    # sent in the same batch, a's later txs are stranded behind the gap; the run doesn't wait for them
+    report = run(FakeChain(reject={rejected}), batch_size=10)
+    assert (report['Sent'], report['Rejected'], report['NotSent']) == (9, 1, 0)
+    assert (report['Included'], report['Stranded'], report['Pending']) == (7, 2, 0)
+    assert report['Elapsed'] < 5
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_parse_mix, test_rejection_stops_sender]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
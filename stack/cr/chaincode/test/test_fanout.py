@@ -0,0 +1,98 @@
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+sys.path.insert(0, os.path.join(main_dir, 'test'))
+
+import logging
+
+from eth_account import Account
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+import fanout
+from chaincode import compile_plan, InvalidInput
+from standin import StandinNode, TesterBackend
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestFanout')
+
+ACCT = Account.privateKeyToAccount("0x" + b"aedufghieuhiughekjudsdfahskljdhf".hex())
+PLAN = [
+    {'Name': 'membership', 'Type': 'deploy'},
+    {'Name': 'add-admin', 'Type': 'calltx', 'Function': '$membership.addAdmin', 'Inputs': ['^addr-ones']},
+    {'Name': 'is-admin', 'Type': 'call', 'Function': '$membership.isAdmin', 'Inputs': ['^addr-ones'],
+     'ReturnTypes': ['bool']},
+    {'Name': 'fund', 'Type': 'send', 'Recipients': ['^addr-ones', '^addr-zero'], 'Value': 1},
+]
+
+
+def assert_invalid(plan, needle):
+    try:
+        compile_plan(plan)
+        assert False, plan
+    except InvalidInput as e:
+        assert needle in str(e), (needle, str(e))
+
+
+def test_compile_plan():
+    assert compile_plan(PLAN) == PLAN
+    deploy = {'Name': 'a', 'Type': 'deploy'}
+    # refs must point at earlier ops, wherever they appear in the op
+    assert_invalid([{'Name': 'b', 'Type': 'deploy', 'Inputs': ['$a']}, deploy], "refers to $a")
+    assert_invalid([{'Name': 'b', 'Type': 'calltx', 'Function': '$a.f'}, deploy], "refers to $a")
+    assert_invalid([{'Name': 'b', 'Type': 'deploy', 'Libraries': {'__lib__': '$a'}}, deploy], "refers to $a")
+    assert_invalid([{'Name': 'b', 'Type': 'send', 'Recipients': ['$a'], 'Value': 1}, deploy], "refers to $a")
+    # ...and an op can't refer to itself
+    assert_invalid([{'Name': 'a', 'Type': 'deploy', 'Inputs': ['$a']}], "refers to $a")
+    assert_invalid([deploy, deploy], "must be unique")
+    assert_invalid([{'Name': 'a', 'Type': 'nope'}], "not recognised")
+    assert_invalid([{'Type': 'deploy'}], "need a `Name`")
+    assert_invalid([dict(deploy, URL='https://example.com/a.bin')], "no `Sha256`")
+    return True
+
+
+def test_fanout():
+    nodes = [StandinNode(TesterBackend(), latency=0.02).start() for _ in range(2)]
+    for n in nodes:
+        n.backend.fund(ACCT.address)
+    targets = fanout.parse_targets([{'NamePrefix': 'one', 'RpcUrl': nodes[0].url}, ['two', nodes[1].url],
+                                    ['dead', 'http://127.0.0.1:1']])
+    (load_privkey, get_chainid) = (fanout.load_privkey, fanout.get_chainid)
+    fanout.load_privkey = lambda name_prefix, svc: ACCT
+    fanout.get_chainid = lambda name_prefix: 1  # eth_tester's chain id
+    progress = []
+    cwd = os.getcwd()
+    os.chdir(main_dir)  # local bytecode is read from bytecode/<name>.bin
+    try:
+        report = fanout.run_fanout(PLAN, targets, dry_run=True,
+                                   on_progress=lambda t, i, n, r, d: progress.append((t.name_prefix, r.name)))
+    finally:
+        (fanout.load_privkey, fanout.get_chainid) = (load_privkey, get_chainid)
+        os.chdir(cwd)
+    log.info(fanout.format_report(report))
+
+    # one target failing doesn't stop the others
+    assert (report['NOk'], report['NFailed']) == (2, 1)
+    assert [r['NamePrefix'] for r in report['Targets']] == ['one', 'two', 'dead']
+    assert 'Error' in report['Targets'][2]
+    # every op ran on every live network, in plan order
+    for prefix in ('one', 'two'):
+        assert [name for (p, name) in progress if p == prefix] == [op['Name'] for op in PLAN]
+    assert all(n.stats()['Calls']['eth_sendRawTransaction'] >= 3 for n in nodes)
+    # the networks ran side by side
+    assert report['WallTime'] < report['SerialTime']
+    for n in nodes:
+        n.stop()
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_compile_plan, test_fanout]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
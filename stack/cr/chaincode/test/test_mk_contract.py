@@ -12,6 +12,7 @@ print(sys.path)
 
 import binascii
 import functools
+import hashlib
 import logging
 
 from hexbytes import HexBytes
@@ -23,7 +24,10 @@ from eth_utils import keccak
 
 import boto3
 boto3.setup_default_session(region_name='ap-southeast-2')
-from chaincode import mk_contract, is_tx_confirmed
+import lib
+from lib import gen_ssm_send
+from rpc import Web3Rpc
+from chaincode import mk_contract, hash_send_inputs
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('TestChaincode')
@@ -71,6 +75,14 @@ def mk_deploy(name, inputs=None, libs=None):
     return {'Name': name, 'Inputs': inputs, 'Libraries': libs, 'Type': 'deploy'}
 
 
+def mk_remote_deploy(name, inputs=None, libs=None):
+    # serve the local bytecode via a file:// URL to exercise the artifact fetch + cache path
+    path = os.path.join(main_dir, 'bytecode', f'{name}.bin')
+    with open(path, 'rb') as f:
+        sha256 = hashlib.sha256(f.read()).hexdigest()
+    return dict(mk_deploy(name, inputs, libs), URL=f'file://{path}', Sha256=sha256)
+
+
 def mk_calltx(name, function, inputs=None, value=None):
     ret = {'Name': name, 'Function': function, 'Inputs': inputs if inputs is not None else [], 'Type': 'calltx'}
     if value is not None:
@@ -82,6 +94,60 @@ def mk_call(name, function, inputs=[], ret_types=[]):
     return {'Name': name, 'Function': function, 'Inputs': inputs, 'Type': 'call', 'ReturnTypes': ret_types}
 
 
+def mk_send(name, recipients, value=None, values=None, window=None):
+    ret = {'Name': name, 'Recipients': recipients, 'Type': 'send'}
+    if values is not None:
+        ret['Values'] = values
+    else:
+        ret['Value'] = value
+    if window is not None:
+        ret['Window'] = window
+    return ret
+
+
+class FakeSsm:
+    def __init__(self):
+        self.params = {}
+
+    def get_parameter(self, Name, WithDecryption=False):
+        if Name not in self.params:
+            raise Exception(f"ParameterNotFound: {Name}")
+        return {'Parameter': {'Name': Name, 'Value': self.params[Name]}}
+
+    def put_parameter(self, Name, Value, Overwrite=False, **kwargs):
+        if Name in self.params and not Overwrite:
+            raise Exception(f"ParameterAlreadyExists: {Name}")
+        self.params[Name] = Value
+
+
+class FlakyRpc(Web3Rpc):
+    '''Loses the connection on the `fail_on`th broadcast.'''
+
+    def __init__(self, w3, fail_on):
+        super().__init__(w3)
+        self.n_sends = 0
+        self.fail_on = fail_on
+
+    def _sent(self):
+        self.n_sends += 1
+        if self.n_sends == self.fail_on:
+            raise ConnectionError("connection reset by peer")
+
+    def send_raw_transaction(self, raw):
+        self._sent()
+        return super().send_raw_transaction(raw)
+
+    def send_raw_transactions(self, raws):
+        self._sent()
+        return super().send_raw_transactions(raws)
+
+
+def mk_funded_acct(key: bytes):
+    acct = Account.privateKeyToAccount("0x" + key.hex())
+    w3.eth.sendTransaction({'to': acct.address, 'from': w3.eth.accounts[0], 'value': 10 * 10 ** 18})
+    return acct
+
+
 def test_mk_contract():
     name_prefix = "tnalpha"
     acct = Account.privateKeyToAccount("0x" + b"aedufghieuhiughekjudsdfahskljdhf".hex())
@@ -100,7 +166,7 @@ def test_mk_contract():
         mk_deploy('bbfarm', libs={"__./contracts/BBLib.v7.sol:BBLibV7______": '$bblib-v7'}),
         mk_deploy('sv-payments', inputs=['^self']),
         mk_deploy('sv-backend'),
-        mk_deploy('sv-comm-auction'),
+        mk_remote_deploy('sv-comm-auction'),
         mk_deploy('sv-index', inputs=['$sv-backend','$sv-payments','^addr-ones','$bbfarm','$sv-comm-auction',]),
         mk_calltx('ix-backend-perms', '$sv-backend.setPermissions', ['$sv-index','bool:true']),
         mk_calltx('ix-payments-perms', '$sv-payments.setPermissions', ['$sv-index','bool:true']),
@@ -108,6 +174,9 @@ def test_mk_contract():
         mk_calltx('ix-mk-democ', '$sv-index.dInit', ['$membership', 'bool:true'], value=1),
         mk_call('democ-hash', '$sv-backend.getGDemoc', [ 'uint256:0' ], [ 'bytes32' ]),
         mk_calltx('democ-add-admin', '$sv-index.setDEditor', ['$democ-hash', '_members', 'bool:true']),
+        mk_send('fund-services', ['_members', '^addr-ones'], values=['uint256:1000', '2000']),
+        # recipients above the precompiles (0x01..0x09), where a plain transfer can run out of gas
+        mk_send('fund-voters', ["0x%040x" % (0x1000 + i) for i in range(50)], value=10 ** 9),
     ]
 
     # smart_contracts_to_deploy += smart_contracts_to_deploy
@@ -116,11 +185,88 @@ def test_mk_contract():
                                      smart_contracts_to_deploy, dict())
 
     print(json.dumps({k: repr(op) for k, op in processed_scs.items()}, indent=2))
+    voters = processed_scs['fund-voters']
+    assert voters.record['Count'] == 50 and voters.record['Total'] == str(50 * 10 ** 9)
+    assert all(w3.eth.getBalance(a) == 10 ** 9 for a in voters.to)
+    services = processed_scs['fund-services']
+    assert services.value == [1000, 2000] and w3.eth.getBalance(services.to[1]) == 2000
+    return True
+
+
+def test_send_records():
+    name_prefix = "tnsend"
+    acct = mk_funded_acct(b"send-ops-test-key-32-bytes-long!")
+    recipients = ["0x%040x" % (0x5e00 + i) for i in range(20)]
+    ops = [mk_send('fund-many', recipients, value=10 ** 9), mk_send('fund-two', recipients[:2], values=[5, 7])]
+
+    def run():
+        nonce = w3.eth.getTransactionCount(acct.address)
+        return functools.reduce(mk_contract(name_prefix, w3, acct, None, nonce=nonce), ops, dict())
+
+    saved_ssm = lib.ssm
+    lib.ssm = FakeSsm()
+    try:
+        start = w3.eth.getTransactionCount(acct.address)
+        out = run()
+        record = json.loads(lib.ssm.params[gen_ssm_send(name_prefix, 'fund-many')])
+        assert record == out['fund-many'].record
+        assert record['Count'] == 20 and record['Total'] == str(20 * 10 ** 9) and record['Complete']
+        assert record['InputsHash'] == hash_send_inputs(out['fund-many'].to, [10 ** 9] * 20)
+        assert record['Nonces'] == [start, start + 19]
+        assert json.loads(lib.ssm.params[gen_ssm_send(name_prefix, 'fund-two')])['Nonces'] == [start + 20, start + 21]
+        balances = [w3.eth.getBalance(a) for a in out['fund-many'].to]
+        assert balances == [10 ** 9 + 5, 10 ** 9 + 7] + [10 ** 9] * 18
+
+        # the same inputs again: skipped on the inputs hash, nothing is sent
+        again = run()
+        assert again['fund-many'].cached and again['fund-two'].cached
+        assert w3.eth.getTransactionCount(acct.address) == start + 22
+        assert [w3.eth.getBalance(a) for a in out['fund-many'].to] == balances
+        # ...while a change to the inputs sends the op again
+        ops[1] = mk_send('fund-two', recipients[:2], values=[5, 8])
+        assert not run()['fund-two'].cached
+        assert w3.eth.getTransactionCount(acct.address) == start + 24
+    finally:
+        lib.ssm = saved_ssm
+    return True
+
+
+def test_send_resumes():
+    name_prefix = "tnresume"
+    acct = mk_funded_acct(b"send-resume-test-key-32-bytes-!!")
+    recipients = ["0x%040x" % (0x7e00 + i) for i in range(20)]
+    # 5 txs per broadcast, and the third broadcast fails
+    ops = [mk_send('fund-flaky', recipients, value=10 ** 9, window=5)]
+    saved_ssm = lib.ssm
+    lib.ssm = FakeSsm()
+    try:
+        start = w3.eth.getTransactionCount(acct.address)
+        try:
+            functools.reduce(mk_contract(name_prefix, w3, acct, None, nonce=start, rpc=FlakyRpc(w3, fail_on=3)), ops,
+                             dict())
+            assert False
+        except ConnectionError:
+            pass
+        record = json.loads(lib.ssm.params[gen_ssm_send(name_prefix, 'fund-flaky')])
+        assert record['Complete'] is False and record['Nonces'] == [start, start + 19]
+        assert w3.eth.getTransactionCount(acct.address) == start + 10
+
+        # the re-run sends the last 10 only; nobody is paid twice
+        out = functools.reduce(mk_contract(name_prefix, w3, acct, None, nonce=start + 10), ops, dict())
+        record = out['fund-flaky'].record
+        assert record['Complete'] and record['Resumed'] == 10 and record['Count'] == 20
+        assert w3.eth.getTransactionCount(acct.address) == start + 20
+        assert all(w3.eth.getBalance(a) == 10 ** 9 for a in out['fund-flaky'].to)
+        # the first txid is the original first tx, recovered by signing it again
+        assert w3.eth.getTransaction(record['FirstTxid'])['nonce'] == start
+        assert json.loads(lib.ssm.params[gen_ssm_send(name_prefix, 'fund-flaky')]) == record
+    finally:
+        lib.ssm = saved_ssm
     return True
 
 
 if __name__ == "__main__":
-    tests = [test_mk_contract]
+    tests = [test_mk_contract, test_send_records, test_send_resumes]
 
     for t in tests:
         print(f"{t.__name__}: {t()}")
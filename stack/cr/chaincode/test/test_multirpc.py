@@ -0,0 +1,212 @@
+import json
+import sys, os
+import time
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+
+import logging
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from rpc import RpcError, RpcTransportError
+from multirpc import MultiNodeRpc, connect, node_urls
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestMultiRpc')
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeNode:
+    '''A JSON-RPC node on localhost answering eth_blockNumber / eth_getBalance / eth_getLogs (a log per block, up to
+    its head), with adjustable delay, head and failures. Remembers which methods it was sent.'''
+
+    def __init__(self, head=100, delay=0.0):
+        self.head = head
+        self.delay = delay
+        self.failing = False
+        self.methods = []
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                reqs = req if isinstance(req, list) else [req]
+                node.methods.extend(r['method'] for r in reqs)
+                time.sleep(node.delay)
+                if node.failing:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                resps = [node.answer(r) for r in reqs]
+                body = json.dumps(resps if isinstance(req, list) else resps[0]).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = _Server(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def answer(self, r):
+        if r['method'] == 'eth_blockNumber':
+            return {'jsonrpc': '2.0', 'id': r['id'], 'result': hex(self.head)}
+        if r['method'] in ('eth_getTransactionCount', 'eth_sendRawTransaction'):
+            return {'jsonrpc': '2.0', 'id': r['id'], 'result': '0x1'}
+        if r['method'] == 'eth_getBalance':
+            return {'jsonrpc': '2.0', 'id': r['id'], 'result': self.url}
+        if r['method'] == 'eth_getLogs':
+            f = r['params'][0]
+            # like a real node, one that hasn't got to toBlock yet just returns what it has
+            blocks = range(int(f['fromBlock'], 16), min(int(f['toBlock'], 16), self.head) + 1)
+            return {'jsonrpc': '2.0', 'id': r['id'], 'result': [{'blockNumber': hex(b), 'logIndex': '0x0'}
+                                                                 for b in blocks]}
+        return {'jsonrpc': '2.0', 'id': r['id'], 'error': {'code': -32601, 'message': 'method not found'}}
+
+    def reads(self):
+        return self.methods.count('eth_getBalance')
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def mk_rpc(nodes, **kwargs):
+    rpc = MultiNodeRpc([n.url for n in nodes], timeout=2, **kwargs)
+    rpc.probe(block=True)
+    return rpc
+
+
+def balance(rpc):
+    return rpc.request('eth_getBalance', ['0x' + '00' * 20, 'latest'])
+
+
+def test_hedged_read():
+    fast, slow = FakeNode(), FakeNode(delay=0.5)
+    rpc = mk_rpc([slow, fast], hedge_after=0.05)
+    # the probe already found `fast` to be faster, so reads go there first
+    assert balance(rpc) == fast.url
+    # when the best node stalls, the hedge to the next one answers first
+    fast.delay, slow.delay = 0.5, 0.0
+    start = time.monotonic()
+    assert balance(rpc) == slow.url and time.monotonic() - start < 0.4
+    assert rpc.health[slow.url].n_hedged == 1
+    # JSON-RPC errors come from the node that answered; they aren't retried elsewhere
+    try:
+        rpc.request('eth_nope', [])
+        assert False
+    except RpcError as e:
+        assert e.code == -32601
+    for n in (fast, slow):
+        n.close()
+    return True
+
+
+def test_failover_and_lag():
+    a, b, c = FakeNode(), FakeNode(), FakeNode(head=90)
+    rpc = mk_rpc([a, b, c], hedge_after=1.0)
+    # c is 10 blocks behind, so it isn't read from
+    for _ in range(10):
+        balance(rpc)
+    assert c.reads() == 0
+    # a failing node is rested and its reads go elsewhere
+    a.failing = True
+    b.failing = True
+    assert balance(rpc) == c.url
+    assert {s['Url']: s['Down'] for s in rpc.stats()} == {a.url: True, b.url: True, c.url: False}
+    b.failing = False
+    rpc.health[b.url].down_until = 0
+    assert balance(rpc) == b.url
+    a.failing = True
+    b.failing = True
+    c.failing = True
+    try:
+        balance(rpc)
+        assert False
+    except RpcTransportError:
+        pass
+    for n in (a, b, c):
+        n.close()
+    return True
+
+
+def test_logs_only_from_nodes_that_have_them():
+    behind, ahead = FakeNode(head=99), FakeNode(head=100, delay=0.05)
+    rpc = mk_rpc([behind, ahead], hedge_after=1.0)
+    # `behind` is within max_lag and the faster of the two, so plain reads go there...
+    assert balance(rpc) == behind.url
+    # ...but it can't answer for block 100 yet
+    logs = rpc.get_logs('0x' + '00' * 20, [], 95, 100)
+    assert [l['blockNumber'] for l in logs] == list(range(95, 101))
+    assert behind.methods.count('eth_getLogs') == 0 and ahead.methods.count('eth_getLogs') == 1
+    # once it has caught up it's used again; it's asked for its head first, as the last probe has it at 99
+    behind.head = 101
+    assert len(rpc.get_logs('0x' + '00' * 20, [], 95, 101)) == 7
+    assert behind.methods.count('eth_getLogs') == 1 and rpc.health[behind.url].head == 101
+    # when no node has the block, the read fails rather than coming back short
+    try:
+        rpc.get_logs('0x' + '00' * 20, [], 95, 105)
+        assert False
+    except RpcTransportError as e:
+        assert 'not 105 yet' in str(e)
+    assert not any(s['Down'] for s in rpc.stats())
+    for n in (behind, ahead):
+        n.close()
+    return True
+
+
+def test_cold_write_waits_for_probe():
+    slow, fast = FakeNode(delay=1.0), FakeNode()
+    rpc = MultiNodeRpc([slow.url, fast.url], timeout=2)
+    # neither node has been measured: the first write goes to the first node to answer a probe
+    start = time.monotonic()
+    rpc.request('eth_sendRawTransaction', ['0x00'])
+    assert rpc.sticky.url == fast.url and time.monotonic() - start < 0.5
+    assert slow.methods.count('eth_sendRawTransaction') == 0
+    for n in (slow, fast):
+        n.close()
+    return True
+
+
+def test_sticky_writes():
+    a, b = FakeNode(), FakeNode()
+    rpc = mk_rpc([a, b])
+    for _ in range(5):
+        rpc.request('eth_getTransactionCount', ['0x' + '00' * 20, 'pending'])
+        rpc.request('eth_sendRawTransaction', ['0x00'])
+    (first, other) = (a, b) if rpc.sticky.url == a.url else (b, a)
+    assert other.methods.count('eth_sendRawTransaction') == 0 and first.methods.count('eth_sendRawTransaction') == 5
+    # when the sticky node goes away, writes move to the other node and stay there
+    first.close()
+    rpc.request('eth_sendRawTransaction', ['0x00'])
+    rpc.request('eth_sendRawTransaction', ['0x00'])
+    assert rpc.sticky.url == other.url and other.methods.count('eth_sendRawTransaction') == 2
+    other.close()
+    return True
+
+
+def test_connect():
+    assert node_urls(' 1.2.3.4, 5.6.7.8,') == ['http://1.2.3.4:8545', 'http://5.6.7.8:8545']
+    assert type(connect('http://1.2.3.4:8545', '1.2.3.4')).__name__ == 'JsonRpcClient'
+    assert isinstance(connect('http://1.2.3.4:8545', '1.2.3.4,5.6.7.8'), MultiNodeRpc)
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_hedged_read, test_failover_and_lag, test_logs_only_from_nodes_that_have_them,
+             test_cold_write_waits_for_probe, test_sticky_writes, test_connect]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -0,0 +1,81 @@
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+sys.path.insert(0, os.path.join(main_dir, 'test'))
+
+import logging
+
+from eth_account import Account
+
+from rpc import JsonRpcClient, Web3Rpc, RpcError
+from standin import StandinNode, TesterBackend
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestRpc')
+
+RAW = '0x' + 'f8' * 40
+
+
+class ScriptedClient(JsonRpcClient):
+    '''Answers eth_sendRawTransaction with a given error, and eth_getTransactionByHash with `known_tx`.'''
+
+    def __init__(self, send_error: str, known_tx=None):
+        super().__init__('http://127.0.0.1:1')
+        self.send_error = send_error
+        self.known_tx = known_tx
+
+    def request(self, method, params=None):
+        if method == 'eth_sendRawTransaction':
+            raise RpcError(method, {'code': -32000, 'message': self.send_error})
+        if method == 'eth_getTransactionByHash':
+            return self.known_tx
+        raise RpcError(method, {'code': -32601, 'message': 'method not found'})
+
+
+def test_already_known_matching():
+    for msg in ['already known', 'known transaction: 0xabc',
+                'Transaction with the same hash was already imported.']:
+        assert ScriptedClient(msg).send_raw_transaction(RAW).startswith('0x')
+    # nonce too low only counts when the node has this very tx
+    assert ScriptedClient('nonce too low', known_tx={'hash': '0x01'}).send_raw_transaction(RAW).startswith('0x')
+    for (msg, known) in [('nonce too low', None), ('unknown account', None), ('insufficient funds', None),
+                         ('Transaction nonce is too low. Try incrementing the nonce.', None)]:
+        try:
+            ScriptedClient(msg, known).send_raw_transaction(RAW)
+            assert False, msg
+        except RpcError:
+            pass
+    return True
+
+
+def test_web3rpc_matches_json_rpc():
+    backend = TesterBackend()
+    acct = Account.privateKeyToAccount("0x" + b"aedufghieuhiughekjudsdfahskljdhf".hex())
+    backend.fund(acct.address)
+    node = StandinNode(backend).start()
+    (web3_rpc, json_rpc) = (Web3Rpc(backend.w3), JsonRpcClient(node.url))
+
+    stx = acct.signTransaction({'to': acct.address, 'value': 1, 'gas': 21000, 'gasPrice': 1, 'nonce': 0})
+    txid = web3_rpc.send_raw_transaction(stx.rawTransaction)
+
+    for (a, b) in [(web3_rpc.get_transaction_receipt(txid), json_rpc.get_transaction_receipt(txid)),
+                   (web3_rpc.get_block('latest'), json_rpc.get_block('latest')),
+                   (web3_rpc.get_transaction(txid), json_rpc.get_transaction(txid))]:
+        assert a == b, (a, b)
+    assert web3_rpc.get_transaction_count(acct.address) == json_rpc.get_transaction_count(acct.address) == 1
+    rs = web3_rpc.batch([('eth_blockNumber', []), ('eth_nope', [])], raise_errors=False)
+    assert rs[0] == hex(json_rpc.block_number()) and isinstance(rs[1], RpcError)
+    node.stop()
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_already_known_matching, test_web3rpc_matches_json_rpc]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -0,0 +1,207 @@
+import sys, os
+import time
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+sys.path.insert(0, os.path.join(main_dir, 'test'))
+
+import logging
+import threading
+from collections import Counter
+
+from rpc import JsonRpcClient, RpcError
+from rpccache import CachingRpc, mk_proxy, _answer, _answer_batch
+from multirpc import MultiNodeRpc
+from test_multirpc import FakeNode
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestRpcCache')
+
+ADDR = '0x' + 'ab' * 20
+
+
+class FakeChain:
+    '''Answers a few methods from a chain of `head` blocks, counting the calls it gets.'''
+
+    def __init__(self, head=100, delay=0.0):
+        self.head = head
+        self.delay = delay
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def answer(self, method, params):
+        with self._lock:
+            self.calls[method] += 1
+        time.sleep(self.delay)
+        if method == 'eth_blockNumber':
+            return hex(self.head)
+        if method == 'eth_getBlockByNumber':
+            n = self.head if params[0] == 'latest' else int(params[0], 16)
+            return {'number': hex(n), 'timestamp': hex(n * 5), 'gasLimit': hex(8000000)}
+        if method == 'eth_getTransactionReceipt':
+            n = int(params[0], 16)
+            return None if n > self.head else {'transactionHash': params[0], 'blockNumber': hex(n), 'status': '0x1'}
+        if method == 'eth_getCode':
+            return '0x6060' if params[0] == ADDR else '0x'
+        if method == 'eth_getLogs':
+            return [{'blockNumber': hex(n), 'data': '0x'} for n in range(int(params[0]['fromBlock'], 16),
+                                                                           int(params[0]['toBlock'], 16) + 1)]
+        if method == 'eth_getTransactionCount':
+            return '0x7'
+        raise RpcError(method, {'code': -32601, 'message': 'method not found'})
+
+    def request(self, method, params=None):
+        return self.answer(method, params or [])
+
+    def batch(self, calls, raise_errors=True):
+        ret = []
+        for (m, p) in calls:
+            try:
+                ret.append(self.answer(m, p))
+            except RpcError as e:
+                if raise_errors:
+                    raise e
+                ret.append(e)
+        return ret
+
+
+def txid(block):
+    return '0x{:064x}'.format(block)
+
+
+def test_final_data_cached():
+    chain = FakeChain()
+    rpc = CachingRpc(chain)
+    for _ in range(3):
+        assert rpc.get_block(50)['number'] == 50
+        assert rpc.get_transaction_receipt(txid(60))['blockNumber'] == 60
+        assert len(rpc.get_logs(ADDR, [], 10, 20)) == 11
+        assert rpc.request('eth_getCode', [ADDR, 'latest']) == '0x6060'
+    assert chain.calls['eth_getBlockByNumber'] == 1 and chain.calls['eth_getTransactionReceipt'] == 1
+    assert chain.calls['eth_getLogs'] == 1 and chain.calls['eth_getCode'] == 1
+    # the hot methods convert fields in place; that mustn't reach the cache
+    assert type(rpc.get_block(50)['timestamp']) is int and type(rpc.get_block(50)['timestamp']) is int
+
+    # recent, missing, tagged or empty results aren't final
+    chain.calls.clear()
+    for _ in range(3):
+        rpc.get_block(99)
+        rpc.get_block('latest')
+        assert rpc.get_transaction_receipt(txid(500)) is None
+        rpc.get_logs(ADDR, [], 90, 100)
+        rpc.request('eth_getCode', ['0x' + '00' * 20, 'latest'])
+        rpc.get_transaction_count(ADDR)
+    assert chain.calls['eth_getBlockByNumber'] == 3 * 2
+    assert all(n == 3 for (m, n) in chain.calls.items() if m not in ('eth_blockNumber', 'eth_getBlockByNumber'))
+    # once the chain moves on they are
+    chain.head = 200
+    time.sleep(rpc.head_ttl)
+    rpc.get_block(99)
+    rpc.get_block(99)
+    assert chain.calls['eth_getBlockByNumber'] == 3 * 2 + 1
+    return True
+
+
+def test_batch_and_eviction():
+    chain = FakeChain()
+    rpc = CachingRpc(chain, max_bytes=2048)
+    calls = [('eth_getTransactionReceipt', [txid(n)]) for n in range(1, 51)]
+    rs = rpc.batch(calls + calls[:10] + [('eth_nope', [])], raise_errors=False)
+    assert chain.calls['eth_getTransactionReceipt'] == 50 and isinstance(rs[-1], RpcError)
+    assert rs[50] == rs[0] and rs[50] is not rs[0]
+    try:
+        rpc.batch([('eth_nope', [])])
+        assert False
+    except RpcError:
+        pass
+    # memory is bounded: the oldest receipts went first
+    stats = rpc.stats()
+    assert stats['Bytes'] <= 2048 and stats['Evicted'] > 0
+    rpc.get_transaction_receipts([txid(n) for n in range(1, 51)])
+    assert chain.calls['eth_getTransactionReceipt'] == 50 + stats['Evicted']
+    return True
+
+
+def test_concurrent_reads_shared():
+    chain = FakeChain(delay=0.2)
+    rpc = CachingRpc(chain)
+    rpc.block_number()
+    chain.calls.clear()
+    threads = [threading.Thread(target=lambda: rpc.get_block('latest')['gasLimit']) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert chain.calls['eth_getBlockByNumber'] == 1 and rpc.stats()['Shared'] == 9
+    return True
+
+
+def test_final_on_the_answering_node():
+    # b is the slower node, so the head is read from a
+    a, b = FakeNode(head=100), FakeNode(head=99, delay=0.05)
+    multi = MultiNodeRpc([a.url, b.url], timeout=2)
+    multi.probe(block=True)
+    rpc = CachingRpc(multi)
+    assert rpc.block_number() == 100
+    # 98 is final as far as the head we've seen goes, but the node that has it final goes down
+    a.failing = True
+    logs = rpc.get_logs(ADDR, [], 90, 98)
+    assert len(logs) == 9 and b.methods.count('eth_getLogs') == 1
+    # b's answer covers the range but b is only one block past it: it's passed on, not kept
+    rpc.get_logs(ADDR, [], 90, 98)
+    assert b.methods.count('eth_getLogs') == 2
+    b.head = 100
+    rpc.get_logs(ADDR, [], 90, 98)
+    rpc.get_logs(ADDR, [], 90, 98)
+    assert b.methods.count('eth_getLogs') == 3
+    # the same in a batch
+    multi.health[b.url].head = None
+    rpc.batch([('eth_getLogs', [{'address': ADDR, 'topics': [], 'fromBlock': hex(80), 'toBlock': hex(98)}]),
+               ('eth_blockNumber', [])])
+    assert b.methods.count('eth_getLogs') == 4 and len(rpc.get_logs(ADDR, [], 80, 98)) == 19
+    assert b.methods.count('eth_getLogs') == 4
+    for n in (a, b):
+        n.close()
+    return True
+
+
+def test_invalid_requests():
+    rpc = CachingRpc(FakeChain())
+    assert _answer(rpc, {'jsonrpc': '2.0', 'id': 3})['error']['code'] == -32600
+    resps = _answer_batch(rpc, [{'jsonrpc': '2.0', 'id': 1, 'method': 'eth_blockNumber'}, 'nope',
+                                {'jsonrpc': '2.0', 'id': 2, 'params': []}])
+    assert resps[0] == {'jsonrpc': '2.0', 'id': 1, 'result': hex(100)}
+    assert [r['error']['code'] for r in resps[1:]] == [-32600, -32600] and resps[2]['id'] == 2
+    assert _answer_batch(rpc, [])['error']['code'] == -32600
+    return True
+
+
+def test_proxy():
+    chain = FakeChain()
+    server = mk_proxy(CachingRpc(chain), host='127.0.0.1', port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = JsonRpcClient(f"http://127.0.0.1:{server.server_address[1]}")
+    for _ in range(5):
+        assert client.get_block(10)['number'] == 10
+        assert client.get_transaction_receipts([txid(1), txid(2)])[1]['blockNumber'] == 2
+    try:
+        client.request('eth_nope', [])
+        assert False
+    except RpcError as e:
+        assert e.code == -32601
+    assert chain.calls['eth_getBlockByNumber'] == 1 and chain.calls['eth_getTransactionReceipt'] == 2
+    server.shutdown()
+    server.server_close()
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_final_data_cached, test_batch_and_eviction, test_concurrent_reads_shared,
+             test_final_on_the_answering_node, test_invalid_requests, test_proxy]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
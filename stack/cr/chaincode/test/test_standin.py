@@ -0,0 +1,85 @@
+import sys, os
+import time
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+sys.path.insert(0, os.path.join(main_dir, 'test'))
+
+import logging
+
+from eth_account import Account
+
+from rpc import JsonRpcClient, RpcTransportError
+from txpipe import NonceStream, sign_txs, wait_for_receipts
+from standin import StandinNode, TesterBackend
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestStandin')
+
+
+def test_latency_and_blocks():
+    backend = TesterBackend()
+    acct = Account.privateKeyToAccount("0x" + b"aedufghieuhiughekjudsdfahskljdhf".hex())
+    backend.fund(acct.address)
+    # blocks are mined by hand below; the interval just turns off mining on arrival
+    node = StandinNode(backend, latency=0.05, block_interval=3600).start()
+    rpc = JsonRpcClient(node.url)
+
+    start = time.monotonic()
+    head = rpc.block_number()
+    assert time.monotonic() - start >= 0.05
+
+    # txs wait in the pending pool for the next block
+    signed = sign_txs(acct, [{'to': acct.address, 'value': 1, 'gas': 21000, 'gasPrice': 1}] * 3,
+                      NonceStream.from_chain(rpc, acct.address))
+    rpc.send_raw_transactions([stx.raw for stx in signed])
+    assert rpc.get_transaction_receipt(signed[-1].txid) is None
+    backend.mine()
+    receipts = wait_for_receipts(rpc, [stx.txid for stx in signed], timeout=5, poll_rate=0.1)
+    assert all(r['blockNumber'] == head + 1 for r in receipts)
+
+    stats = node.stats()
+    assert stats['Calls']['eth_sendRawTransaction'] == 3
+    # the three sends went in one batch request
+    assert stats['Requests'] < sum(stats['Calls'].values())
+    node.stop()
+    return True
+
+
+def test_drops_and_rate_limit():
+    node = StandinNode(TesterBackend(), drop_rate=1.0).start()
+    try:
+        JsonRpcClient(node.url, retries=0).block_number()
+        assert False
+    except RpcTransportError:
+        pass
+    # the call was still carried out
+    assert node.stats()['Dropped'] == 1 and node.stats()['Calls']['eth_blockNumber'] == 1
+    node.stop()
+
+    node = StandinNode(TesterBackend(), rate_limit=5, latency=0.02).start()
+    rpc = JsonRpcClient(node.url, retries=0)
+    n_ok = 0
+    for _ in range(20):
+        start = time.monotonic()
+        try:
+            rpc.block_number()
+            n_ok += 1
+        except RpcTransportError:
+            pass
+        # a 429 comes back no faster than an answer
+        assert time.monotonic() - start >= 0.02
+    assert n_ok < 20 and node.stats()['Limited'] == 20 - n_ok
+    node.stop()
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_latency_and_blocks, test_drops_and_rate_limit]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
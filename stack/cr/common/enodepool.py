@@ -0,0 +1,106 @@
+'''A pool of spare, pre-generated enode keys for adding public (RPC) nodes without rebuilding the chainspec.
+
+Pool keys live in SSM as sv-<prefix>-enodekey-pool-<i> and their public keys are published together in
+sv-<prefix>-param-enode-pool-pks. A node claims key <i> at boot (claim_pool_key in nested/sv-public-node-new.yaml) by
+creating sv-<prefix>-param-enode-pool-claim-<i> with "<enode url> <instance id>" as the value; SSM refuses to create a
+parameter that already exists, so exactly one node wins each key. The claims double as the registry of pool nodes that
+`publish_peers` advertises (as a parity reserved peers file, which running public nodes follow via sv-chainspec-reload).
+
+Claims are released by `release_dead_claims` (on the pool's schedule) once their instance is terminated, so the key of a
+replaced or deleted node goes back into the pool. A stopped node keeps its key. Claims without an instance id (from
+before they recorded one) are never released automatically; delete the claim parameter to free one by hand.
+
+Pool nodes are extra nested stacks of nested/sv-public-node-new.yaml with pUseEnodePool=true (and a pNodeNumber not
+used by another public node).'''
+
+import json
+import logging
+from typing import Dict, List
+
+from lib import ssm, s3, ec2, get_ssm_param_no_enc, del_ssm_param, list_ssm_params_starting_with, \
+    gen_ssm_enodekey_pool, gen_ssm_enode_pool_pks, gen_ssm_enode_pool_claim, gen_ssm_enode_pks
+from keygen import new_seed, gen_keypairs
+
+log = logging.getLogger("enodepool")
+log.setLevel(logging.INFO)
+
+PEERS_OBJ_KEY = 'chain/reserved-peers.txt'
+
+
+def get_pool_pks(NamePrefix) -> Dict[str, str]:
+    return get_ssm_param_no_enc(gen_ssm_enode_pool_pks(NamePrefix), decode_json=True) or {}
+
+
+def get_claims(NamePrefix) -> Dict[str, str]:
+    '''{pool index: claim value ("<enode url> <instance id>", or just the url)} for every claimed key.'''
+    prefix = gen_ssm_enode_pool_claim(NamePrefix, '')
+    names = [p['Name'] for p in list_ssm_params_starting_with(prefix)]
+    claims = {}
+    for i in range(0, len(names), 10):
+        res = ssm.get_parameters(Names=names[i:i + 10])
+        claims.update({p['Name'][len(prefix):]: p['Value'] for p in res['Parameters']})
+    return claims
+
+
+def release_dead_claims(NamePrefix, **props) -> dict:
+    '''Delete the claims of nodes whose instance is terminated (or long gone), so their keys are spare again.'''
+    by_instance = {}  # type: Dict[str, List[str]]
+    for (i, value) in get_claims(NamePrefix).items():
+        parts = value.split()
+        if len(parts) > 1:
+            by_instance.setdefault(parts[1], []).append(i)
+    ids = sorted(by_instance)
+    alive = set()
+    for start in range(0, len(ids), 200):
+        # a filter rather than InstanceIds, which fails outright on an id EC2 has forgotten
+        pages = ec2.get_paginator('describe_instances').paginate(
+            Filters=[{'Name': 'instance-id', 'Values': ids[start:start + 200]}])
+        alive.update(inst['InstanceId'] for page in pages for r in page['Reservations'] for inst in r['Instances']
+                     if inst['State']['Name'] not in ('shutting-down', 'terminated'))
+    released = sorted((i for iid in ids if iid not in alive for i in by_instance[iid]), key=int)
+    for i in released:
+        del_ssm_param(gen_ssm_enode_pool_claim(NamePrefix, i))
+    if released:
+        log.info(f"[release_dead_claims] released pool keys {released}")
+    return {'EnodePoolReleased': len(released)}
+
+
+def refill_enode_pool(NamePrefix, NSpareEnodeKeys, **props) -> dict:
+    '''Generate keys until there are `NSpareEnodeKeys` unclaimed ones.'''
+    pool = get_pool_pks(NamePrefix)
+    claims = get_claims(NamePrefix)
+    n_spare = sum(1 for i in pool if i not in claims)
+    n_new = max(0, int(NSpareEnodeKeys) - n_spare)
+    if n_new == 0:
+        return {'EnodePoolSize': len(pool), 'EnodePoolSpare': n_spare, 'EnodePoolAdded': 0}
+
+    start = max([int(i) for i in pool] + [-1]) + 1
+    for kp in gen_keypairs(new_seed(), 'enode-pool', range(start, start + n_new)):
+        ssm.put_parameter(Name=gen_ssm_enodekey_pool(NamePrefix, kp.index), Value=kp.privkey.hex(),
+                          Description="ENODE Private key #{} in the spare public node pool".format(kp.index),
+                          Type='SecureString')
+        pool[str(kp.index)] = kp.pubkey.hex()
+    # keys are stored before their pubkeys are published so anything in the published list can be claimed
+    ssm.put_parameter(Name=gen_ssm_enode_pool_pks(NamePrefix), Value=json.dumps(pool, sort_keys=True),
+                      Description="Public keys of the spare enode key pool", Type='String', Overwrite=True)
+    log.info(f"[refill_enode_pool] added {n_new} keys starting at #{start}")
+    return {'EnodePoolSize': len(pool), 'EnodePoolSpare': n_spare + n_new, 'EnodePoolAdded': n_new}
+
+
+def publish_peers(NamePrefix, StaticBucketName, pEnodeIps='', **props) -> dict:
+    '''Write every known enode (chainspec nodes + claimed pool nodes) to a reserved peers file in the static bucket.'''
+    enode_pks = get_ssm_param_no_enc(gen_ssm_enode_pks(NamePrefix), decode_json=True) or []
+    peers = ["enode://{pk}@{ip}:30303".format(pk=pk, ip=ip) for (pk, ip) in zip(enode_pks, pEnodeIps.split(','))]
+    peers += [value.split()[0] for (_, value) in sorted(get_claims(NamePrefix).items(), key=lambda kv: int(kv[0]))]
+    s3.put_object(Key=PEERS_OBJ_KEY, Body='\n'.join(peers) + '\n', Bucket=StaticBucketName, ACL='public-read',
+                  ContentType='text/plain', CacheControl='max-age=60')
+    return {'ReservedPeersUrl': '{}/{}/{}'.format(s3.meta.endpoint_url, StaticBucketName, PEERS_OBJ_KEY),
+            'NReservedPeers': len(peers)}
+
+
+def delete_enode_pool(NamePrefix, **props) -> dict:
+    names = [p['Name'] for p in list_ssm_params_starting_with(gen_ssm_enodekey_pool(NamePrefix, ''),
+                                                              gen_ssm_enode_pool_claim(NamePrefix, ''))]
+    for name in names + [gen_ssm_enode_pool_pks(NamePrefix)]:
+        del_ssm_param(name)
+    return {'DeletedEnodePool': True}
@@ -0,0 +1,74 @@
+'''secp256k1 key generation for node, enode and service keys.
+
+Keys are derived as sha512(seed || purpose || index)[:32] from a single local seed, so any index can be generated
+independently of the others. coincurve (libsecp256k1) is used when it's installed, and then batches are spread over a
+thread pool: its calls go through cffi, which releases the GIL. Otherwise we fall back to the pure-python `ecdsa`
+package, which holds the GIL, so keys are generated one after another (lambda has no /dev/shm for a process pool).'''
+
+import hashlib
+import logging
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Iterable, NamedTuple
+
+from eth_utils import keccak, to_checksum_address
+
+try:
+    import coincurve
+    BACKEND = 'coincurve'
+except ImportError:
+    coincurve = None
+    from ecdsa import SigningKey, SECP256k1
+    BACKEND = 'ecdsa'
+
+log = logging.getLogger("keygen")
+log.setLevel(logging.INFO)
+
+SECP256K1_N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+
+KeyPair = NamedTuple('KeyPair', [('index', int), ('privkey', bytes), ('pubkey', bytes), ('address', str)])
+
+
+def new_seed() -> bytes:
+    return secrets.token_bytes(64)
+
+
+def derive_privkey(seed: bytes, purpose: str, index: int) -> bytes:
+    ctr = 0
+    while True:
+        # the counter only matters in the (astronomically unlikely) case a hash is not a valid secret
+        h = hashlib.sha512(seed + purpose.encode() + index.to_bytes(4, 'big') + ctr.to_bytes(4, 'big')).digest()[:32]
+        if 0 < int.from_bytes(h, 'big') < SECP256K1_N:
+            return h
+        ctr += 1
+
+
+def privkey_to_pubkey(privkey: bytes) -> bytes:
+    '''64 byte uncompressed public key (no 0x04 prefix), as used in enode ids and for addresses.'''
+    if coincurve is not None:
+        return coincurve.PublicKey.from_valid_secret(privkey).format(compressed=False)[1:]
+    return SigningKey.from_string(privkey, curve=SECP256k1).get_verifying_key().to_string()
+
+
+def pubkey_to_address(pubkey: bytes) -> str:
+    return to_checksum_address(keccak(pubkey)[-20:])
+
+
+def gen_keypair(seed: bytes, purpose: str, index: int) -> KeyPair:
+    return keypair_from_privkey(index, derive_privkey(seed, purpose, index))
+
+
+def keypair_from_privkey(index: int, privkey: bytes) -> KeyPair:
+    pubkey = privkey_to_pubkey(privkey)
+    return KeyPair(index, privkey, pubkey, pubkey_to_address(pubkey))
+
+
+def gen_keypairs(seed: bytes, purpose: str, indices: Iterable[int], workers=4, batch_size=16) -> List[KeyPair]:
+    '''Generate keys for `indices` (in parallel batches with coincurve); results are in the same order as `indices`.'''
+    indices = list(indices)
+    batches = [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+    if len(batches) <= 1 or workers <= 1 or coincurve is None:
+        return [gen_keypair(seed, purpose, i) for i in indices]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(lambda b: [gen_keypair(seed, purpose, i) for i in b], batches)
+        return [kp for batch in results for kp in batch]
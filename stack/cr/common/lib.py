@@ -1,18 +1,19 @@
-import binascii
 import json
 import logging
 import os, secrets
 import string
 import time
-import urllib
 import hashlib
+import zlib
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, NamedTuple
-from ecdsa import SigningKey, SECP256k1
+from typing import List, NamedTuple, Dict, Optional
 
 import boto3
 
-from eth_account.account import Account
+from keygen import new_seed, gen_keypairs, keypair_from_privkey, KeyPair
+from rpc import JsonRpcClient
+from s3purge import purge_bucket
 
 SsmParam = NamedTuple('SsmParam',
                       [('Name', str), ('Type', str), ('KeyId', str), ('LastModifiedDate', datetime),
@@ -23,7 +24,35 @@ SVC_MEMBERS = "members"
 SVC_CASTVOTE = "castvote"
 SERVICES = [SVC_CHAINCODE, SVC_MEMBERS, SVC_CASTVOTE]
 
+# clients are module level so they're reused across warm invocations
 ssm = boto3.client('ssm')
+s3 = boto3.client('s3')
+ec2 = boto3.client('ec2')
+lambda_client = boto3.client('lambda')
+
+_ssm_snapshot = None  # type: Optional[Dict[str, str]]
+
+
+@contextmanager
+def ssm_snapshot():
+    '''Within this block get_ssm_param_no_enc only fetches each param once. Writes through `ssm` drop the written
+    params from the snapshot, so a handler always reads its own writes.'''
+    global _ssm_snapshot
+    _ssm_snapshot = {}
+    try:
+        yield
+    finally:
+        _ssm_snapshot = None
+
+
+def _drop_from_ssm_snapshot(params, **kwargs):
+    if _ssm_snapshot is not None:
+        for name in [params.get('Name')] + params.get('Names', []):
+            _ssm_snapshot.pop(name, None)
+
+
+for _op in ['PutParameter', 'DeleteParameter', 'DeleteParameters']:
+    ssm.meta.events.register(f'provide-client-params.ssm.{_op}', _drop_from_ssm_snapshot)
 
 
 class Timer:
@@ -52,31 +81,21 @@ def update_dict(_dict, _new_fields):
     return _dict
 
 
-def http_get(url: str) -> bytes:
-    with urllib.request.urlopen(url) as r:
-        return r.read()
-
-
-def _hash(bs: bytes) -> bytes:
-    return hashlib.sha512(bs).digest()
-
-
-def get_some_entropy() -> bytes:
-    '''Use various online sources + urandom to generate entropy'''
-    sources = [secrets.token_bytes(128), _hash(http_get("https://www.grc.com/passwords.htm"))]
-    return _hash(b''.join(sources))
+def remove_s3_bucket_objs(StaticBucketName, remaining_time=None, **params):
+    ret = purge_bucket(s3, StaticBucketName, remaining_time=remaining_time)
+    ret['DeletedS3Bucket'] = ret['Complete']
+    return ret
 
 
-def remove_s3_bucket_objs(StaticBucketName, **params):
-    return {'DeletedS3Bucket': str(boto3.resource('s3').Bucket(StaticBucketName).objects.filter().delete())}
+def gen_ec2_key_pair_name(NamePrefix):
+    return "sv-{}-node-ec2-ssh-key".format(NamePrefix)  # , int(time.time()))
 
 
 def generate_ec2_key(ShouldGenEc2SSHKey: bool, NamePrefix: str, SSHEncryptionPassword: str, AdminEmail, **kwargs):
     logging.info("gen_ec2_key: %s", {'ShouldGenEc2SSHKey': ShouldGenEc2SSHKey, 'NamePrefix': NamePrefix})
     ret = {'CreatedEc2KeyPair': False}
-    KeyPairName = "sv-{}-node-ec2-ssh-key".format(NamePrefix)  # , int(time.time()))
+    KeyPairName = gen_ec2_key_pair_name(NamePrefix)
     ret['KeyPairName'] = KeyPairName
-    ec2 = boto3.client('ec2')
     kps = ec2.describe_key_pairs()
     if sum([kp['KeyName'] == KeyPairName for kp in
             kps['KeyPairs']]) == 0:  # this should always be 0 if we add a timestamp to the SSH key
@@ -97,16 +116,17 @@ def generate_ec2_key(ShouldGenEc2SSHKey: bool, NamePrefix: str, SSHEncryptionPas
     return ret
 
 
-def priv_to_addr(_priv):
-    return Account.privateKeyToAccount(_priv).address
-
-
 def get_ssm_param_no_enc(name, decode_json=False):
-    try:
-        value = ssm.get_parameter(Name=name)['Parameter']['Value']
-    except Exception as e:
-        logging.warning(f"Error during get_parameter: {repr(e)}")
-        return None
+    if _ssm_snapshot is not None and name in _ssm_snapshot:
+        value = _ssm_snapshot[name]
+    else:
+        try:
+            value = ssm.get_parameter(Name=name)['Parameter']['Value']
+        except Exception as e:
+            logging.warning(f"Error during get_parameter: {repr(e)}")
+            return None
+        if _ssm_snapshot is not None:
+            _ssm_snapshot[name] = value
     if decode_json:
         value = json.loads(value)
     return value
@@ -145,6 +165,18 @@ def gen_ssm_enodekey_public(NamePrefix, i):
     return "sv-{}-enodekey-public-{}".format(NamePrefix, i)
 
 
+def gen_ssm_enodekey_pool(NamePrefix, i):
+    return "sv-{}-enodekey-pool-{}".format(NamePrefix, i)
+
+
+def gen_ssm_enode_pool_pks(NamePrefix):
+    return 'sv-{}-param-enode-pool-pks'.format(NamePrefix)
+
+
+def gen_ssm_enode_pool_claim(NamePrefix, i):
+    return 'sv-{}-param-enode-pool-claim-{}'.format(NamePrefix, i)
+
+
 def gen_ssm_nodekey_service(NamePrefix, eth_service):
     return "sv-{}-nodekey-service-{}".format(NamePrefix, eth_service)
 
@@ -161,6 +193,10 @@ def gen_ssm_enode_pks(NamePrefix):
     return 'sv-{}-param-enode-pks'.format(NamePrefix)
 
 
+def gen_ssm_validator_transitions(NamePrefix):
+    return 'sv-{}-param-validator-transitions'.format(NamePrefix)
+
+
 def gen_ssm_networkid(NamePrefix):
     return 'sv-{}-param-networkid'.format(NamePrefix)
 
@@ -207,53 +243,147 @@ def del_ssm_param(name):
             raise e
 
 
-def create_node_keys(NConsensusNodes, NamePrefix, NPublicNodes, **kwargs) -> (list, list, list):
-    _e = get_some_entropy()
+def get_ssm_params_with_enc(names: List[str]) -> dict:
+    '''Batch version of get_ssm_param_with_enc; missing params are left out of the result.'''
+    found = {}
+    for i in range(0, len(names), 10):  # GetParameters takes at most 10 names
+        res = ssm.get_parameters(Names=names[i:i + 10], WithDecryption=True)
+        found.update({p['Name']: p['Value'] for p in res['Parameters']})
+    return found
 
-    def gen_next_key(hex_prefix="0x"):
-        nonlocal _e
-        _h = _hash(_e)
-        _privkey = hex_prefix + binascii.hexlify(_h[:32]).decode()
-        _e = _h[32:]
-        assert len(_e) >= 32
-        pk = priv_to_addr(_privkey)
-        return _privkey, pk
 
-    keys = []
-    poa_pks = []
-    service_pks = {}
-    enode_pks = []
-    for i in range(int(NConsensusNodes)):  # max nConsensusNodes
-        (_privkey, pk) = gen_next_key()
-        keys.append({'Name': gen_ssm_nodekey_consensus(NamePrefix, i),
-                     'Description': "Private key for consensus node #{}".format(i),
-                     'Value': _privkey, 'Type': 'SecureString'})
-        poa_pks.append(pk)
+def load_or_gen_keypairs(seed: bytes, purpose: str, indices: List[int], ssm_names: List[str]) -> (List[KeyPair], set):
+    '''Keys already in SSM (e.g. left behind by an earlier scale-down) are reused so a node index always keeps the same
+    key; the rest are generated. Returns the keypairs (in `indices` order) and the indices that are new.'''
+    existing = get_ssm_params_with_enc(ssm_names)
+    missing = [i for (i, name) in zip(indices, ssm_names) if name not in existing]
+    generated = {kp.index: kp for kp in gen_keypairs(seed, purpose, missing)}
+    keypairs = [generated[i] if i in generated else keypair_from_privkey(i, bytes.fromhex(existing[name].replace('0x', '')))
+                for (i, name) in zip(indices, ssm_names)]
+    return keypairs, set(missing)
 
-    logging.info(f"poa_pks: {poa_pks}")
 
-    for eth_service in SERVICES:
-        (_privkey, pk) = gen_next_key()
-        keys.append({'Name': gen_ssm_nodekey_service(NamePrefix, eth_service),
-                     'Description': "Private key for service lambda: {}".format(eth_service),
-                     'Value': _privkey, 'Type': 'SecureString'})
-        service_pks[eth_service] = pk
+def create_node_keys(NConsensusNodes, NamePrefix, NPublicNodes, consensus_from=0, public_from=0,
+                     include_services=True, **kwargs) -> dict:
+    '''Keys for consensus nodes [consensus_from, NConsensusNodes) and public nodes [public_from, NPublicNodes), plus
+    the service keys if `include_services`. `ssm_keys` only contains keys that aren't in SSM yet.'''
+    seed = new_seed()
+
+    keys = []
+    c_indices = list(range(int(consensus_from), int(NConsensusNodes)))
+    consensus, new_c = load_or_gen_keypairs(seed, 'consensus', c_indices,
+                                            [gen_ssm_nodekey_consensus(NamePrefix, i) for i in c_indices])
+    for kp in consensus:
+        if kp.index in new_c:
+            keys.append({'Name': gen_ssm_nodekey_consensus(NamePrefix, kp.index),
+                         'Description': "Private key for consensus node #{}".format(kp.index),
+                         'Value': '0x' + kp.privkey.hex(), 'Type': 'SecureString'})
+    poa_pks = [kp.address for kp in consensus]
 
-    logging.info(f"service_pks: {service_pks}")
+    logging.info(f"poa_pks: {poa_pks}")
 
-    for i in range(int(NPublicNodes)):
-        (_privkey, _) = gen_next_key(hex_prefix='')
-        pk = SigningKey.from_string(bytes.fromhex(_privkey), curve=SECP256k1).get_verifying_key().to_string().hex()
-        keys.append({'Name': gen_ssm_enodekey_public(NamePrefix, i),
-                     'Description': "ENODE Private key for public node #{} (not address)".format(i),
-                     'Value': _privkey, 'Type': 'SecureString'})
-        enode_pks.append(pk)
+    service_pks = {}
+    if include_services:
+        s_indices = list(range(len(SERVICES)))
+        services, new_s = load_or_gen_keypairs(seed, 'service', s_indices,
+                                               [gen_ssm_nodekey_service(NamePrefix, svc) for svc in SERVICES])
+        for (eth_service, kp) in zip(SERVICES, services):
+            if kp.index in new_s:
+                keys.append({'Name': gen_ssm_nodekey_service(NamePrefix, eth_service),
+                             'Description': "Private key for service lambda: {}".format(eth_service),
+                             'Value': '0x' + kp.privkey.hex(), 'Type': 'SecureString'})
+            service_pks[eth_service] = kp.address
+
+        logging.info(f"service_pks: {service_pks}")
+
+    p_indices = list(range(int(public_from), int(NPublicNodes)))
+    enodes, new_p = load_or_gen_keypairs(seed, 'enode', p_indices,
+                                         [gen_ssm_enodekey_public(NamePrefix, i) for i in p_indices])
+    for kp in enodes:
+        if kp.index in new_p:
+            keys.append({'Name': gen_ssm_enodekey_public(NamePrefix, kp.index),
+                         'Description': "ENODE Private key for public node #{} (not address)".format(kp.index),
+                         'Value': kp.privkey.hex(), 'Type': 'SecureString'})
+    enode_pks = [kp.pubkey.hex() for kp in enodes]
 
     logging.info(f"enode_pks: {enode_pks}")
 
     return {'ssm_keys': keys, 'poa_pks': poa_pks, 'service_pks': service_pks, 'enode_pks': enode_pks}
 
 
+def min_transition_delay_blocks(n_nodes: int) -> int:
+    '''Blocks it takes every node to pick up a republished chainspec and restart parity with it: sv-chainspec-reload
+    (nested/sv-ec2-node.yaml) polls once a minute, and node n restarts n * CHAINSPEC_RELOAD_STAGGER_S after noticing.'''
+    secs = CHAINSPEC_RELOAD_POLL_S + CHAINSPEC_MAX_AGE_S + n_nodes * CHAINSPEC_RELOAD_STAGGER_S + PARITY_RESTART_S
+    return -(-secs // BLOCK_TIME_S)
+
+
+def get_transition_block(n_nodes: int, pEnodeIps='', ValidatorTransitionBlock='', TransitionDelayBlocks='120',
+                         **props) -> int:
+    '''Block at which a new validator set takes effect. Every node has to have restarted with the republished
+    chainspec before then (a node still on the old one forks off at that block), so it's at least
+    min_transition_delay_blocks past the current head of public node 0; by default TransitionDelayBlocks past it.'''
+    rpc_url = "http://{}:8545".format(pEnodeIps.split(',')[0])
+    head = JsonRpcClient(rpc_url).block_number()
+    min_delay = min_transition_delay_blocks(n_nodes)
+    if ValidatorTransitionBlock:
+        block = int(ValidatorTransitionBlock)
+        if block < head + min_delay:
+            raise Exception(f"Refusing validator transition at block {block}: the {n_nodes} nodes need until block "
+                            f"{head + min_delay} to reload the chainspec (head is {head})")
+        return block
+    return head + max(int(TransitionDelayBlocks), min_delay)
+
+
+def get_validator_transitions(NamePrefix) -> dict:
+    '''{block number (str): [validator addresses]}; stacks from before transitions existed only have genesis's list.'''
+    transitions = get_ssm_param_no_enc(gen_ssm_validator_transitions(NamePrefix), decode_json=True)
+    if transitions is None:
+        transitions = {"0": get_ssm_param_no_enc(gen_ssm_key_poa_pks(NamePrefix), decode_json=True)}
+    return transitions
+
+
+def save_validator_transitions(transitions: dict, NamePrefix, **props):
+    ssm.put_parameter(Name=gen_ssm_validator_transitions(NamePrefix),
+                      Description="Validator set transitions (block number -> PoA addresses)",
+                      Value=json.dumps(transitions, sort_keys=True),
+                      Type='String', Overwrite=True)
+    return {"SavedValidatorTransitions": True}
+
+
+def scale_node_keys(NamePrefix, NConsensusNodes, NPublicNodes, OldNConsensusNodes, OldNPublicNodes, **props) -> dict:
+    '''Grow or shrink the consensus/public node sets. Only new indices get keys; removed indices keep theirs in SSM so
+    scaling back up reuses them. A validator set change is scheduled as a `validators.multi` transition.'''
+    (n_c, n_p, old_c, old_p) = map(int, (NConsensusNodes, NPublicNodes, OldNConsensusNodes, OldNPublicNodes))
+    old_poa_pks = get_ssm_param_no_enc(gen_ssm_key_poa_pks(NamePrefix), decode_json=True)
+    ret = {'UpdatedPrivKeys': False, 'PoAAddresses': old_poa_pks}
+    if (n_c, n_p) == (old_c, old_p):
+        return ret
+
+    # before anything is written, so a transition that's too soon leaves the stack as it was
+    block = get_transition_block(max(n_c, old_c, n_p, old_p), **props) if n_c != old_c else None
+
+    _keys = create_node_keys(n_c, NamePrefix, n_p, consensus_from=min(old_c, n_c), public_from=min(old_p, n_p),
+                             include_services=False)
+    ret.update(save_node_keys(_keys['ssm_keys'], NamePrefix))
+    ret['UpdatedPrivKeys'] = True
+
+    if n_c != old_c:
+        poa_pks = old_poa_pks[:min(old_c, n_c)] + _keys['poa_pks']
+        transitions = get_validator_transitions(NamePrefix)
+        transitions[str(block)] = poa_pks
+        ret.update(save_poa_pks(poa_pks, NamePrefix, overwrite=True))
+        ret.update(save_validator_transitions(transitions, NamePrefix))
+        ret.update({'PoAAddresses': poa_pks, 'ValidatorTransitionBlock': block})
+        logging.info(f"validators {old_c} -> {n_c} at block {block}: {poa_pks}")
+
+    if n_p != old_p:
+        old_enode_pks = get_ssm_param_no_enc(gen_ssm_enode_pks(NamePrefix), decode_json=True)
+        ret.update(save_enode_pks(old_enode_pks[:min(old_p, n_p)] + _keys['enode_pks'], NamePrefix, overwrite=True))
+
+    return ret
+
+
 def save_node_keys(keys: list, NamePrefix, **kwargs):
     existing_ssm = list_ssm_params_starting_with("sv-{}-nodekey-consensus".format(NamePrefix),
                                                  "sv-{}-param-poa-pk".format(NamePrefix))
@@ -270,11 +400,11 @@ def save_node_keys(keys: list, NamePrefix, **kwargs):
     return {'SavedConsensusNodePrivKeys': True, 'SkippedConsensusNodePrivKeys': skipped_params}
 
 
-def save_poa_pks(poa_pks, NamePrefix, **props):
+def save_poa_pks(poa_pks, NamePrefix, overwrite=False, **props):
     ssm.put_parameter(Name=gen_ssm_key_poa_pks(NamePrefix),
                       Description="PoA addresses (as in chainspec)",
                       Value=json.dumps(poa_pks),
-                      Type='String')
+                      Type='String', Overwrite=overwrite)
     return {"SavedPoaPks": True}
 
 
@@ -286,11 +416,11 @@ def save_service_pks(service_pks, NamePrefix, **props):
     return {"SavedPoaPks": True}
 
 
-def save_enode_pks(enode_pks, NamePrefix, **props):
+def save_enode_pks(enode_pks, NamePrefix, overwrite=False, **props):
     ssm.put_parameter(Name=gen_ssm_enode_pks(NamePrefix),
                       Description="Public nodes ENODE ids (for chainspec)",
                       Value=json.dumps(enode_pks),
-                      Type='String')
+                      Type='String', Overwrite=overwrite)
     return {"SavedPublicEnodes": True}
 
 
@@ -303,9 +433,11 @@ def delete_all_node_keys(NamePrefix, NConsensusNodes, NPublicNodes, **props):
                 raise e
 
     try_del(gen_ssm_key_poa_pks(NamePrefix))
-    consensus_node_keys = [gen_ssm_nodekey_consensus(NamePrefix, i) for i in range(int(NConsensusNodes))]
-    public_enode_keys = [gen_ssm_enodekey_public(NamePrefix, i) for i in range(int(NPublicNodes))]
-    for name in consensus_node_keys + public_enode_keys:
+    try_del(gen_ssm_validator_transitions(NamePrefix))
+    # list rather than range(N) so keys kept around after a scale-down are removed too
+    node_keys = list_ssm_params_starting_with(gen_ssm_nodekey_consensus(NamePrefix, ''),
+                                              gen_ssm_enodekey_public(NamePrefix, ''))
+    for name in [p['Name'] for p in node_keys]:
         try_del(name)
     try_del(gen_ssm_service_pks(NamePrefix))
     try_del(gen_ssm_enode_pks(NamePrefix))
@@ -338,24 +470,88 @@ def del_ssm_networkid_ethstats(NamePrefix, **props):
     return {'DeletedSSMNetworkIdAndEthStats': True}
 
 
+CHAINSPEC_OBJ_KEY = 'chain/chainspec.json'
+CHAINSPEC_MAX_AGE_S = 60
+CHAINSPEC_CACHE_CONTROL = f'public, max-age={CHAINSPEC_MAX_AGE_S}'  # the chainspec changes (rarely) on stack updates
+# must match sv-chainspec-reload's cron schedule and stagger in nested/sv-ec2-node.yaml
+CHAINSPEC_RELOAD_POLL_S = 60
+CHAINSPEC_RELOAD_STAGGER_S = 30
+PARITY_RESTART_S = 60
+BLOCK_TIME_S = 5  # authorityRound stepDuration
+
+
+def encode_chainspec(chainspec: dict) -> (bytes, bytes, str):
+    '''Encode the chainspec deterministically (sorted keys, no whitespace) so unchanged specs hash the same.
+    Returns (json, gzipped json, sha256 hex of the json).'''
+    raw = json.dumps(chainspec, sort_keys=True, separators=(',', ':')).encode()
+    gz = zlib.compressobj(9, zlib.DEFLATED, 31)  # wbits=31 -> gzip container with a fixed (zero) mtime
+    return raw, gz.compress(raw) + gz.flush(), hashlib.sha256(raw).hexdigest()
+
+
 def upload_chain_config(NamePrefix, StaticBucketName, **params):
     poa_pks = json.loads(ssm.get_parameter(Name=gen_ssm_key_poa_pks(NamePrefix))['Parameter']['Value'])
+    transitions = get_validator_transitions(NamePrefix)
     service_pks: dict = json.loads(ssm.get_parameter(Name=gen_ssm_service_pks(NamePrefix))['Parameter']['Value'])
     enode_pks = json.loads(ssm.get_parameter(Name=gen_ssm_enode_pks(NamePrefix))['Parameter']['Value'])
 
-    chainspec = json.dumps(gen_chainspec_json(poa_pks, list(service_pks.values()), enode_pks, NamePrefix=NamePrefix, **params))
-    ret = {'ChainSpecGenerated': True}
-    obj_key = 'chain/chainspec.json'
-    s3 = boto3.client('s3')
-    put_resp = s3.put_object(Key=obj_key, Body=chainspec, Bucket=StaticBucketName, ACL='public-read')
+    return publish_chainspec(StaticBucketName, gen_chainspec_json(
+        poa_pks, list(service_pks.values()), enode_pks, NamePrefix=NamePrefix, validator_transitions=transitions,
+        **params))
+
+
+def republish_validators(NamePrefix, StaticBucketName, **params):
+    '''On a stack update: the published chainspec with only its validator transitions replaced. Genesis (the gas
+    limit, accounts, extraData) and the chain params are kept as published, since any change there is a different
+    genesis hash and the reloaded nodes would start a new chain. If nothing is published yet it's generated.'''
+    try:
+        published = json.loads(s3.get_object(Bucket=StaticBucketName, Key=CHAINSPEC_OBJ_KEY)['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        logging.info("No published chainspec; generating one")
+        return upload_chain_config(NamePrefix=NamePrefix, StaticBucketName=StaticBucketName, **params)
+    published['engine']['authorityRound']['params']['validators'] = {
+        'multi': validators_multi(get_validator_transitions(NamePrefix))}
+    return publish_chainspec(StaticBucketName, published)
+
+
+def publish_chainspec(StaticBucketName, chainspec: dict):
+    chainspec, chainspec_gz, sha256 = encode_chainspec(chainspec)
+    ret = {'ChainSpecGenerated': True, 'ChainSpecSha256': sha256}
+    obj_key = CHAINSPEC_OBJ_KEY
+    gz_obj_key = obj_key + '.gz'
     ret['ChainSpecUrl'] = '{}/{}/{}'.format(s3.meta.endpoint_url, StaticBucketName, obj_key)
+    ret['ChainSpecGzUrl'] = '{}/{}/{}'.format(s3.meta.endpoint_url, StaticBucketName, gz_obj_key)
+
+    try:
+        existing_sha256 = s3.head_object(Bucket=StaticBucketName, Key=gz_obj_key)['Metadata'].get('sha256')
+    except Exception as e:
+        logging.info(f"No existing chainspec to compare against: {repr(e)}")
+        existing_sha256 = None
+    if existing_sha256 == sha256:
+        logging.info(f"Chainspec unchanged ({sha256}); skipping upload")
+        ret['ChainSpecUploaded'] = False
+        return ret
+
+    common = dict(Bucket=StaticBucketName, ACL='public-read', ContentType='application/json',
+                  CacheControl=CHAINSPEC_CACHE_CONTROL, Metadata={'sha256': sha256})
+    s3.put_object(Key=obj_key, Body=chainspec, **common)
+    # the gz object is written last since its hash is what we compare against next time
+    s3.put_object(Key=gz_obj_key, Body=chainspec_gz, ContentEncoding='gzip', **common)
+    logging.info(f"Uploaded chainspec {sha256}: {len(chainspec)} bytes, {len(chainspec_gz)} gzipped")
+    ret['ChainSpecUploaded'] = True
     return ret
 
 
-def gen_chainspec_json(poa_addresses: list, service_addresses: list, enode_pks: list, pEnodeIps, **params) -> dict:
+def validators_multi(validator_transitions: dict) -> dict:
+    return {str(block): {"list": addrs} for (block, addrs) in sorted(validator_transitions.items(),
+                                                                     key=lambda kv: int(kv[0]))}
+
+
+def gen_chainspec_json(poa_addresses: list, service_addresses: list, enode_pks: list, pEnodeIps,
+                       validator_transitions: dict = None, **params) -> dict:
     """
     :param poa_addresses: list of addresses for the proof of authority nodes
     :param service_addresses: list of addresses for services (i.e the lambdas that do things like onboarding members)
+    :param validator_transitions: {block number: addresses} validator sets; defaults to poa_addresses from genesis
     :return: dict: the chainspec
     """
 
@@ -367,6 +563,9 @@ def gen_chainspec_json(poa_addresses: list, service_addresses: list, enode_pks:
 
     INIT_BAL = hex(160693804425899027554196209234)
 
+    if validator_transitions is None:
+        validator_transitions = {"0": poa_addresses}
+
     builtins = {"0000000000000000000000000000000000000001": {
         "balance": "1", "builtin": {"name": "ecrecover", "pricing": {"linear": {"base": 3000, "word": 0}}}},
         "0000000000000000000000000000000000000002": {
@@ -399,11 +598,7 @@ def gen_chainspec_json(poa_addresses: list, service_addresses: list, enode_pks:
                     "stepDuration": "5",
                     "blockReward": "0x4563918244F40000",
                     "validators": {
-                        "multi": {
-                            "0": {
-                                "list": poa_addresses
-                            }
-                        }
+                        "multi": validators_multi(validator_transitions)
                     },
                     "maximumUncleCountTransition": 0,
                     "maximumUncleCount": 0
@@ -0,0 +1,81 @@
+'''Fetch event logs over a long block range with eth_getLogs.
+
+The range is cut into spans that are fetched in parallel. Span size adapts as we go: it doubles while responses come
+back small and halves when a node refuses a range (too many results, response too large, timeout), in which case the
+failed range is split in two and retried. Nodes differ in their limits, so nothing here assumes a particular one.'''
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Tuple
+
+from rpc import RpcError, RpcTransportError
+
+log = logging.getLogger("logscan")
+log.setLevel(logging.INFO)
+
+
+class LogScan:
+    def __init__(self, rpc, address: str, topics: List, initial_span=5000, min_span=1, max_span=200000,
+                 target_logs=2000, workers=4):
+        self.rpc = rpc
+        self.address = address
+        self.topics = topics
+        self.span = initial_span
+        self.min_span = min_span
+        self.max_span = max_span
+        self.target_logs = target_logs
+        self.workers = workers
+        self.n_requests = 0
+        self.n_splits = 0
+
+    def _fetch(self, rng: Tuple[int, int]) -> List[Dict]:
+        return self.rpc.get_logs(self.address, self.topics, rng[0], rng[1])
+
+    def _adapt(self, n_logs: int):
+        if n_logs < self.target_logs // 2:
+            self.span = min(self.max_span, self.span * 2)
+        elif n_logs > self.target_logs:
+            self.span = max(self.min_span, self.span // 2)
+
+    def fetch(self, from_block: int, to_block: int) -> List[Dict]:
+        '''All logs in [from_block, to_block], ordered by (blockNumber, logIndex).'''
+        start = time.time()
+        logs = []
+        cursor = from_block
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            in_flight = {}  # future -> range
+            retry = []  # ranges to refetch after a split
+            while cursor <= to_block or retry or in_flight:
+                while len(in_flight) < self.workers and (retry or cursor <= to_block):
+                    if retry:
+                        rng = retry.pop()
+                    else:
+                        rng = (cursor, min(to_block, cursor + self.span - 1))
+                        cursor = rng[1] + 1
+                    in_flight[pool.submit(self._fetch, rng)] = rng
+                    self.n_requests += 1
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for f in done:
+                    rng = in_flight.pop(f)
+                    try:
+                        got = f.result()
+                    except (RpcError, RpcTransportError) as e:
+                        if rng[0] == rng[1]:
+                            raise e
+                        mid = (rng[0] + rng[1]) // 2
+                        retry += [(mid + 1, rng[1]), (rng[0], mid)]
+                        self.span = max(self.min_span, (rng[1] - rng[0] + 1) // 2)
+                        self.n_splits += 1
+                        log.info(f"[LogScan] split {rng} after {e}; span now {self.span}")
+                        continue
+                    logs += got
+                    self._adapt(len(got))
+        logs.sort(key=lambda l: (l['blockNumber'], l['logIndex']))
+        log.info(f"[LogScan] {len(logs)} logs from blocks {from_block}..{to_block} in {self.n_requests} requests "
+                 f"({self.n_splits} splits) in {time.time() - start:.2f}s")
+        return logs
+
+
+def fetch_logs(rpc, address: str, topics: List, from_block: int, to_block: int, **kwargs) -> List[Dict]:
+    return LogScan(rpc, address, topics, **kwargs).fetch(from_block, to_block)
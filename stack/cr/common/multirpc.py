@@ -0,0 +1,291 @@
+'''A JSON-RPC provider over all of the stack's public nodes.
+
+MultiNodeRpc has JsonRpcClient's interface, but each request goes to one of several nodes:
+
+- reads go to the healthiest node, ranked by a moving average of its latency. If it hasn't answered within
+  `hedge_after`, the same read goes to the next node too, and whichever answers first wins. A node that fails
+  (transport error, HTTP error) is skipped in favour of the next one and rested for `cooldown` seconds.
+- writes (and nonce lookups) stick to one node for as long as it stays healthy, so our own pending txs and the nonces
+  we're handed agree. When that node fails, the next best one becomes sticky.
+- every `probe_interval` seconds all nodes are asked for eth_blockNumber. A node more than `max_lag` blocks behind
+  the best one has stalled, and is treated like a failed node until it catches up.
+- a read that names a block number (the end of a getLogs range, the block of a state read) only gets its answer
+  from a node that has reached that block. Otherwise a caller that took the head from one node and asked another
+  for logs up to it could get an incomplete range back with nothing to say so.
+
+JSON-RPC errors (the node answered, the call itself failed) are raised as usual: another node would say the same.'''
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Tuple, Callable, Optional
+
+from rpc import JsonRpcClient, RpcError, RpcTransportError, to_int
+
+log = logging.getLogger("multirpc")
+log.setLevel(logging.INFO)
+
+# sent to the sticky node: other nodes may not have seen our pending txs yet
+STICKY_METHODS = {'eth_sendRawTransaction', 'eth_sendTransaction', 'eth_getTransactionCount'}
+# where the block parameter is in reads that take one (eth_getLogs has it in its filter)
+BLOCK_PARAMS = {'eth_getBlockByNumber': 0, 'eth_getBalance': 1, 'eth_getCode': 1, 'eth_getStorageAt': 2, 'eth_call': 1}
+
+
+class NodeBehind(RpcTransportError):
+    '''The node is up but hasn't reached the block a read needs.'''
+
+
+class NodeHealth:
+    def __init__(self, url: str, alpha=0.2):
+        self.url = url
+        self.alpha = alpha
+        self.latency = None  # type: Optional[float]  # moving average, seconds
+        self.head = None  # type: Optional[int]
+        self.down_until = 0.0
+        self.n_ok = 0
+        self.n_failed = 0
+        self.n_hedged = 0
+
+    def ok(self, latency: float):
+        self.latency = latency if self.latency is None else self.alpha * latency + (1 - self.alpha) * self.latency
+        self.n_ok += 1
+
+    def failed(self, cooldown: float):
+        self.down_until = time.monotonic() + cooldown
+        self.n_failed += 1
+
+    def stats(self) -> Dict:
+        return {'Url': self.url, 'LatencyMs': None if self.latency is None else round(self.latency * 1000, 2),
+                'Head': self.head, 'Ok': self.n_ok, 'Failed': self.n_failed, 'Hedged': self.n_hedged,
+                'Down': self.down_until > time.monotonic()}
+
+
+def needed_block(calls: List[Tuple[str, List]]) -> Optional[int]:
+    '''The highest block number `calls` refer to, if any do by number.'''
+    need = None
+    for (method, params) in calls:
+        params = params or []
+        if method == 'eth_getLogs':
+            b = params[0].get('toBlock') if params else None
+        elif method in BLOCK_PARAMS and len(params) > BLOCK_PARAMS[method]:
+            b = params[BLOCK_PARAMS[method]]
+        else:
+            continue
+        if type(b) is str and b.startswith('0x'):
+            b = int(b, 16)
+        if type(b) is int:
+            need = b if need is None else max(need, b)
+    return need
+
+
+def node_urls(node_ips: str, port=8545) -> List[str]:
+    '''http URLs for a comma separated list of IPs or host names (like the public EIPs stack's oPublicIps).'''
+    return [f"http://{ip.strip()}:{port}" for ip in node_ips.split(',') if ip.strip()]
+
+
+class MultiNodeRpc(JsonRpcClient):
+    def __init__(self, urls: List[str], timeout=5, retries=0, hedge_after: Optional[float] = None, max_lag=1,
+                 cooldown=30, probe_interval=15, workers=16):
+        if len(urls) == 0:
+            raise ValueError("MultiNodeRpc needs at least one node")
+        # the hot methods are inherited; they all go through request and batch, which are routed below
+        super().__init__(urls[0], timeout=timeout, retries=retries)
+        self.nodes = [JsonRpcClient(u, timeout=timeout, retries=retries) for u in urls]
+        self.health = {n.url: NodeHealth(n.url) for n in self.nodes}
+        self.hedge_after = hedge_after
+        self.max_lag = max_lag
+        self.cooldown = cooldown
+        self.probe_interval = probe_interval
+        self.sticky = None  # type: Optional[JsonRpcClient]
+        self._last_probe = 0.0
+        self._probes = []
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+    # node selection
+
+    def _usable(self, node: JsonRpcClient, now: float, best_head: Optional[int]) -> bool:
+        h = self.health[node.url]
+        if h.down_until > now:
+            return False
+        return best_head is None or h.head is None or best_head - h.head <= self.max_lag
+
+    def ranked(self) -> List[JsonRpcClient]:
+        '''Usable nodes fastest first, then the rest (so a request is still tried when every node looks unwell).'''
+        if time.monotonic() - self._last_probe > self.probe_interval:
+            self.probe()
+        now = time.monotonic()
+        with self._lock:
+            heads = [h.head for h in self.health.values() if h.head is not None and h.down_until <= now]
+            best_head = max(heads) if heads else None
+            # nodes we haven't timed yet go last: the probes measure them soon enough, and one may not be up at all
+            key = lambda n: (self.health[n.url].latency is None, self.health[n.url].latency or 0.0)
+            usable = sorted([n for n in self.nodes if self._usable(n, now, best_head)], key=key)
+            rest = sorted([n for n in self.nodes if n not in usable], key=lambda n: self.health[n.url].down_until)
+        return usable + rest
+
+    def probe(self, block=False):
+        '''Ask every node for its head block in parallel, updating latencies, heads and which nodes are down. Runs in
+        the background unless `block`, so requests never wait on an unreachable node.'''
+        self._last_probe = time.monotonic()
+
+        def record(node, f):
+            if f.exception() is None:
+                with self._lock:
+                    self.health[node.url].head = f.result()
+
+        futs = []
+        for n in self.nodes:
+            f = self._pool.submit(self._timed, n, lambda n: to_int(n.request('eth_blockNumber')))
+            f.add_done_callback(lambda f, n=n: record(n, f))
+            futs.append(f)
+        self._probes = futs
+        if block:
+            wait(futs)
+
+    def _await_probe(self):
+        '''Wait (up to the timeout) for some node to answer the latest probe, or for every probe to fail.'''
+        pending = set(self._probes)
+        deadline = time.monotonic() + self.timeout
+        while pending and all(h.latency is None for h in self.health.values()):
+            (done, pending) = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                return
+
+    def _hedge_delay(self) -> float:
+        if self.hedge_after is not None:
+            return self.hedge_after
+        lats = [h.latency for h in self.health.values() if h.latency is not None]
+        # a few times the best node's usual latency, within sane bounds
+        return min(1.0, max(0.05, 3 * min(lats))) if lats else 0.25
+
+    def _timed(self, node: JsonRpcClient, fn: Callable):
+        start = time.monotonic()
+        try:
+            ret = fn(node)
+        except (RpcError, NodeBehind):
+            # the node is fine; the call failed
+            with self._lock:
+                self.health[node.url].ok(time.monotonic() - start)
+            raise
+        except Exception as e:
+            with self._lock:
+                self.health[node.url].failed(self.cooldown)
+            log.warning(f"[MultiNodeRpc] {node.url} failed: {repr(e)}")
+            raise
+        with self._lock:
+            self.health[node.url].ok(time.monotonic() - start)
+        return ret
+
+    # routing
+
+    def _at_block(self, node: JsonRpcClient, need: int):
+        '''Raise NodeBehind unless `node` has reached block `need`. Heads only move forward, so a head we've already
+        seen that far along is enough; otherwise the node is asked.'''
+        h = self.health[node.url]
+        if h.head is not None and h.head >= need:
+            return
+        head = to_int(node.request('eth_blockNumber'))
+        with self._lock:
+            h.head = head if h.head is None else max(h.head, head)
+        if head < need:
+            raise NodeBehind(f"{node.url} is at block {head}, not {need} yet")
+
+    def _read(self, fn: Callable, need: Optional[int] = None):
+        candidates = self.ranked()
+        if need is not None:
+            # nodes known to have the block first; the rest are checked before they're asked
+            candidates.sort(key=lambda n: self.health[n.url].head is None or self.health[n.url].head < need)
+            read = fn
+
+            def fn(node):
+                self._at_block(node, need)
+                return read(node)
+
+        in_flight = {}
+        errors = []
+        delay = self._hedge_delay()
+
+        def start_next(hedged=False):
+            node = candidates.pop(0)
+            if hedged:
+                self.health[node.url].n_hedged += 1
+            in_flight[self._pool.submit(self._timed, node, fn)] = node
+
+        start_next()
+        while in_flight:
+            done, _ = wait(in_flight, timeout=delay if candidates else None, return_when=FIRST_COMPLETED)
+            if not done:
+                # slow: race the next node against the ones already asked
+                start_next(hedged=True)
+                continue
+            for f in done:
+                in_flight.pop(f)
+                e = f.exception()
+                if e is None:
+                    return f.result()
+                if isinstance(e, RpcError):
+                    raise e
+                errors.append(e)
+            if not in_flight and candidates:
+                start_next()
+        raise RpcTransportError(f"All nodes failed: {errors}")
+
+    def _write(self, fn: Callable):
+        errors = []
+        tried = set()
+        while True:
+            with self._lock:
+                sticky = self.sticky
+            if sticky is None or sticky.url in tried or self.health[sticky.url].down_until > time.monotonic():
+                if sticky is None:
+                    # cold: rather than guess (and maybe wait out a timeout on a node that's down), let the probe
+                    # find one that answers
+                    self.ranked()
+                    self._await_probe()
+                candidates = [n for n in self.ranked() if n.url not in tried]
+                if not candidates:
+                    raise RpcTransportError(f"All nodes failed: {errors}")
+                sticky = candidates[0]
+                with self._lock:
+                    if self.sticky is not sticky:
+                        log.info(f"[MultiNodeRpc] writes now go to {sticky.url}")
+                    self.sticky = sticky
+            tried.add(sticky.url)
+            try:
+                return self._timed(sticky, fn)
+            except RpcError:
+                raise
+            except Exception as e:
+                errors.append(e)
+
+    def request(self, method: str, params: List = None):
+        fn = lambda node: node.request(method, params)
+        return self._write(fn) if method in STICKY_METHODS else self._read(fn, needed_block([(method, params)]))
+
+    def batch(self, calls: List[Tuple[str, List]], raise_errors=True) -> List:
+        fn = lambda node: node.batch(calls, raise_errors=raise_errors)
+        return self._write(fn) if any(m in STICKY_METHODS for (m, _) in calls) else self._read(fn, needed_block(calls))
+
+    def request_at(self, method: str, params: List, min_head: int):
+        '''A read answered by a node whose head has reached `min_head`, e.g. to know a range is final on the node
+        that returned it.'''
+        return self._read(lambda node: node.request(method, params),
+                          max(min_head, needed_block([(method, params)]) or min_head))
+
+    def batch_at(self, calls: List[Tuple[str, List]], min_head: int, raise_errors=True) -> List:
+        '''batch() of reads, answered by a node whose head has reached `min_head`.'''
+        return self._read(lambda node: node.batch(calls, raise_errors=raise_errors),
+                          max(min_head, needed_block(calls) or min_head))
+
+    def stats(self) -> List[Dict]:
+        return [self.health[n.url].stats() for n in self.nodes]
+
+
+def connect(url: str, node_ips: str = '', port=8545) -> JsonRpcClient:
+    '''A MultiNodeRpc over `node_ips` when there are several nodes, otherwise a plain client for `url`.'''
+    urls = node_urls(node_ips, port)
+    if len(urls) > 1:
+        return MultiNodeRpc(urls)
+    return JsonRpcClient(url)
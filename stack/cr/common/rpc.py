@@ -0,0 +1,288 @@
+import http.client
+import logging
+import socket
+import threading
+import time
+import urllib.parse
+from typing import List, Dict, Optional, Tuple, Any
+
+from eth_utils import keccak, add_0x_prefix
+
+log = logging.getLogger("rpc")
+log.setLevel(logging.INFO)
+
+# prefer a fast json codec if one is installed (in deps) - the std json module is the fallback
+try:
+    import orjson
+
+    def json_dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    json_loads = orjson.loads
+    JSON_CODEC = 'orjson'
+except ImportError:
+    try:
+        import ujson
+
+        def json_dumps(obj) -> bytes:
+            return ujson.dumps(obj).encode()
+
+        json_loads = ujson.loads
+        JSON_CODEC = 'ujson'
+    except ImportError:
+        import json
+
+        def json_dumps(obj) -> bytes:
+            return json.dumps(obj, separators=(',', ':')).encode()
+
+        json_loads = json.loads
+        JSON_CODEC = 'json'
+
+
+RECEIPT_INT_FIELDS = ['blockNumber', 'gasUsed', 'cumulativeGasUsed', 'transactionIndex', 'status']
+BLOCK_INT_FIELDS = ['number', 'gasLimit', 'gasUsed', 'timestamp']
+LOG_INT_FIELDS = ['blockNumber', 'logIndex', 'transactionIndex']
+TX_INT_FIELDS = ['blockNumber', 'nonce', 'gas', 'gasPrice', 'value']
+
+
+class RpcError(Exception):
+    def __init__(self, method, error: dict):
+        self.method = method
+        self.code = error.get('code')
+        self.message = error.get('message', '')
+        super().__init__(f"{method} failed: [{self.code}] {self.message}")
+
+
+class RpcTransportError(Exception):
+    pass
+
+
+def to_int(v) -> int:
+    return int(v, 16) if type(v) is str else v
+
+
+def hex_ints(d: Optional[Dict], fields: List[str]) -> Optional[Dict]:
+    '''Convert the hex quantities we actually use to ints; everything else is left as returned by the node.'''
+    if d is None:
+        return None
+    for f in fields:
+        if d.get(f) is not None:
+            d[f] = to_int(d[f])
+    return d
+
+
+# what geth and parity answer when they already have the tx; a retried send hitting one is a success for our purposes.
+# matched exactly: looser checks ('known' in msg) also catch errors like "unknown account".
+ALREADY_KNOWN_MSGS = ['already known', 'known transaction', 'transaction with the same hash was already imported']
+NONCE_TOO_LOW_MSGS = ['nonce too low', 'transaction nonce is too low']
+
+
+def _is_already_known(e: RpcError) -> bool:
+    msg = (e.message or '').lower()
+    return any(msg.startswith(m) for m in ALREADY_KNOWN_MSGS)
+
+
+def _is_nonce_too_low(e: RpcError) -> bool:
+    msg = (e.message or '').lower()
+    return any(msg.startswith(m) for m in NONCE_TOO_LOW_MSGS)
+
+
+def _txid(raw_hex: str) -> str:
+    return add_0x_prefix(keccak(hexstr=raw_hex).hex())
+
+
+def to_json(v):
+    '''web3's python values back to JSON-RPC's: quantities as hex, bytes as 0x-hex.'''
+    if isinstance(v, bool) or v is None or isinstance(v, str):
+        return v
+    if isinstance(v, int):
+        return hex(v)
+    if isinstance(v, (bytes, bytearray)):
+        return add_0x_prefix(bytes(v).hex())
+    if isinstance(v, dict) or hasattr(v, 'items'):
+        return {k: to_json(x) for (k, x) in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [to_json(x) for x in v]
+    return v
+
+
+def _block_param(block) -> str:
+    return hex(block) if type(block) is int else block
+
+
+class JsonRpcClient:
+    '''A minimal JSON-RPC client for the hot methods (sending txs, polling receipts, eth_call).
+
+    Skips web3's middleware/formatter stack entirely: keeps one persistent HTTP connection per thread, retries
+    transport errors, and returns plain dicts (only the handful of quantity fields we use are converted to ints).'''
+
+    RETRY_STATUS = {429, 502, 503, 504}
+
+    def __init__(self, url: str, timeout=10, retries=3, backoff=0.2):
+        self.url = url
+        _u = urllib.parse.urlparse(url)
+        self._https = _u.scheme == 'https'
+        self._host = _u.hostname
+        self._port = _u.port or (443 if self._https else 80)
+        self._path = _u.path or '/'
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._next_id = 1
+        self._id_lock = threading.Lock()
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.n_requests = 0
+
+    def _reserve_ids(self, n=1) -> int:
+        with self._id_lock:
+            first_id = self._next_id
+            self._next_id += n
+            return first_id
+
+    def _conn(self, fresh=False) -> http.client.HTTPConnection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or fresh:
+            if conn is not None:
+                conn.close()
+            cls = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+            conn = cls(self._host, self._port, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def _post(self, body: bytes) -> Any:
+        last_err = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                conn = self._conn(fresh=last_err is not None)
+                conn.request('POST', self._path, body=body, headers={'Content-Type': 'application/json'})
+                resp = conn.getresponse()
+                data = resp.read()
+                with self._stats_lock:
+                    self.n_requests += 1
+                if resp.status in self.RETRY_STATUS:
+                    last_err = RpcTransportError(f"HTTP {resp.status} from {self.url}")
+                    continue
+                if resp.status != 200:
+                    raise RpcTransportError(f"HTTP {resp.status} from {self.url}: {data[:200]}")
+                return json_loads(data)
+            except (http.client.HTTPException, ConnectionError, socket.timeout, OSError) as e:
+                log.warning(f"[JsonRpcClient] transport error talking to {self.url} (attempt {attempt}): {repr(e)}")
+                last_err = e
+        raise RpcTransportError(f"Giving up on {self.url} after {self.retries + 1} attempts: {repr(last_err)}")
+
+    def request(self, method: str, params: List = None):
+        resp = self._post(json_dumps({'jsonrpc': '2.0', 'id': self._reserve_ids(), 'method': method,
+                                      'params': [] if params is None else params}))
+        if 'error' in resp:
+            raise RpcError(method, resp['error'])
+        return resp['result']
+
+    def batch(self, calls: List[Tuple[str, List]], raise_errors=True) -> List:
+        '''Send many calls in one HTTP request. Results are returned in the same order as `calls`. With
+        `raise_errors=False` a failed call's slot holds its RpcError instead of raising.'''
+        if len(calls) == 0:
+            return []
+        # a contiguous block of ids lets us put responses (which may arrive in any order) back in order
+        first_id = self._reserve_ids(len(calls))
+        reqs = [{'jsonrpc': '2.0', 'id': first_id + i, 'method': m, 'params': p} for (i, (m, p)) in enumerate(calls)]
+        resps = self._post(json_dumps(reqs))
+        if type(resps) is dict:  # some nodes answer a whole batch with a single error object
+            raise RpcError('batch', resps.get('error', {}))
+        results = [None] * len(calls)
+        for r in resps:
+            i = r['id'] - first_id
+            if 'error' in r:
+                if raise_errors:
+                    raise RpcError(calls[i][0], r['error'])
+                results[i] = RpcError(calls[i][0], r['error'])
+            else:
+                results[i] = r['result']
+        return results
+
+    # hot methods
+
+    def _sent_txid(self, raw_hex: str, e: RpcError) -> str:
+        '''The txid of a send that failed with `e` if the node has the tx anyway (e.g. a retry of a send whose response
+        was lost), else raises `e`. "nonce too low" only counts if that nonce was used by this very tx.'''
+        txid = _txid(raw_hex)
+        if _is_already_known(e) or (_is_nonce_too_low(e) and self.get_transaction(txid) is not None):
+            return txid
+        raise e
+
+    def send_raw_transaction(self, raw_tx: bytes) -> str:
+        raw_hex = raw_tx if type(raw_tx) is str else add_0x_prefix(raw_tx.hex())
+        try:
+            return self.request('eth_sendRawTransaction', [raw_hex])
+        except RpcError as e:
+            return self._sent_txid(raw_hex, e)
+
+    def send_raw_transactions(self, raw_txs: List[bytes]) -> List[str]:
+        '''Broadcast many signed txs in one batch request; returns their txids.'''
+        raw_hexes = [raw if type(raw) is str else add_0x_prefix(raw.hex()) for raw in raw_txs]
+        results = self.batch([('eth_sendRawTransaction', [raw]) for raw in raw_hexes], raise_errors=False)
+        return [self._sent_txid(raw_hex, r) if isinstance(r, RpcError) else r for (raw_hex, r) in zip(raw_hexes, results)]
+
+    def get_transaction_receipt(self, txid: str) -> Optional[Dict]:
+        return hex_ints(self.request('eth_getTransactionReceipt', [txid]), RECEIPT_INT_FIELDS)
+
+    def get_transaction_receipts(self, txids: List[str], batch_size=500) -> List[Optional[Dict]]:
+        ret = []
+        for i in range(0, len(txids), batch_size):
+            rs = self.batch([('eth_getTransactionReceipt', [t]) for t in txids[i:i + batch_size]])
+            ret.extend(hex_ints(r, RECEIPT_INT_FIELDS) for r in rs)
+        return ret
+
+    def call(self, tx: Dict, block='latest') -> str:
+        return self.request('eth_call', [tx, _block_param(block)])
+
+    def get_transaction_count(self, addr: str, block='pending') -> int:
+        return to_int(self.request('eth_getTransactionCount', [addr, _block_param(block)]))
+
+    def block_number(self) -> int:
+        return to_int(self.request('eth_blockNumber'))
+
+    def get_block(self, block='latest', full_txs=False) -> Optional[Dict]:
+        return hex_ints(self.request('eth_getBlockByNumber', [_block_param(block), full_txs]), BLOCK_INT_FIELDS)
+
+    def get_transaction(self, txid: str) -> Optional[Dict]:
+        return hex_ints(self.request('eth_getTransactionByHash', [txid]), TX_INT_FIELDS)
+
+    def get_logs(self, address: str, topics: List, from_block: int, to_block: int) -> List[Dict]:
+        f = {'address': address, 'topics': topics, 'fromBlock': hex(from_block), 'toBlock': hex(to_block)}
+        return [hex_ints(l, LOG_INT_FIELDS) for l in self.request('eth_getLogs', [f])]
+
+
+class Web3Rpc(JsonRpcClient):
+    '''Same interface as JsonRpcClient but backed by a Web3 instance. Used where there is no HTTP endpoint, e.g. the
+    in-process EthereumTesterProvider in tests. Results are turned back into their JSON-RPC form, so every method
+    returns exactly what JsonRpcClient's does.'''
+
+    def __init__(self, w3):
+        self.w3 = w3
+        self.url = 'web3'
+        self._stats_lock = threading.Lock()
+        self.n_requests = 0
+
+    def request(self, method: str, params: List = None):
+        with self._stats_lock:
+            self.n_requests += 1
+        try:
+            return to_json(self.w3.manager.request_blocking(method, [] if params is None else params))
+        except ValueError as e:
+            # web3 raises the node's error object as a ValueError
+            error = e.args[0] if e.args and isinstance(e.args[0], dict) else {'code': -32000, 'message': str(e)}
+            raise RpcError(method, error)
+
+    def batch(self, calls: List[Tuple[str, List]], raise_errors=True) -> List:
+        results = []
+        for (m, p) in calls:
+            try:
+                results.append(self.request(m, p))
+            except RpcError as e:
+                if raise_errors:
+                    raise e
+                results.append(e)
+        return results
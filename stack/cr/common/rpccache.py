@@ -0,0 +1,400 @@
+'''A caching layer for JSON-RPC reads of chain data that can't change.
+
+CachingRpc wraps any client with JsonRpcClient's interface (a JsonRpcClient, a MultiNodeRpc, a Web3Rpc) and keeps
+results that are final: receipts, txs and blocks once they're `confirmations` blocks deep, logs and eth_calls over
+finalized block ranges, deployed code, and the chain id. Entries are held serialized, in LRU order, within `max_bytes`.
+Everything else (latest/pending queries, nonces, sends) passes through, but identical reads that are in flight at the
+same time share one upstream request.
+
+Finality is judged from the head we've seen, which behind a MultiNodeRpc may be another node's than the one answering.
+So a read that's final once some block is deep enough goes to a node that has that block `confirmations` deep itself
+(MultiNodeRpc.request_at); when no node has yet, the answer is passed on but not kept.
+
+It can also run on its own as a JSON-RPC proxy in front of the nodes:
+
+    python3 rpccache.py --upstream http://<node-0>:8545 --upstream http://<node-1>:8545 --port 8545'''
+
+import argparse
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from typing import List, Dict, Tuple, Optional, Any
+
+from rpc import JsonRpcClient, RpcError, RpcTransportError, json_dumps, json_loads, to_int
+
+log = logging.getLogger("rpccache")
+log.setLevel(logging.INFO)
+
+CONFIRMATIONS = 2
+
+# never shared between callers, even when identical
+UNSHARED_METHODS = {'eth_sendRawTransaction', 'eth_sendTransaction'}
+FOREVER_METHODS = {'eth_chainId', 'net_version'}
+# results that carry the block they were included in; final once that block is
+RESULT_BLOCK_METHODS = {'eth_getTransactionReceipt', 'eth_getTransactionByHash', 'eth_getBlockByHash'}
+# methods taking a block parameter, and where it is
+BLOCK_PARAM = {'eth_getBlockByNumber': 0, 'eth_call': 1, 'eth_getBalance': 1, 'eth_getCode': 1,
+               'eth_getStorageAt': 2}
+
+_TAGS = {'latest', 'pending', 'earliest', 'safe', 'finalized'}
+
+
+def _block_num(b) -> Optional[int]:
+    '''A block parameter as a number, or None for a tag ('latest', 'pending') or a missing one.'''
+    if b is None or b in _TAGS:
+        return None
+    return to_int(b)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.data = None  # type: Optional[bytes]  # the result, serialized for the callers who waited on it
+        self.error = None  # type: Optional[Exception]
+        self.n_waiting = 0
+
+
+class CachingRpc(JsonRpcClient):
+    def __init__(self, inner, max_bytes=32 * 1024 * 1024, confirmations=CONFIRMATIONS, head_ttl=1.0):
+        # the hot methods are inherited; they all go through request and batch
+        super().__init__(getattr(inner, 'url', ''))
+        self.inner = inner
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 8  # one huge log range shouldn't flush everything else
+        self.confirmations = confirmations
+        self.head_ttl = head_ttl
+        self._entries = OrderedDict()  # type: OrderedDict[str, bytes]
+        self._bytes = 0
+        self._head = None  # type: Optional[int]
+        self._head_at = 0.0
+        self._flights = {}  # type: Dict[str, _Flight]
+        self._lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_shared = 0
+        self.n_passed = 0
+        self.n_evicted = 0
+
+    # finality
+
+    def _finalized(self, at_least: Optional[int] = None) -> int:
+        '''The newest final block, from a recently seen head. The head is only refreshed (at most every `head_ttl`
+        seconds) when a block beyond what we know to be final is asked about.'''
+        stale = time.monotonic() - self._head_at > self.head_ttl
+        if self._head is None or (stale and at_least is not None and at_least > self._head - self.confirmations):
+            self._see_head(to_int(self._shared(self._key('eth_blockNumber', []),
+                                               lambda: self.inner.request('eth_blockNumber'))))
+        return self._head - self.confirmations
+
+    def _see_head(self, head: int):
+        with self._lock:
+            if self._head is None or head >= self._head:
+                self._head = head
+                self._head_at = time.monotonic()
+
+    def _cacheable_call(self, method: str, params: List) -> Optional[bool]:
+        '''True if the call's result is final whatever it is, False if it never is, None if that depends on the
+        result.'''
+        if method in FOREVER_METHODS:
+            return True
+        if method in RESULT_BLOCK_METHODS:
+            return None
+        if method == 'eth_getLogs':
+            f = params[0] if params else {}
+            if f.get('blockHash') is not None:
+                return True
+            (lo, hi) = (_block_num(f.get('fromBlock')), _block_num(f.get('toBlock')))
+            return lo is not None and hi is not None and hi <= self._finalized(hi)
+        if method in BLOCK_PARAM:
+            i = BLOCK_PARAM[method]
+            n = _block_num(params[i]) if len(params) > i else None
+            if n is not None:
+                return n <= self._finalized(n)
+            # once deployed our contracts' code doesn't change (none of them can selfdestruct)
+            return None if method == 'eth_getCode' else False
+        return False
+
+    def _final_block(self, method: str, params: List) -> Optional[int]:
+        '''The block whose finality a read's result depends on, for reads that name one.'''
+        if method == 'eth_getLogs':
+            f = params[0] if params else {}
+            return None if f.get('blockHash') is not None else _block_num(f.get('toBlock'))
+        if method in BLOCK_PARAM and len(params) > BLOCK_PARAM[method]:
+            return _block_num(params[BLOCK_PARAM[method]])
+        return None
+
+    def _cacheable_result(self, method: str, result) -> bool:
+        if result is None:
+            return False
+        if method == 'eth_getCode':
+            return result not in ('0x', '')
+        n = _block_num(result.get('number' if method == 'eth_getBlockByHash' else 'blockNumber'))
+        return n is not None and n <= self._finalized(n)
+
+    # the cache
+
+    def _key(self, method: str, params: List) -> str:
+        # hex is case insensitive, and so is the cache
+        return (method + json.dumps(params, sort_keys=True, separators=(',', ':'))).lower()
+
+    def _get(self, key: str):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                return None, False
+            self._entries.move_to_end(key)
+            self.n_hits += 1
+        # a fresh copy for each caller: the hot methods convert fields in place
+        return json_loads(data), True
+
+    def _put(self, key: str, result):
+        data = json_dumps(result)
+        if len(data) > self.max_entry_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                (_, old) = self._entries.popitem(last=False)
+                self._bytes -= len(old)
+                self.n_evicted += 1
+
+    def _shared(self, key: str, fetch):
+        '''Run `fetch`, or wait for the identical request already in flight and take its result.'''
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.n_waiting += 1
+                self.n_shared += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            # each waiter gets its own copy (see _get)
+            return json_loads(flight.data)
+        try:
+            result = fetch()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            # nobody joins once the flight is unlisted, so n_waiting is final here
+            with self._lock:
+                self._flights.pop(key, None)
+            if flight.error is None and flight.n_waiting:
+                flight.data = json_dumps(result)
+            flight.done.set()
+        return result
+
+    def _fetch(self, key: str, method: str, params: List, cacheable: Optional[bool]) -> Tuple[Any, Optional[bool]]:
+        '''(result, cacheable) for a read that missed the cache. A read that's only final from some block on comes
+        from a node that has that block `confirmations` deep, if the upstream can pick one; when none has, it's answered
+        but not cached.'''
+        block = self._final_block(method, params) if cacheable else None
+        if block is not None and hasattr(self.inner, 'request_at'):
+            try:
+                return self._shared(key + '@final', lambda: self.inner.request_at(method, params,
+                                                                                  block + self.confirmations)), True
+            except RpcTransportError as e:
+                log.info(f"[CachingRpc] {method} up to {block}: no node is {self.confirmations} blocks past it: {e}")
+                cacheable = False
+        return self._shared(key, lambda: self.inner.request(method, params)), cacheable
+
+    def _fetch_batch(self, calls: List[Tuple[str, List, Optional[bool]]]) -> Tuple[List, List[Optional[bool]]]:
+        '''(results, cacheable) for calls that missed the cache, like _fetch. Reads that depend on a block's finality
+        go in a batch of their own.'''
+        blocks = [self._final_block(m, p) if c else None for (m, p, c) in calls]
+        final = [i for (i, b) in enumerate(blocks) if b is not None] if hasattr(self.inner, 'batch_at') else []
+        rest = sorted(set(range(len(calls))) - set(final))
+        results = [None] * len(calls)  # type: List[Any]
+        cacheable = [c for (_, _, c) in calls]
+        if final:
+            final_calls = [calls[i][:2] for i in final]
+            try:
+                fetched = self.inner.batch_at(final_calls, max(blocks[i] for i in final) + self.confirmations,
+                                              raise_errors=False)
+            except RpcTransportError as e:
+                log.info(f"[CachingRpc] batch: no node is {self.confirmations} blocks past it: {e}")
+                fetched = self.inner.batch(final_calls, raise_errors=False)
+                for i in final:
+                    cacheable[i] = False
+            for (i, r) in zip(final, fetched):
+                results[i] = r
+        if rest:
+            for (i, r) in zip(rest, self.inner.batch([calls[i][:2] for i in rest], raise_errors=False)):
+                results[i] = r
+        return results, cacheable
+
+    def _note_head(self, method: str, params: List, result):
+        if method == 'eth_blockNumber':
+            self._see_head(to_int(result))
+        elif method == 'eth_getBlockByNumber' and result is not None and params and params[0] == 'latest':
+            self._see_head(to_int(result['number']))
+
+    # the JsonRpcClient interface
+
+    def request(self, method: str, params: List = None):
+        params = [] if params is None else params
+        if method in UNSHARED_METHODS:
+            self.n_passed += 1
+            return self.inner.request(method, params)
+        key = self._key(method, params)
+        cacheable = self._cacheable_call(method, params)
+        if cacheable is not False:
+            (result, hit) = self._get(key)
+            if hit:
+                return result
+        (result, cacheable) = self._fetch(key, method, params, cacheable)
+        self._note_head(method, params, result)
+        if cacheable or (cacheable is None and self._cacheable_result(method, result)):
+            self.n_misses += 1
+            self._put(key, result)
+        else:
+            self.n_passed += 1
+        return result
+
+    def batch(self, calls: List[Tuple[str, List]], raise_errors=True) -> List:
+        '''Answers what it can from the cache and sends the rest upstream as one batch (identical calls once).'''
+        results = [None] * len(calls)  # type: List[Any]
+        todo = OrderedDict()  # type: OrderedDict[str, Tuple[str, List, Optional[bool], List[int]]]
+        for (i, (method, params)) in enumerate(calls):
+            params = [] if params is None else params
+            if method in UNSHARED_METHODS:
+                todo[f"#{i}"] = (method, params, False, [i])
+                continue
+            key = self._key(method, params)
+            cacheable = self._cacheable_call(method, params)
+            if cacheable is not False:
+                (result, hit) = self._get(key)
+                if hit:
+                    results[i] = result
+                    continue
+            if key in todo:
+                todo[key][3].append(i)
+                self.n_shared += 1
+            else:
+                todo[key] = (method, params, cacheable, [i])
+        if todo:
+            (fetched, cacheables) = self._fetch_batch([(m, p, c) for (m, p, c, _) in todo.values()])
+            for ((key, (method, params, _, idxs)), r, cacheable) in zip(todo.items(), fetched, cacheables):
+                if not isinstance(r, RpcError):
+                    self._note_head(method, params, r)
+                    if cacheable or (cacheable is None and self._cacheable_result(method, r)):
+                        self.n_misses += 1
+                        self._put(key, r)
+                    else:
+                        self.n_passed += 1
+                results[idxs[0]] = r
+                for i in idxs[1:]:
+                    results[i] = r if isinstance(r, RpcError) else json_loads(json_dumps(r))
+        if raise_errors:
+            for r in results:
+                if isinstance(r, RpcError):
+                    raise r
+        return results
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'Entries': len(self._entries), 'Bytes': self._bytes, 'Hits': self.n_hits, 'Misses': self.n_misses,
+                    'Shared': self.n_shared, 'Passed': self.n_passed, 'Evicted': self.n_evicted, 'Head': self._head}
+
+
+# the proxy
+
+
+def _invalid(req) -> Dict:
+    return {'jsonrpc': '2.0', 'id': req.get('id') if isinstance(req, dict) else None,
+            'error': {'code': -32600, 'message': 'invalid request'}}
+
+
+def _valid(req) -> bool:
+    return isinstance(req, dict) and isinstance(req.get('method'), str)
+
+
+def _answer(rpc: CachingRpc, req: Dict) -> Dict:
+    if not _valid(req):
+        return _invalid(req)
+    try:
+        return {'jsonrpc': '2.0', 'id': req.get('id'), 'result': rpc.request(req['method'], req.get('params'))}
+    except RpcError as e:
+        return {'jsonrpc': '2.0', 'id': req.get('id'), 'error': {'code': e.code, 'message': e.message}}
+
+
+def _answer_batch(rpc: CachingRpc, reqs: List[Dict]):
+    if len(reqs) == 0:
+        return _invalid(None)
+    valid = [r for r in reqs if _valid(r)]
+    rs = iter(rpc.batch([(r['method'], r.get('params')) for r in valid], raise_errors=False))
+    ret = []
+    for req in reqs:
+        if not _valid(req):
+            ret.append(_invalid(req))
+            continue
+        r = next(rs)
+        ret.append({'jsonrpc': '2.0', 'id': req.get('id'), 'error': {'code': r.code, 'message': r.message}}
+                   if isinstance(r, RpcError) else {'jsonrpc': '2.0', 'id': req.get('id'), 'result': r})
+    return ret
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def mk_proxy(rpc: CachingRpc, host='0.0.0.0', port=8545) -> HTTPServer:
+    '''An HTTP JSON-RPC server answering through `rpc`. Call serve_forever() on it.'''
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status: int, body: bytes):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            try:
+                req = json_loads(self.rfile.read(int(self.headers['Content-Length'])))
+            except ValueError:
+                return self._send(400, json_dumps({'jsonrpc': '2.0', 'id': None,
+                                                   'error': {'code': -32700, 'message': 'parse error'}}))
+            try:
+                resp = _answer_batch(rpc, req) if isinstance(req, list) else _answer(rpc, req)
+            except RpcTransportError as e:
+                return self._send(502, json_dumps({'jsonrpc': '2.0', 'id': None,
+                                                   'error': {'code': -32603, 'message': str(e)}}))
+            self._send(200, json_dumps(resp))
+
+    return _Server((host, port), Handler)
+
+
+if __name__ == "__main__":
+    from multirpc import MultiNodeRpc
+
+    parser = argparse.ArgumentParser(description="Caching JSON-RPC proxy for final chain data")
+    parser.add_argument('--upstream', action='append', required=True, help="node URL; repeat for several nodes")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8545)
+    parser.add_argument('--max-mb', type=int, default=256)
+    parser.add_argument('--confirmations', type=int, default=CONFIRMATIONS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    upstream = MultiNodeRpc(args.upstream) if len(args.upstream) > 1 else JsonRpcClient(args.upstream[0])
+    cache = CachingRpc(upstream, max_bytes=args.max_mb * 1024 * 1024, confirmations=args.confirmations)
+    server = mk_proxy(cache, args.host, args.port)
+    log.info(f"rpccache: serving on {args.host}:{args.port} for {args.upstream}")
+    server.serve_forever()
@@ -0,0 +1,72 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterator, Dict, List, Callable, Optional
+
+log = logging.getLogger("s3purge")
+log.setLevel(logging.INFO)
+
+MAX_DELETE_BATCH = 1000  # DeleteObjects limit
+
+
+def iter_object_versions(s3, bucket: str) -> Iterator[Dict]:
+    '''Every object version and delete marker in `bucket` as {'Key', 'VersionId'}. Unversioned buckets list each object
+    once with VersionId 'null', so this covers both cases.'''
+    for page in s3.get_paginator('list_object_versions').paginate(Bucket=bucket):
+        for v in page.get('Versions', []) + page.get('DeleteMarkers', []):
+            yield {'Key': v['Key'], 'VersionId': v['VersionId']}
+
+
+def iter_batches(it: Iterator, n: int) -> Iterator[List]:
+    batch = []
+    for x in it:
+        batch.append(x)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def purge_bucket(s3, bucket: str, remaining_time: Optional[Callable[[], float]] = None, margin=20, workers=8) -> Dict:
+    '''Delete everything in `bucket` with up to `workers` DeleteObjects calls in flight.
+
+    `remaining_time` returns the seconds left (e.g. from the lambda context); once fewer than `margin` remain we stop
+    listing, let in-flight deletes finish, and return with Complete=False so the caller can carry on elsewhere.'''
+    start = time.time()
+    n_deleted = 0
+    n_errors = 0
+    complete = True
+
+    def delete(batch):
+        resp = s3.delete_objects(Bucket=bucket, Delete={'Objects': batch, 'Quiet': True})
+        errors = resp.get('Errors', [])
+        for e in errors[:5]:
+            log.warning(f"[purge_bucket] failed to delete {e.get('Key')} ({e.get('VersionId')}): {e.get('Message')}")
+        return len(batch) - len(errors), len(errors)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = set()
+        for batch in iter_batches(iter_object_versions(s3, bucket), MAX_DELETE_BATCH):
+            if remaining_time is not None and remaining_time() < margin:
+                complete = False
+                break
+            # bound the number of pending batches so listing doesn't run far ahead of deleting
+            while len(in_flight) >= workers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for f in done:
+                    (ok, errs) = f.result()
+                    n_deleted += ok
+                    n_errors += errs
+            in_flight.add(pool.submit(delete, batch))
+        for f in in_flight:
+            (ok, errs) = f.result()
+            n_deleted += ok
+            n_errors += errs
+
+    duration = time.time() - start
+    ret = {'Bucket': bucket, 'Complete': complete and n_errors == 0, 'DeletedObjects': n_deleted,
+           'FailedObjects': n_errors, 'Duration': duration,
+           'ObjectsPerSecond': n_deleted / duration if duration > 0 else 0}
+    log.info(f"[purge_bucket] {ret}")
+    return ret
@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from typing import List, Dict, Iterable, NamedTuple
+
+from eth_account.signers.local import LocalAccount
+
+log = logging.getLogger("txpipe")
+log.setLevel(logging.INFO)
+
+SignedTx = NamedTuple('SignedTx', [('nonce', int), ('txid', str), ('raw', bytes)])
+
+
+class TxFailed(Exception):
+    pass
+
+
+class NonceStream:
+    '''Hands out sequential nonces for a single sender so txs can be signed and broadcast back to back without
+    waiting for each one to be mined. Safe to share between threads.'''
+
+    def __init__(self, start: int):
+        self.next_nonce = int(start)
+        self._lock = threading.Lock()
+
+    def take(self, n=1) -> int:
+        '''Reserve `n` consecutive nonces and return the first.'''
+        with self._lock:
+            nonce = self.next_nonce
+            self.next_nonce += n
+            return nonce
+
+    @classmethod
+    def from_chain(cls, rpc, addr: str) -> 'NonceStream':
+        return cls(rpc.get_transaction_count(addr, 'pending'))
+
+
+def sign_txs(acct: LocalAccount, unsigned_txs: Iterable[Dict], nonces: NonceStream, chainid=None) -> List[SignedTx]:
+    signed = []
+    for tx in unsigned_txs:
+        tx = dict(tx, nonce=nonces.take())
+        if chainid is not None:
+            tx['chainId'] = chainid
+        stx = acct.signTransaction(tx)
+        signed.append(SignedTx(tx['nonce'], stx.hash.hex(), stx.rawTransaction))
+    return signed
+
+
+def broadcast(rpc, addr: str, signed_txs: List[SignedTx], window=256, poll_rate=0.5, batch_size=100) -> List[str]:
+    '''Send every signed tx without waiting for receipts. At most `window` of our txs are allowed to be unmined at
+    once so we don't overflow the node's per-sender tx queue; when the window is full we wait on the mined nonce.
+    Txs that fit in the window are sent `batch_size` at a time in one JSON-RPC batch.'''
+    if len(signed_txs) == 0:
+        return []
+    mined_nonce = rpc.get_transaction_count(addr, 'latest')
+    i = 0
+    while i < len(signed_txs):
+        while signed_txs[i].nonce - mined_nonce >= window:
+            time.sleep(poll_rate)
+            mined_nonce = rpc.get_transaction_count(addr, 'latest')
+        room = mined_nonce + window - signed_txs[i].nonce
+        chunk = signed_txs[i:i + max(1, min(batch_size, room))]
+        if len(chunk) == 1:
+            rpc.send_raw_transaction(chunk[0].raw)
+        else:
+            rpc.send_raw_transactions([stx.raw for stx in chunk])
+        i += len(chunk)
+    log.info(f"[broadcast] sent {len(signed_txs)} txs from {addr}; nonces {signed_txs[0].nonce}..{signed_txs[-1].nonce}")
+    return [stx.txid for stx in signed_txs]
+
+
+def wait_for_receipts(rpc, txids: List[str], timeout=120, poll_rate=0.5) -> List[Dict]:
+    '''Wait for a run of txs from one sender (in nonce order) to be mined and return their receipts.
+
+    Txs from the same sender are mined in nonce order, so we only poll the last tx; once that has a receipt every
+    earlier one has one too.'''
+    if len(txids) == 0:
+        return []
+    deadline = time.time() + timeout
+    while rpc.get_transaction_receipt(txids[-1]) is None:
+        if time.time() > deadline:
+            raise Exception(f"Txs took longer than {timeout}s to confirm! Last txid: {txids[-1]}")
+        time.sleep(poll_rate)
+    return rpc.get_transaction_receipts(txids)
+
+
+def send_pipelined(rpc, acct: LocalAccount, unsigned_txs: Iterable[Dict], nonces: NonceStream, chainid=None,
+                   window=256, timeout=120, poll_rate=0.5, check_status=True) -> (List[str], List[Dict]):
+    '''Sign, broadcast, and confirm a batch of txs through `nonces`. Returns (txids, receipts) in input order.'''
+    signed = sign_txs(acct, unsigned_txs, nonces, chainid=chainid)
+    txids = broadcast(rpc, acct.address, signed, window=window, poll_rate=poll_rate)
+    receipts = wait_for_receipts(rpc, txids, timeout=timeout, poll_rate=poll_rate)
+    if check_status:
+        failed = [txid for (txid, r) in zip(txids, receipts) if r.get('status', 1) == 0]
+        if failed:
+            raise TxFailed(f"{len(failed)} of {len(txids)} txs failed; first failure: {failed[0]}")
+    return txids, receipts
@@ -1,9 +1,12 @@
 # Source: https://github.com/stelligent/cloudformation-custom-resources/blob/master/lambda/python/customresource.py
 
+import time
+_IMPORT_START = time.time()
+
+import functools
 import json
 import logging
 import signal
-import time
 import traceback
 from urllib.request import build_opener, HTTPHandler, Request
 from enum import Enum
@@ -18,10 +21,13 @@ import os, sys
 import bootstrap
 
 from lib import *
+from enodepool import release_dead_claims, refill_enode_pool, publish_peers, delete_enode_pool
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
+IMPORT_DURATION = time.time() - _IMPORT_START
+
 
 class CfnStatus(Enum):
     SUCCESS = "SUCCESS"
@@ -36,9 +42,13 @@ class CrResponse:
         self.physical_id = physical_id
 
 
+_invocations = {'n': 0}
+
+
 def wrap_handler(_handler):
     """Handle Lambda event from AWS"""
 
+    @functools.wraps(_handler)
     def inner(event, context):
         # Setup alarm for remaining runtime minus a second
         signal.alarm((context.get_remaining_time_in_millis() // 1000) - 1)
@@ -46,7 +56,17 @@ def wrap_handler(_handler):
             LOGGER.info('REQUEST RECEIVED:\n %s', event)
             LOGGER.info('REQUEST RECEIVED:\n %s', context)
             LOGGER.info(event['RequestType'])
-            resp: CrResponse = _handler(event, context, **event['ResourceProperties'])
+            cold = _invocations['n'] == 0
+            _invocations['n'] += 1
+            # repeated reads of the same SSM params within one request only hit SSM once
+            with ssm_snapshot(), Timer() as t:
+                resp: CrResponse = _handler(event, context, **event['ResourceProperties'])
+            LOGGER.info("%s %s took %.3fs (cold start: %s, imports took %.3fs)", _handler.__name__,
+                        event['RequestType'], t.interval, cold, IMPORT_DURATION)
+            if resp is None:
+                # the handler handed the work on to another invocation which will respond to CFN
+                LOGGER.info("Handler %s deferred its response", _handler.__name__)
+                return
             if type(resp) != CrResponse:
                 raise Exception("Handler {} did not return a CrResponse!".format(_handler.__name__))
             send_cfn_resp(event, context, resp)
@@ -81,13 +101,28 @@ def do_create(props: dict):
     return data
 
 
+MAX_PURGE_CONTINUATIONS = 50
+
+
 @wrap_handler
 def handler_bucket_cleanup(event, ctx, **props):
     NamePrefix = props['NamePrefix']
     physical_id = 'sv-{}-eth-private-keys-and-addrs'.format(NamePrefix)
 
     if event['RequestType'] == "Delete":
-        return CrResponse(CfnStatus.SUCCESS, remove_s3_bucket_objs(**props), physical_id)
+        data = remove_s3_bucket_objs(remaining_time=lambda: ctx.get_remaining_time_in_millis() / 1000, **props)
+        if not data['Complete']:
+            n_continued = event.get('PurgeContinuations', 0)
+            if data['FailedObjects'] > 0 or n_continued >= MAX_PURGE_CONTINUATIONS:
+                return CrResponse(CfnStatus.FAILED, dict(data, Message="Could not empty {} (after {} continuations)"
+                                                         .format(props['StaticBucketName'], n_continued)), physical_id)
+            # out of time: carry on in a fresh invocation of this function, which will respond to CFN when done
+            LOGGER.info("Purge of %s incomplete after %d objects; re-invoking", props['StaticBucketName'],
+                        data['DeletedObjects'])
+            lambda_client.invoke(FunctionName=ctx.invoked_function_arn, InvocationType='Event',
+                                 Payload=json.dumps(dict(event, PurgeContinuations=n_continued + 1)).encode())
+            return None
+        return CrResponse(CfnStatus.SUCCESS, data, physical_id)
     elif event['RequestType'] in ["Create", "Update"]:
         return CrResponse(CfnStatus.SUCCESS, {}, physical_id)
     else:
@@ -111,12 +146,11 @@ def handler_priv_keys(event: dict, context, **props):
         return CrResponse(CfnStatus.SUCCESS, data, physical_id)
 
     elif event['RequestType'] == 'Update':
-        # check if we need to update any key stuff (i.e. did nNodes change?)
-        ssm = boto3.client('ssm')
-        old_n = ssm.get_parameter(Name="sv-{}-param-nconsensus-nodes".format(NamePrefix))['Parameter']['Value']
-        if old_n != NConsensusNodes:
-            raise Exception("You cannot update NConsensusNodes currently. Sorry about that.")
-        return CrResponse(CfnStatus.SUCCESS, {"UpdatedPrivKeys": False}, physical_id)
+        # only indices that are new get keys; a validator set change is scheduled as a chainspec transition
+        old_props = event['OldResourceProperties']
+        data = scale_node_keys(OldNConsensusNodes=old_props['NConsensusNodes'],
+                               OldNPublicNodes=old_props['NPublicNodes'], **props)
+        return CrResponse(CfnStatus.SUCCESS, data, physical_id)
 
     elif event['RequestType'] == 'Delete':
         return CrResponse(CfnStatus.SUCCESS, delete_all_node_keys(**props), physical_id)
@@ -124,9 +158,40 @@ def handler_priv_keys(event: dict, context, **props):
         return CrResponse(CfnStatus.FAILED, {"Message": "Unexpected RequestType from CFN"}, physical_id)
 
 
+@wrap_handler
+def _handler_enode_pool_cr(event, ctx, **props):
+    physical_id = "sv-{}-enode-key-pool".format(props['NamePrefix'])
+    if event['RequestType'] in ['Create', 'Update']:
+        data = release_dead_claims(**props)
+        data.update(refill_enode_pool(**props))
+        data.update(publish_peers(**props))
+        return CrResponse(CfnStatus.SUCCESS, data, physical_id)
+    elif event['RequestType'] == 'Delete':
+        return CrResponse(CfnStatus.SUCCESS, delete_enode_pool(**props), physical_id)
+    else:
+        return CrResponse(CfnStatus.FAILED, {"Message": "Unexpected RequestType from CFN"}, physical_id)
+
+
+def handler_enode_pool(event, ctx):
+    """Custom resource for the spare enode key pool. Also runs on a schedule (with props from the environment) to top
+    the pool back up and republish the reserved peers file after public nodes claim keys (or terminated ones release
+    them)."""
+    if 'RequestType' in event:
+        return _handler_enode_pool_cr(event, ctx)
+    props = {k: os.environ[k] for k in ['NamePrefix', 'NSpareEnodeKeys', 'StaticBucketName', 'pEnodeIps']}
+    data = release_dead_claims(**props)
+    data.update(refill_enode_pool(**props))
+    data.update(publish_peers(**props))
+    LOGGER.info('Enode pool tick: %s', data)
+    return data
+
+
 @wrap_handler
 def handler_prevent_nameprefix_change(event, ctx, NamePrefix, **props):
     physical_id = "sv-{}-nameprefix-prevent-change".format(NamePrefix)
+    if event['RequestType'] == 'Update' and event['OldResourceProperties']['NamePrefix'] == NamePrefix:
+        # other props changing is fine
+        return CrResponse(CfnStatus.SUCCESS, {"NamePrefixConfirmed": True}, physical_id)
     return ({
         'Create': CrResponse(CfnStatus.SUCCESS, {"NamePrefixConfirmed": True}, physical_id),
         'Update': CrResponse(CfnStatus.FAILED,
@@ -136,6 +201,10 @@ def handler_prevent_nameprefix_change(event, ctx, NamePrefix, **props):
     })[event['RequestType']]
 
 
+# props that go into the genesis block (NamePrefix is also guarded by handler_prevent_nameprefix_change)
+GENESIS_PROPS = ['NamePrefix', 'BlockGasLimit']
+
+
 @wrap_handler
 def handler_params(event: dict, context, **props):
     physical_id = "sv-{}-big-old-custom-resource-todo-refactor-out".format(props['NamePrefix'])
@@ -143,8 +212,18 @@ def handler_params(event: dict, context, **props):
         data = do_create(props)
         return CrResponse(CfnStatus.SUCCESS, data, physical_id)
     elif event['RequestType'] == 'Update':
-        LOGGER.info('UPDATE! (NULL)')
-        return CrResponse(CfnStatus.SUCCESS, {}, physical_id)
+        old_props = event['OldResourceProperties']
+        changed = [k for k in GENESIS_PROPS if old_props.get(k) != props.get(k)]
+        if changed:
+            msg = "{} can't be changed once the chain exists: it's part of the genesis block, so every node would " \
+                  "restart onto a new chain".format(', '.join(changed))
+            return CrResponse(CfnStatus.FAILED, {"Message": msg}, physical_id)
+        # republish the chainspec with the current validator transitions; genesis stays as it was published
+        LOGGER.info('UPDATE! (chainspec)')
+        network_id = int(get_ssm_param_no_enc(gen_ssm_networkid(props['NamePrefix'])))
+        data = {'NetworkId': network_id, 'KeyPairName': gen_ec2_key_pair_name(props['NamePrefix'])}
+        data.update(republish_validators(NetworkId=network_id, **props))
+        return CrResponse(CfnStatus.SUCCESS, data, physical_id)
     elif event['RequestType'] == 'Delete':
         LOGGER.info('DELETE!')
         data = del_ssm_networkid_ethstats(**props)
@@ -153,6 +232,29 @@ def handler_params(event: dict, context, **props):
         return CrResponse(CfnStatus.FAILED, {"Message": "Unexpected event received from CloudFormation"}, physical_id)
 
 
+# routed on the resource type, so a resource's properties are the same whichever function serves it
+DISPATCH = {
+    'Custom::Params': handler_params,
+    'Custom::EthPrivkeys': handler_priv_keys,
+    'Custom::NamePrefixStatic': handler_prevent_nameprefix_change,
+    'Custom::StaticBucketCleanup': handler_bucket_cleanup,
+}
+
+
+def handler_dispatch(event, context):
+    """Serves all the custom resources in DISPATCH from one function, in stacks created with pCrDispatcher=true: a
+    stack operation pays for one cold start rather than one per resource, and the imports and boto3 clients are
+    shared between them."""
+    handler = DISPATCH.get(event.get('ResourceType'))
+    if handler is None:
+        # still need to answer CFN or the stack hangs until it times out
+        return send_cfn_resp(event, context, CrResponse(
+            CfnStatus.FAILED, {"Message": "No handler for {}; expected one of {}".format(
+                event.get('ResourceType'), sorted(DISPATCH))},
+            event.get('PhysicalResourceId', "Unknown-PhysicalResourceId-{}".format(event['LogicalResourceId']))))
+    return handler(event, context)
+
+
 def send_cfn_resp(evt, ctx, cfn_resp: CrResponse):
     return send_response(evt, ctx, cfn_resp)
 
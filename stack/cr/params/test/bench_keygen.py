@@ -0,0 +1,72 @@
+'''Keys/second for node key generation: the old sequential sha512-chain + eth_account + ecdsa path vs keygen.
+
+usage: python3 test/bench_keygen.py [-n 200] [--workers 4] [--json]'''
+
+import argparse
+import hashlib
+import json
+import sys, os
+import time
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+
+from eth_account import Account
+from ecdsa import SigningKey, SECP256k1
+
+import keygen
+
+
+def legacy_keys(n):
+    '''The pre-keygen create_node_keys loop (minus the grc.com entropy fetch).'''
+    _e = hashlib.sha512(os.urandom(128)).digest()
+    out = []
+    for _ in range(n):
+        _h = hashlib.sha512(_e).digest()
+        _privkey = _h[:32]
+        _e = _h[32:]
+        addr = Account.privateKeyToAccount(_privkey).address
+        pub = SigningKey.from_string(_privkey, curve=SECP256k1).get_verifying_key().to_string().hex()
+        out.append((addr, pub))
+    return out
+
+
+def run(name, f, n):
+    start = time.time()
+    f()
+    total = time.time() - start
+    return {'name': name, 'n': n, 'keys_per_s': n / total, 'total_s': total}
+
+
+def bench(n, workers):
+    seed = keygen.new_seed()
+    # sanity check: both backends agree with eth_account on the address
+    kp = keygen.gen_keypair(seed, 'check', 0)
+    assert kp.address == Account.privateKeyToAccount(kp.privkey).address
+
+    return [
+        run('legacy (sequential, eth_account + ecdsa)', lambda: legacy_keys(n), n),
+        run(f'keygen sequential ({keygen.BACKEND})', lambda: keygen.gen_keypairs(seed, 'bench', range(n), workers=1), n),
+        run(f'keygen {workers} workers ({keygen.BACKEND})',
+            lambda: keygen.gen_keypairs(seed, 'bench', range(n), workers=workers), n),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--json', action='store_true', help="print results as json")
+    args = parser.parse_args()
+
+    results = bench(args.n, args.workers)
+    if args.json:
+        print(json.dumps({'backend': keygen.BACKEND, 'results': results}, indent=2))
+    else:
+        print(f"secp256k1 backend: {keygen.BACKEND}")
+        for r in results:
+            print(f"{r['name']:<45} {r['keys_per_s']:>10.1f} keys/s   ({r['total_s']:.2f}s for {r['n']})")
@@ -0,0 +1,138 @@
+import io
+import json
+import sys, os
+from types import SimpleNamespace
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+
+import logging
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+import lib
+import index
+from lib import upload_chain_config, republish_validators, create_node_keys, save_poa_pks, save_service_pks, \
+    save_enode_pks, save_validator_transitions, get_validator_transitions, CHAINSPEC_OBJ_KEY
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestChainspecUpdate')
+
+NAME_PREFIX = 'tnspec'
+BUCKET = 'static-bucket'
+PROPS = {'NamePrefix': NAME_PREFIX, 'StaticBucketName': BUCKET, 'BlockGasLimit': '8000000', 'NetworkId': 1,
+         'pEnodeIps': '1.2.3.4,1.2.3.5'}
+
+
+class FakeSsm:
+    def __init__(self):
+        self.params = {}
+
+    def get_parameter(self, Name, WithDecryption=False):
+        if Name not in self.params:
+            raise Exception(f"ParameterNotFound: {Name}")
+        return {'Parameter': {'Name': Name, 'Value': self.params[Name]}}
+
+    def get_parameters(self, Names, WithDecryption=False):
+        return {'Parameters': [{'Name': n, 'Value': self.params[n]} for n in Names if n in self.params]}
+
+    def put_parameter(self, Name, Value, Overwrite=False, **kwargs):
+        if Name in self.params and not Overwrite:
+            raise Exception(f"ParameterAlreadyExists: {Name}")
+        self.params[Name] = Value
+
+
+class FakeS3:
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+        self.meta = SimpleNamespace(endpoint_url='https://s3.example.com')
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise Exception("404")
+        return {'Metadata': self.objects[(Bucket, Key)][1]}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)][0])}
+
+    def put_object(self, Bucket, Key, Body, Metadata, **kwargs):
+        self.objects[(Bucket, Key)] = (Body, Metadata)
+
+
+def published():
+    return json.loads(lib.s3.objects[(BUCKET, CHAINSPEC_OBJ_KEY)][0])
+
+
+def with_fakes(f):
+    def run():
+        saved = (lib.ssm, lib.s3)
+        (lib.ssm, lib.s3) = (FakeSsm(), FakeS3())
+        try:
+            keys = create_node_keys(2, NAME_PREFIX, 2)
+            save_poa_pks(keys['poa_pks'], NAME_PREFIX)
+            save_service_pks(keys['service_pks'], NAME_PREFIX)
+            save_enode_pks(keys['enode_pks'], NAME_PREFIX)
+            return f()
+        finally:
+            (lib.ssm, lib.s3) = saved
+    run.__name__ = f.__name__
+    return run
+
+
+@with_fakes
+def test_republish_keeps_genesis():
+    # nothing published yet: it's generated
+    assert republish_validators(**PROPS)['ChainSpecUploaded']
+    before = published()
+    assert republish_validators(**PROPS)['ChainSpecUploaded'] is False
+
+    transitions = dict(get_validator_transitions(NAME_PREFIX), **{'2000': ['0x' + '11' * 20]})
+    save_validator_transitions(transitions, NAME_PREFIX)
+    # whatever the props say now, only the validator set changes
+    ret = republish_validators(**dict(PROPS, BlockGasLimit='9000000', pEnodeIps='9.9.9.9'))
+    assert ret['ChainSpecUploaded']
+    after = published()
+    multi = after['engine']['authorityRound']['params'].pop('validators')['multi']
+    assert list(multi) == ['0', '2000'] and multi['2000'] == {'list': ['0x' + '11' * 20]}
+    before['engine']['authorityRound']['params'].pop('validators')
+    assert after == before and after['genesis']['gasLimit'] == hex(8000000)
+    # ...which is what a full regeneration with the original props gives
+    upload_chain_config(**PROPS)
+    assert published()['engine']['authorityRound']['params']['validators']['multi'] == multi
+    return True
+
+
+def test_update_rejects_genesis_change():
+    responses = []
+    send_cfn_resp = index.send_cfn_resp
+    index.send_cfn_resp = lambda event, ctx, resp: responses.append(resp)
+    ctx = SimpleNamespace(get_remaining_time_in_millis=lambda: 60000)
+    old = {'NamePrefix': NAME_PREFIX, 'BlockGasLimit': '8000000', 'StaticBucketName': BUCKET}
+    try:
+        index.handler_params({'RequestType': 'Update', 'LogicalResourceId': 'rParamsCr',
+                              'PhysicalResourceId': f"sv-{NAME_PREFIX}-big-old-custom-resource-todo-refactor-out",
+                              'ResourceProperties': dict(old, BlockGasLimit='9000000'),
+                              'OldResourceProperties': old}, ctx)
+    finally:
+        index.send_cfn_resp = send_cfn_resp
+        index.signal.alarm(0)
+    [resp] = responses
+    assert resp.status == index.CfnStatus.FAILED and resp.data['Message'].startswith('BlockGasLimit ')
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_republish_keeps_genesis, test_update_rejects_genesis_change]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -0,0 +1,49 @@
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+
+import logging
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+import index
+from index import handler_dispatch, CfnStatus
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestDispatch')
+
+
+def test_dispatch():
+    # each type goes to the function that serves it in a stack without the dispatcher
+    assert {t: h.__name__ for (t, h) in index.DISPATCH.items()} == {
+        'Custom::Params': 'handler_params', 'Custom::EthPrivkeys': 'handler_priv_keys',
+        'Custom::NamePrefixStatic': 'handler_prevent_nameprefix_change',
+        'Custom::StaticBucketCleanup': 'handler_bucket_cleanup'}
+
+    called = []
+    (dispatch, send_cfn_resp) = (index.DISPATCH, index.send_cfn_resp)
+    index.DISPATCH = {t: (lambda t: lambda event, ctx: called.append(t))(t) for t in dispatch}
+    index.send_cfn_resp = lambda event, ctx, resp: called.append(resp)
+    try:
+        for t in dispatch:
+            handler_dispatch({'ResourceType': t, 'RequestType': 'Create', 'LogicalResourceId': 'r'}, None)
+        assert called == list(dispatch)
+        # an unknown type is answered, so the stack doesn't wait for CFN's timeout
+        handler_dispatch({'ResourceType': 'Custom::Nope', 'RequestType': 'Create', 'LogicalResourceId': 'r'}, None)
+        resp = called[-1]
+        assert resp.status == CfnStatus.FAILED and 'Custom::Nope' in resp.data['Message']
+    finally:
+        (index.DISPATCH, index.send_cfn_resp) = (dispatch, send_cfn_resp)
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_dispatch]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -0,0 +1,206 @@
+import json
+import sys, os
+from types import SimpleNamespace
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+
+import logging
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+import lib
+import enodepool
+from enodepool import refill_enode_pool, publish_peers, delete_enode_pool, release_dead_claims, get_pool_pks, \
+    get_claims, PEERS_OBJ_KEY
+from lib import gen_ssm_enodekey_pool, gen_ssm_enode_pool_claim, gen_ssm_enode_pks
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestEnodePool')
+
+NAME_PREFIX = 'tnpool'
+BUCKET = 'static-bucket'
+
+
+class FakeSsm:
+    '''The parameter APIs enodepool uses, over a dict.'''
+
+    def __init__(self):
+        self.params = {}
+
+    def get_parameter(self, Name, WithDecryption=False):
+        if Name not in self.params:
+            raise Exception(f"ParameterNotFound: {Name}")
+        return {'Parameter': {'Name': Name, 'Value': self.params[Name]}}
+
+    def get_parameters(self, Names, WithDecryption=False):
+        assert len(Names) <= 10
+        return {'Parameters': [{'Name': n, 'Value': self.params[n]} for n in Names if n in self.params]}
+
+    def put_parameter(self, Name, Value, Overwrite=False, **kwargs):
+        if Name in self.params and not Overwrite:
+            raise Exception(f"ParameterAlreadyExists: {Name}")
+        self.params[Name] = Value
+
+    def delete_parameter(self, Name):
+        if Name not in self.params:
+            raise Exception(f"ParameterNotFound: {Name}")
+        del self.params[Name]
+
+    def describe_parameters(self, ParameterFilters, MaxResults=50, NextToken='0'):
+        prefixes = ParameterFilters[0]['Values']
+        names = [n for n in sorted(self.params) if any(n.startswith(p) for p in prefixes)]
+        page = names[int(NextToken):int(NextToken) + MaxResults]
+        return {'Parameters': [{'Name': n} for n in page], 'NextToken': str(int(NextToken) + MaxResults)}
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.meta = SimpleNamespace(endpoint_url='https://s3.example.com')
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body
+
+
+class FakeEc2:
+    '''describe_instances (paginated, filtered by instance id) over {instance id: state}.'''
+
+    def __init__(self):
+        self.instances = {}
+
+    def get_paginator(self, op):
+        assert op == 'describe_instances'
+        return SimpleNamespace(paginate=self.paginate)
+
+    def paginate(self, Filters):
+        [f] = Filters
+        assert f['Name'] == 'instance-id' and len(f['Values']) <= 200
+        for iid in f['Values']:
+            if iid in self.instances:
+                yield {'Reservations': [{'Instances': [{'InstanceId': iid, 'State': {'Name': self.instances[iid]}}]}]}
+
+
+def claim(i, url, instance_id=None):
+    '''What claim_pool_key in sv-public-node-new.yaml does for pool key `i`.'''
+    value = url if instance_id is None else f"{url} {instance_id}"
+    lib.ssm.put_parameter(Name=gen_ssm_enode_pool_claim(NAME_PREFIX, i), Value=value, Type='String')
+    return lib.ssm.get_parameter(Name=gen_ssm_enodekey_pool(NAME_PREFIX, i), WithDecryption=True)
+
+
+def with_fakes(f):
+    def run():
+        saved = (lib.ssm, enodepool.ssm, enodepool.s3, enodepool.ec2)
+        lib.ssm = enodepool.ssm = FakeSsm()
+        enodepool.s3 = FakeS3()
+        enodepool.ec2 = FakeEc2()
+        try:
+            return f()
+        finally:
+            (lib.ssm, enodepool.ssm, enodepool.s3, enodepool.ec2) = saved
+    run.__name__ = f.__name__
+    return run
+
+
+@with_fakes
+def test_refill():
+    assert refill_enode_pool(NAME_PREFIX, '3') == {'EnodePoolSize': 3, 'EnodePoolSpare': 3, 'EnodePoolAdded': 3}
+    assert sorted(get_pool_pks(NAME_PREFIX)) == ['0', '1', '2']
+    # every published pubkey has its private key stored
+    assert all(gen_ssm_enodekey_pool(NAME_PREFIX, i) in lib.ssm.params for i in get_pool_pks(NAME_PREFIX))
+    assert refill_enode_pool(NAME_PREFIX, '3')['EnodePoolAdded'] == 0
+
+    # a key can only be claimed once
+    claim(1, 'enode://a@1.1.1.1:30303')
+    try:
+        claim(1, 'enode://b@1.1.1.2:30303')
+        assert False
+    except Exception as e:
+        assert 'ParameterAlreadyExists' in str(e)
+
+    # claimed keys are replaced with new indices; claimed ones stay in the pool
+    before = get_pool_pks(NAME_PREFIX)
+    assert refill_enode_pool(NAME_PREFIX, '3') == {'EnodePoolSize': 4, 'EnodePoolSpare': 3, 'EnodePoolAdded': 1}
+    pool = get_pool_pks(NAME_PREFIX)
+    assert sorted(pool, key=int) == ['0', '1', '2', '3'] and all(pool[i] == pk for (i, pk) in before.items())
+    return True
+
+
+@with_fakes
+def test_claims_paginate():
+    n = 23  # more than a describe_parameters page and several get_parameters batches
+    for i in range(n):
+        lib.ssm.put_parameter(Name=gen_ssm_enode_pool_claim(NAME_PREFIX, i), Value=f"enode://{i}@1.1.1.1:30303")
+    orig = lib.list_ssm_params_starting_with
+    enodepool.list_ssm_params_starting_with = lambda *args: orig(*args, max_results=5)
+    try:
+        assert get_claims(NAME_PREFIX) == {str(i): f"enode://{i}@1.1.1.1:30303" for i in range(n)}
+    finally:
+        enodepool.list_ssm_params_starting_with = orig
+    return True
+
+
+@with_fakes
+def test_publish_peers():
+    lib.ssm.put_parameter(Name=gen_ssm_enode_pks(NAME_PREFIX), Value=json.dumps(['aa', 'bb']))
+    refill_enode_pool(NAME_PREFIX, '12')
+    # claims are listed in pool order, not name order ("10" < "2")
+    for i in [10, 2]:
+        claim(i, f"enode://pool{i}@2.2.2.{i}:30303", f"i-{i}")
+    # a claim from before they recorded the instance id
+    claim(5, 'enode://pool5@2.2.2.5:30303')
+    ret = publish_peers(NAME_PREFIX, BUCKET, pEnodeIps='1.1.1.1,1.1.1.2')
+    assert ret == {'ReservedPeersUrl': f"https://s3.example.com/{BUCKET}/{PEERS_OBJ_KEY}", 'NReservedPeers': 5}
+    # only the enode urls are published
+    assert enodepool.s3.objects[(BUCKET, PEERS_OBJ_KEY)].split('\n') == [
+        'enode://aa@1.1.1.1:30303', 'enode://bb@1.1.1.2:30303',
+        'enode://pool2@2.2.2.2:30303', 'enode://pool5@2.2.2.5:30303', 'enode://pool10@2.2.2.10:30303', '']
+    return True
+
+
+@with_fakes
+def test_release_dead_claims():
+    lib.ssm.put_parameter(Name=gen_ssm_enode_pks(NAME_PREFIX), Value=json.dumps([]))
+    refill_enode_pool(NAME_PREFIX, '5')
+    enodepool.ec2.instances.update({'i-run': 'running', 'i-stop': 'stopped', 'i-term': 'terminated'})
+    claim(0, 'enode://a@1.1.1.1:30303', 'i-run')
+    claim(1, 'enode://b@1.1.1.2:30303', 'i-stop')
+    claim(2, 'enode://c@1.1.1.3:30303', 'i-term')
+    claim(3, 'enode://d@1.1.1.4:30303', 'i-gone')  # EC2 no longer lists it
+    claim(4, 'enode://e@1.1.1.5:30303')  # no instance id: left alone
+    assert release_dead_claims(NAME_PREFIX) == {'EnodePoolReleased': 2}
+    assert sorted(get_claims(NAME_PREFIX), key=int) == ['0', '1', '4']
+    # the released keys are spare again: the refill adds none and a new node can claim them
+    assert refill_enode_pool(NAME_PREFIX, '2') == {'EnodePoolSize': 5, 'EnodePoolSpare': 2, 'EnodePoolAdded': 0}
+    claim(2, 'enode://f@1.1.1.6:30303', 'i-new')
+    enodepool.ec2.instances['i-new'] = 'pending'
+    assert release_dead_claims(NAME_PREFIX) == {'EnodePoolReleased': 0}
+    # ...and the peers file drops the old node
+    publish_peers(NAME_PREFIX, BUCKET)
+    assert enodepool.s3.objects[(BUCKET, PEERS_OBJ_KEY)].split('\n') == [
+        'enode://a@1.1.1.1:30303', 'enode://b@1.1.1.2:30303', 'enode://f@1.1.1.6:30303', 'enode://e@1.1.1.5:30303', '']
+    return True
+
+
+@with_fakes
+def test_delete():
+    lib.ssm.put_parameter(Name=gen_ssm_enode_pks(NAME_PREFIX), Value=json.dumps(['aa']))
+    refill_enode_pool(NAME_PREFIX, '2')
+    claim(0, 'enode://a@1.1.1.1:30303')
+    assert delete_enode_pool(NAME_PREFIX) == {'DeletedEnodePool': True}
+    # only the pool is removed
+    assert list(lib.ssm.params) == [gen_ssm_enode_pks(NAME_PREFIX)]
+    # ...and deleting again is fine
+    delete_enode_pool(NAME_PREFIX)
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_refill, test_claims_paginate, test_publish_peers, test_release_dead_claims, test_delete]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -0,0 +1,119 @@
+import sys, os
+import threading
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+
+import logging
+
+import s3purge
+from s3purge import purge_bucket
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestS3Purge')
+
+BUCKET = 'static-bucket'
+PAGE_SIZE = 1000  # list_object_versions' default MaxKeys
+
+
+class FakeVersionedS3:
+    '''A versioned bucket: each key has some versions and maybe a delete marker. Listing is paged like S3's.'''
+
+    def __init__(self, n_keys, n_versions=2, fail_keys=()):
+        self.lock = threading.Lock()
+        self.versions = {}
+        self.markers = {}
+        for i in range(n_keys):
+            key = f"chain/obj-{i:05d}"
+            for v in range(n_versions):
+                self.versions[(key, f"v{v}")] = True
+            if i % 3 == 0:
+                self.markers[(key, 'dm')] = True
+        self.fail_keys = set(fail_keys)
+        self.n_list_pages = 0
+        self.n_delete_calls = 0
+
+    def get_paginator(self, name):
+        assert name == 'list_object_versions'
+        return self
+
+    def paginate(self, Bucket):
+        assert Bucket == BUCKET
+        with self.lock:
+            entries = sorted([('Versions', k, v) for (k, v) in self.versions] +
+                             [('DeleteMarkers', k, v) for (k, v) in self.markers], key=lambda e: (e[1], e[2]))
+        for i in range(0, len(entries), PAGE_SIZE):
+            self.n_list_pages += 1
+            page = {'Versions': [], 'DeleteMarkers': []}
+            for (kind, key, version) in entries[i:i + PAGE_SIZE]:
+                page[kind].append({'Key': key, 'VersionId': version})
+            yield page
+
+    def delete_objects(self, Bucket, Delete):
+        assert Bucket == BUCKET and Delete['Quiet'] and len(Delete['Objects']) <= s3purge.MAX_DELETE_BATCH
+        errors = []
+        with self.lock:
+            self.n_delete_calls += 1
+            for o in Delete['Objects']:
+                k = (o['Key'], o['VersionId'])
+                if o['Key'] in self.fail_keys:
+                    errors.append({'Key': o['Key'], 'VersionId': o['VersionId'], 'Message': 'Access Denied'})
+                else:
+                    self.versions.pop(k, None)
+                    self.markers.pop(k, None)
+        return {'Errors': errors} if errors else {}
+
+    def n_left(self):
+        return len(self.versions) + len(self.markers)
+
+
+def test_purge_versioned():
+    s3 = FakeVersionedS3(1500)
+    total = s3.n_left()
+    ret = purge_bucket(s3, BUCKET, workers=4)
+    # every version and every delete marker, across several list pages and delete batches
+    assert s3.n_list_pages > 1 and s3.n_delete_calls == -(-total // s3purge.MAX_DELETE_BATCH)
+    assert s3.n_left() == 0
+    assert ret['Complete'] and (ret['DeletedObjects'], ret['FailedObjects']) == (total, 0)
+    # an empty bucket is fine
+    assert purge_bucket(s3, BUCKET)['Complete']
+    return True
+
+
+def test_purge_errors():
+    s3 = FakeVersionedS3(1200, fail_keys={'chain/obj-00009'})
+    ret = purge_bucket(s3, BUCKET)
+    assert not ret['Complete'] and ret['FailedObjects'] == 3  # two versions + a delete marker
+    assert s3.n_left() == 3
+    return True
+
+
+def test_purge_out_of_time():
+    s3 = FakeVersionedS3(2000)
+    total = s3.n_left()
+    calls = []
+
+    def remaining_time():
+        # plenty of time for the first two batches, then the deadline is near
+        calls.append(1)
+        return 100 if len(calls) <= 2 else 5
+
+    ret = purge_bucket(s3, BUCKET, remaining_time=remaining_time, margin=20, workers=1)
+    assert not ret['Complete'] and ret['FailedObjects'] == 0
+    assert ret['DeletedObjects'] == 2 * s3purge.MAX_DELETE_BATCH == total - s3.n_left()
+    # ...and a later invocation picks up the rest
+    ret = purge_bucket(s3, BUCKET)
+    assert ret['Complete'] and ret['DeletedObjects'] == total - 2 * s3purge.MAX_DELETE_BATCH
+    assert s3.n_left() == 0
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_purge_versioned, test_purge_errors, test_purge_out_of_time]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")
@@ -0,0 +1,150 @@
+import json
+import sys, os
+
+main_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+one_up_dir = os.path.dirname(main_dir)
+sys.path.insert(0, main_dir)
+sys.path.insert(0, os.path.join(main_dir, 'deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common/deps'))
+sys.path.insert(0, os.path.join(one_up_dir, 'common'))
+
+import logging
+
+import boto3
+boto3.setup_default_session(region_name='ap-southeast-2')
+import lib
+from lib import scale_node_keys, create_node_keys, save_node_keys, save_poa_pks, save_service_pks, save_enode_pks, \
+    get_validator_transitions, gen_chainspec_json, gen_ssm_key_poa_pks, gen_ssm_enode_pks, gen_ssm_nodekey_consensus, \
+    min_transition_delay_blocks
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('TestScaleNodeKeys')
+
+NAME_PREFIX = 'tnscale'
+HEAD = 1000
+
+
+class FakeSsm:
+    '''The parameter APIs lib uses, over a dict.'''
+
+    def __init__(self):
+        self.params = {}
+
+    def get_parameter(self, Name, WithDecryption=False):
+        if Name not in self.params:
+            raise Exception(f"ParameterNotFound: {Name}")
+        return {'Parameter': {'Name': Name, 'Value': self.params[Name]}}
+
+    def get_parameters(self, Names, WithDecryption=False):
+        return {'Parameters': [{'Name': n, 'Value': self.params[n]} for n in Names if n in self.params]}
+
+    def put_parameter(self, Name, Value, Overwrite=False, **kwargs):
+        if Name in self.params and not Overwrite:
+            raise Exception(f"ParameterAlreadyExists: {Name}")
+        self.params[Name] = Value
+
+    def describe_parameters(self, ParameterFilters, MaxResults=50, **kwargs):
+        prefixes = ParameterFilters[0]['Values']
+        return {'Parameters': [{'Name': n} for n in sorted(self.params) if any(n.startswith(p) for p in prefixes)]}
+
+
+class FakeNode:
+    def __init__(self, url):
+        pass
+
+    def block_number(self):
+        return HEAD
+
+
+def scale(c, p, old_c, old_p, **props):
+    props = dict({'pEnodeIps': '1.2.3.4,1.2.3.5', 'TransitionDelayBlocks': '120'}, **props)
+    return scale_node_keys(NAME_PREFIX, str(c), str(p), str(old_c), str(old_p), **props)
+
+
+def poa_pks():
+    return json.loads(lib.ssm.params[gen_ssm_key_poa_pks(NAME_PREFIX)])
+
+
+def setup():
+    (lib.ssm, lib.JsonRpcClient) = (FakeSsm(), FakeNode)
+    keys = create_node_keys(3, NAME_PREFIX, 2)
+    save_node_keys(keys['ssm_keys'], NAME_PREFIX)
+    save_poa_pks(keys['poa_pks'], NAME_PREFIX)
+    save_service_pks(keys['service_pks'], NAME_PREFIX)
+    save_enode_pks(keys['enode_pks'], NAME_PREFIX)
+    return keys
+
+
+def test_scale_validators():
+    (ssm, rpc_client) = (lib.ssm, lib.JsonRpcClient)
+    try:
+        genesis = setup()['poa_pks']
+        assert scale(3, 2, 3, 2) == {'UpdatedPrivKeys': False, 'PoAAddresses': genesis}
+
+        # grow: existing validators keep their keys, the new set starts TransitionDelayBlocks from now
+        ret = scale(5, 2, 3, 2)
+        block = HEAD + 120
+        assert ret['ValidatorTransitionBlock'] == block and ret['PoAAddresses'] == poa_pks()
+        assert len(poa_pks()) == 5 and poa_pks()[:3] == genesis
+        assert get_validator_transitions(NAME_PREFIX) == {'0': genesis, str(block): poa_pks()}
+        spec = gen_chainspec_json(poa_pks(), [], [], '', validator_transitions=get_validator_transitions(NAME_PREFIX),
+                                  NamePrefix=NAME_PREFIX, BlockGasLimit='8000000', NetworkId=1)
+        multi = spec['engine']['authorityRound']['params']['validators']['multi']
+        assert list(multi) == ['0', str(block)] and multi[str(block)]['list'] == poa_pks()
+        fifth = poa_pks()[4]
+
+        # shrink: the tail is dropped from the set, but its key stays in SSM
+        scale(4, 2, 5, 2, ValidatorTransitionBlock=str(2000))
+        assert poa_pks() == ret['PoAAddresses'][:4]
+        assert gen_ssm_nodekey_consensus(NAME_PREFIX, 4) in lib.ssm.params
+        assert sorted(get_validator_transitions(NAME_PREFIX), key=int) == ['0', str(block), '2000']
+
+        # ...so growing again brings back the same validator
+        scale(5, 2, 4, 2, ValidatorTransitionBlock=str(3000))
+        assert poa_pks()[4] == fifth
+    finally:
+        (lib.ssm, lib.JsonRpcClient) = (ssm, rpc_client)
+    return True
+
+
+def test_transition_too_soon():
+    (ssm, rpc_client) = (lib.ssm, lib.JsonRpcClient)
+    try:
+        setup()
+        before = dict(lib.ssm.params)
+        # nodes can't all reload the chainspec in time: nothing is written
+        too_soon = HEAD + min_transition_delay_blocks(3) - 1
+        try:
+            scale(4, 2, 3, 2, ValidatorTransitionBlock=str(too_soon))
+            assert False
+        except Exception as e:
+            assert 'Refusing validator transition' in str(e)
+        assert lib.ssm.params == before
+        # a short TransitionDelayBlocks is stretched to what the reload needs
+        ret = scale(4, 2, 3, 2, TransitionDelayBlocks='1')
+        assert ret['ValidatorTransitionBlock'] == HEAD + min_transition_delay_blocks(4)
+    finally:
+        (lib.ssm, lib.JsonRpcClient) = (ssm, rpc_client)
+    return True
+
+
+def test_scale_public_nodes():
+    (ssm, rpc_client) = (lib.ssm, lib.JsonRpcClient)
+    try:
+        keys = setup()
+        ret = scale(3, 3, 3, 2)
+        assert ret['UpdatedPrivKeys'] and 'ValidatorTransitionBlock' not in ret
+        enode_pks = json.loads(lib.ssm.params[gen_ssm_enode_pks(NAME_PREFIX)])
+        assert len(enode_pks) == 3 and enode_pks[:2] == keys['enode_pks']
+        # public nodes don't change the validator set
+        assert get_validator_transitions(NAME_PREFIX) == {'0': keys['poa_pks']}
+    finally:
+        (lib.ssm, lib.JsonRpcClient) = (ssm, rpc_client)
+    return True
+
+
+if __name__ == "__main__":
+    tests = [test_scale_validators, test_transition_too_soon, test_scale_public_nodes]
+
+    for t in tests:
+        print(f"{t.__name__}: {t()}")